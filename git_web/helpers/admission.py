@@ -0,0 +1,220 @@
+"""
+Admission control for requests that spawn git processes,
+limiting how many of each class run at once and in total
+"""
+import asyncio
+import math
+from bisect import insort
+from collections import Counter
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from functools import cache, wraps
+from itertools import count
+
+from quart import Response, current_app
+from quart.wrappers.response import IterableBody, ResponseBody
+from werkzeug.exceptions import ServiceUnavailable
+
+from .config import get_config
+
+__all__ = [
+    "ADMISSION_CLASSES", "AdmissionController",
+    "get_admission_controller", "admit", "admitted",
+    "admission_required", "release_after", "admitted_response",
+]
+
+# in priority order, when slots free up earlier classes are admitted first
+ADMISSION_CLASSES = ("interactive", "push", "fetch", "archive", "maintenance")
+
+
+class AdmissionController:
+    """
+    Limits the running requests of each class and in total,
+    waiting requests are admitted by class priority then arrival
+    """
+    def __init__(self, limits: dict[str, int], max_total: int):
+        """
+            :param limits: The max running requests of each class in ADMISSION_CLASSES
+            :param max_total: The max running requests of all classes
+        """
+        self.limits = limits
+        self.max_total = max_total
+        self._running = Counter()
+        self._rejected = Counter()
+        self._waiting: list[tuple[int, int, str, asyncio.Future]] = []
+        self._arrivals = count()
+
+    def _can_run(self, admission_class: str) -> bool:
+        return (
+            self._running[admission_class] < self.limits[admission_class] and
+            self._running.total() < self.max_total
+        )
+
+    def _admit_waiting(self):
+        for entry in list(self._waiting):
+            *_, admission_class, waiter = entry
+            if not waiter.done() and self._can_run(admission_class):
+                self._waiting.remove(entry)
+                self._running[admission_class] += 1
+                waiter.set_result(None)
+
+    async def acquire(self, admission_class: str, timeout: float):
+        """
+        Wait to be admitted, must be followed by a 'release'
+
+            :param admission_class: The class from ADMISSION_CLASSES
+            :param timeout: Seconds to wait in the queue
+            :raises ServiceUnavailable: When not admitted within the timeout
+        """
+        if self._can_run(admission_class):
+            # waiting requests can't run, otherwise they would have been admitted
+            self._running[admission_class] += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (
+            ADMISSION_CLASSES.index(admission_class),
+            next(self._arrivals), admission_class, waiter,
+        )
+        insort(self._waiting, entry)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as err:
+            if waiter.done() and not waiter.cancelled():
+                # admitted just as the wait was given up
+                self.release(admission_class)
+            else:
+                self._waiting.remove(entry)
+            if isinstance(err, asyncio.TimeoutError):
+                self._rejected[admission_class] += 1
+                raise ServiceUnavailable(
+                    f"Too many '{admission_class}' requests, try again later",
+                    retry_after=math.ceil(timeout),
+                ) from None
+            raise
+
+    def release(self, admission_class: str):
+        """
+        Release an admitted request's slot, admitting waiting requests
+
+            :param admission_class: The class it was admitted as
+        """
+        self._running[admission_class] -= 1
+        self._admit_waiting()
+
+    def get_stats(self) -> dict[str, dict[str, int]]:
+        """
+        Get the queue depths of each class
+
+            :return: The limit, running, waiting and rejected counts by class
+        """
+        waiting = Counter(admission_class for *_, admission_class, _ in self._waiting)
+        return {
+            admission_class: {
+                "limit": self.limits[admission_class],
+                "running": self._running[admission_class],
+                "waiting": waiting[admission_class],
+                "rejected": self._rejected[admission_class],
+            }
+            for admission_class in ADMISSION_CLASSES
+        }
+
+
+@cache
+def get_admission_controller() -> AdmissionController:
+    """
+    Get the controller, limited by the ADMISSION_* config
+
+        :return: The controller
+    """
+    config = get_config()
+    return AdmissionController(
+        {
+            admission_class: getattr(config, f"ADMISSION_{admission_class.upper()}_LIMIT")
+            for admission_class in ADMISSION_CLASSES
+        },
+        config.ADMISSION_MAX_TOTAL,
+    )
+
+
+async def admit(admission_class: str):
+    """
+    Wait up to ADMISSION_QUEUE_TIMEOUT to be admitted,
+    must be followed by a release from the controller
+
+        :param admission_class: The class from ADMISSION_CLASSES
+        :raises ServiceUnavailable: When not admitted in time
+    """
+    await get_admission_controller().acquire(
+        admission_class, get_config().ADMISSION_QUEUE_TIMEOUT)
+
+
+@asynccontextmanager
+async def admitted(admission_class: str):
+    """
+    Hold an admission slot while in the context
+
+        :param admission_class: The class from ADMISSION_CLASSES
+        :raises ServiceUnavailable: When not admitted in time
+    """
+    await admit(admission_class)
+    try:
+        yield
+    finally:
+        get_admission_controller().release(admission_class)
+
+
+def admission_required(admission_class: str):
+    """
+    Decorate a view to run once admitted, for views
+    which have finished with git when they return
+
+        :param admission_class: The class from ADMISSION_CLASSES
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with admitted(admission_class):
+                return await current_app.ensure_async(func)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def release_after(
+        admission_class: str,
+        body: ResponseBody) -> AsyncGenerator[bytes, None]:
+    """
+    Pass through a response body streamed from git,
+    releasing its admission slot once it has been sent
+
+        :param admission_class: The class it was admitted as
+        :param body: The response body
+        :yield: Each chunk
+    """
+    try:
+        async with body as content:
+            async for chunk in content:
+                yield chunk
+    finally:
+        get_admission_controller().release(admission_class)
+
+
+async def admitted_response(
+        admission_class: str,
+        make_response: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Make a response streamed from git once admitted,
+    holding the slot until its body has been sent
+
+        :param admission_class: The class from ADMISSION_CLASSES
+        :param make_response: Makes the response
+        :raises ServiceUnavailable: When not admitted in time
+        :return: The response
+    """
+    await admit(admission_class)
+    try:
+        response = await make_response()
+    except BaseException:
+        get_admission_controller().release(admission_class)
+        raise
+    response.response = IterableBody(release_after(admission_class, response.response))
+    return response
@@ -0,0 +1,113 @@
+"""
+Repository archives built once per tree, format and compression level,
+kept in an on-disk cache
+"""
+import shutil
+from collections.abc import AsyncGenerator
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from git_interface.exceptions import BufferedProcessError, GitException
+from git_interface.helpers import subprocess_run_buffered
+
+from .caching import DiskCache, get_cache_path, open_or_build
+from .config import get_config
+
+__all__ = [
+    "ARCHIVE_LEVELS", "is_archive_format_available",
+    "get_archive_disk_cache", "get_archive_name", "open_archive",
+]
+
+# archive formats and the compression levels they accept
+ARCHIVE_LEVELS = {
+    "tar": range(0),
+    "tar.gz": range(1, 10),
+    "zip": range(0, 10),
+    "tar.zst": range(1, 20),
+}
+
+
+@cache
+def _is_command_installed(command: str) -> bool:
+    return shutil.which(command.split()[0]) is not None
+
+
+def is_archive_format_available(archive_format: str) -> bool:
+    """
+    Whether an archive format can be built,
+    'tar.zst' needs ARCHIVE_ZSTD_COMMAND to be installed
+
+        :param archive_format: The format e.g. 'tar.gz'
+        :return: Whether it is available
+    """
+    if archive_format == "tar.zst":
+        command = get_config().ARCHIVE_ZSTD_COMMAND
+        return command is not None and _is_command_installed(command)
+    return archive_format in ARCHIVE_LEVELS
+
+
+@cache
+def get_archive_disk_cache() -> DiskCache:
+    """
+    Get the cache of built archives, limited by ARCHIVE_CACHE_SIZE
+
+        :return: The cache
+    """
+    return DiskCache(get_cache_path("archives"), get_config().ARCHIVE_CACHE_SIZE)
+
+
+async def _run_archive(
+        repo_path: Path,
+        object_hash: str,
+        archive_format: str,
+        level: Optional[int]) -> AsyncGenerator[bytes, None]:
+    args = ["git", "-C", str(repo_path)]
+    if archive_format == "tar.zst":
+        args += ["-c", f"tar.tar.zst.command={get_config().ARCHIVE_ZSTD_COMMAND}"]
+    args += ["archive", f"--format={archive_format}"]
+    if level is not None:
+        # also given to the zstd command
+        args.append(f"-{level}")
+    args.append(object_hash)
+    try:
+        async for chunk in subprocess_run_buffered(args):
+            yield chunk
+    except BufferedProcessError as err:
+        raise GitException(err.args[0].decode()) from err
+
+
+def get_archive_name(object_hash: str, archive_format: str, level: Optional[int]) -> str:
+    """
+    Get the cache file name of an archive, also used as its ETag
+
+        :param object_hash: The commit or tree hash
+        :param archive_format: The format
+        :param level: The compression level or None for the default
+        :return: The name
+    """
+    if level is None:
+        return f"{object_hash}.{archive_format}"
+    return f"{object_hash}-{level}.{archive_format}"
+
+
+async def open_archive(
+        repo_path: Path,
+        object_hash: str,
+        archive_format: str,
+        level: Optional[int] = None) -> tuple[Optional[int], AsyncGenerator[bytes, None]]:
+    """
+    Open an archive of a commit or tree,
+    building it when not cached, see 'open_or_build'
+
+        :param repo_path: The repo path
+        :param object_hash: The full commit or tree hash
+        :param archive_format: The format, see 'is_archive_format_available'
+        :param level: The compression level, from ARCHIVE_LEVELS, defaults to None
+        :return: The archive size (None while building) and its content
+    """
+    return await open_or_build(
+        get_archive_disk_cache(),
+        get_archive_name(object_hash, archive_format, level),
+        lambda: _run_archive(repo_path, object_hash, archive_format, level),
+    )
@@ -0,0 +1,62 @@
+"""
+Tasks run in the background while the app is serving
+"""
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+
+__all__ = [
+    "start_background_task", "start_periodic_task", "stop_background_tasks",
+]
+
+logger = logging.getLogger(__name__)
+
+# referenced until stopped, as the event loop only keeps weak references
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _run_periodically(interval: float, func: Callable[[], Awaitable]):
+    while True:
+        try:
+            await func()
+        except Exception:
+            # tried again next time
+            logger.exception("background task '%s' failed", func.__name__)
+        await asyncio.sleep(interval)
+
+
+def start_background_task(func: Callable[[], Awaitable]) -> asyncio.Task:
+    """
+    Run a function until it returns or is stopped
+
+        :param func: The async function
+        :return: The task
+    """
+    task = asyncio.ensure_future(func())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def start_periodic_task(interval: float, func: Callable[[], Awaitable]) -> asyncio.Task:
+    """
+    Run a function now and then every interval, until stopped
+
+        :param interval: Seconds between a run finishing and the next starting
+        :param func: The async function
+        :return: The task
+    """
+    task = asyncio.ensure_future(_run_periodically(interval, func))
+    _background_tasks.add(task)
+    return task
+
+
+async def stop_background_tasks():
+    """
+    Cancel the background tasks and wait for them to stop
+    """
+    tasks = list(_background_tasks)
+    _background_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
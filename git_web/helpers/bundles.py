@@ -0,0 +1,139 @@
+"""
+Bundles of each repository's default branch, refreshed in the
+background and offered to cloning git clients through 'bundle-uri'
+so most of the history is downloaded as a plain file
+"""
+import logging
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from git_interface.exceptions import GitException
+from git_interface.helpers import subprocess_run
+from git_interface.symbolic_ref import get_symbolic_ref
+from werkzeug.exceptions import HTTPException
+
+from .admission import admitted
+from .caching import get_cache_path
+from .calculations import create_git_http_uri, find_dirs, find_repos
+from .cat_file_pool import get_commit_hash
+from .config import get_config
+
+__all__ = [
+    "BUNDLE_SUFFIX", "is_bundle_uri_enabled", "get_bundle_directory", "get_bundle_path",
+    "create_bundle", "create_all_bundles", "get_bundle_list",
+]
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_SUFFIX = ".bundle"
+
+
+def is_bundle_uri_enabled() -> bool:
+    """
+    Whether bundles are made and advertised, set by BUNDLE_INTERVAL
+
+        :return: Whether enabled
+    """
+    return get_config().BUNDLE_INTERVAL > 0
+
+
+def get_bundle_directory(repo_path: Path) -> Path:
+    """
+    Get where a repository's bundles are stored
+
+        :param repo_path: The repo path
+        :return: The directory
+    """
+    return get_cache_path("bundles") / repo_path.parent.name / repo_path.name
+
+
+def get_bundle_path(repo_path: Path) -> Optional[Path]:
+    """
+    Get a repository's newest bundle
+
+        :param repo_path: The repo path
+        :return: The bundle path or None when there isn't one
+    """
+    newest = None
+    for path in get_bundle_directory(repo_path).glob("*" + BUNDLE_SUFFIX):
+        try:
+            modified = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            # replaced by a newer bundle
+            continue
+        if newest is None or modified > newest[0]:
+            newest = (modified, path)
+    return None if newest is None else newest[1]
+
+
+async def create_bundle(repo_path: Path) -> bool:
+    """
+    Bundle a repository's default branch, unless
+    it is already bundled at its latest commit
+
+        :param repo_path: The repo path
+        :raises GitException: When git fails
+        :raises ServiceUnavailable: When not admitted to run git in time
+        :return: Whether a bundle was created
+    """
+    try:
+        branch = await get_symbolic_ref(repo_path, "HEAD")
+        commit_hash = await get_commit_hash(repo_path, branch)
+    except GitException:
+        # no commits yet
+        return False
+    directory = get_bundle_directory(repo_path)
+    path = directory / f"{commit_hash}{BUNDLE_SUFFIX}"
+    if path.exists():
+        return False
+    directory.mkdir(parents=True, exist_ok=True)
+    temp_path = directory / f"{uuid.uuid4().hex}.tmp"
+    try:
+        async with admitted("maintenance"):
+            result = await subprocess_run([
+                "git", "-C", str(repo_path), "bundle", "create", "-q",
+                str(temp_path.absolute()), branch,
+            ])
+        if result.returncode != 0:
+            raise GitException(result.stderr.decode())
+        temp_path.rename(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    # downloads already started keep reading the unlinked file
+    for old_path in directory.glob("*" + BUNDLE_SUFFIX):
+        if old_path != path:
+            old_path.unlink(missing_ok=True)
+    return True
+
+
+async def create_all_bundles():
+    """
+    Bundle every repository with new commits on its default branch,
+    called every BUNDLE_INTERVAL seconds
+    """
+    repos_path = get_config().REPOS_PATH
+    for directory in find_dirs():
+        for repo_path in find_repos(repos_path / directory):
+            try:
+                await create_bundle(repo_path)
+            except (GitException, HTTPException) as err:
+                # tried again next time
+                logger.warning("bundling '%s' failed: %s", repo_path, err)
+
+
+def get_bundle_list(repo_path: Path) -> list[str]:
+    """
+    Get the 'key=value' lines answering
+    a protocol v2 'bundle-uri' command
+
+        :param repo_path: The repo path
+        :return: The lines, empty when not bundled yet
+    """
+    if (path := get_bundle_path(repo_path)) is None:
+        return []
+    return [
+        "bundle.version=1",
+        "bundle.mode=all",
+        f"bundle.{path.stem}.uri={create_git_http_uri(repo_path)}/bundles/{path.name}",
+    ]
@@ -0,0 +1,547 @@
+"""
+In-memory and on-disk caches and their invalidation
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterable, Callable, Hashable
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+
+from git_interface.exceptions import GitException
+
+from .config import get_config
+
+__all__ = [
+    "LRUCache", "DiskCache", "DiskCacheBuild", "HighlightCache",
+    "open_or_build", "get_cache_path", "remove_temp_cache_path", "iter_file",
+    "register_repo_cache", "register_repo_listener", "invalidate_repo",
+    "get_refs_fingerprint",
+]
+
+# seconds before a left over temporary file is removed
+STALE_TEMP_FILE_AGE = 60*60
+# bytes read from a cached file at once when streaming it
+FILE_READ_SIZE = 2**16
+
+
+class LRUCache:
+    """
+    A least recently used cache limited by the total size of its values,
+    by default each value has a size of 1 so the limit is an entry count.
+
+    When group_by is given, entries can be removed
+    by group e.g. all entries belonging to a repository
+    """
+    def __init__(
+            self,
+            max_size: int,
+            sizeof: Callable[[Any], int] = lambda _: 1,
+            group_by: Optional[Callable[[Hashable], Hashable]] = None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.group_by = group_by
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._groups: dict[Hashable, set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default=None):
+        """
+        Get a value, marking it as recently used
+
+            :param key: The key
+            :param default: Returned when missing, defaults to None
+            :return: The value or default
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: Hashable, value):
+        """
+        Store a value, evicting the least recently used
+        entries until it fits, values larger than the
+        cache itself are not stored
+
+            :param key: The key
+            :param value: The value
+        """
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            self.pop(next(iter(self._entries)))
+        self._entries[key] = (value, size)
+        self.size += size
+        if self.group_by is not None:
+            self._groups.setdefault(self.group_by(key), set()).add(key)
+
+    def pop(self, key: Hashable, default=None):
+        """
+        Remove a value
+
+            :param key: The key
+            :param default: Returned when missing, defaults to None
+            :return: The removed value or default
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.size -= entry[1]
+        if self.group_by is not None:
+            group = self.group_by(key)
+            self._groups[group].discard(key)
+            if not self._groups[group]:
+                del self._groups[group]
+        return entry[0]
+
+    def pop_group(self, group: Hashable):
+        """
+        Remove all values belonging to a group
+
+            :param group: The group
+        """
+        for key in tuple(self._groups.get(group, ())):
+            self.pop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._groups.clear()
+        self.size = 0
+
+
+class DiskCache:
+    """
+    A least recently used cache of files in a directory,
+    limited by the total file size.
+
+    The directory may be shared between worker processes,
+    so a file can disappear after another process evicts it.
+    Each process only counts the files it has seen (those found
+    at start up and those it added), so with several server
+    workers the directory can grow up to max_size per worker
+    """
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._files: OrderedDict[str, int] = OrderedDict()
+        directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        stale_before = time.time() - STALE_TEMP_FILE_AGE
+        for entry in os.scandir(directory):
+            if entry.name.startswith("."):
+                # temporary file, possibly being written by another process
+                if entry.stat().st_mtime < stale_before:
+                    Path(entry.path).unlink(missing_ok=True)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+        self._evict()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._files
+
+    def _evict(self, keep: Optional[str] = None):
+        for name in tuple(self._files):
+            if self.size <= self.max_size:
+                break
+            if name != keep:
+                self.remove(name)
+
+    def temp_path(self) -> Path:
+        """
+        Get a path to write a new file to before adding it
+
+            :return: The path
+        """
+        return self.directory / f".{uuid.uuid4().hex}.tmp"
+
+    def get(self, name: str) -> Optional[Path]:
+        """
+        Get the path of a cached file, marking it as recently used
+
+            :param name: The file name
+            :return: The path or None when not cached
+        """
+        if name not in self._files:
+            return None
+        path = self.directory / name
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.size -= self._files.pop(name)
+            return None
+        self._files.move_to_end(name)
+        return path
+
+    def add(self, name: str, temp_path: Path) -> Path:
+        """
+        Move a finished file into the cache,
+        evicting the least recently used files until it fits
+
+            :param name: The file name
+            :param temp_path: The written file, from temp_path()
+            :return: The cached path
+        """
+        path = self.directory / name
+        size = temp_path.stat().st_size
+        os.replace(temp_path, path)
+        self.size -= self._files.pop(name, 0)
+        self._files[name] = size
+        self.size += size
+        self._evict(name)
+        return path
+
+    def remove(self, name: str):
+        self.size -= self._files.pop(name, 0)
+        (self.directory / name).unlink(missing_ok=True)
+
+    async def read(self, name: str) -> Optional[bytes]:
+        """
+        Read a cached file, without blocking the event loop
+
+            :param name: The file name
+            :return: The content or None when not cached
+        """
+        if (path := self.get(name)) is None:
+            return None
+        try:
+            return await asyncio.to_thread(path.read_bytes)
+        except FileNotFoundError:
+            self.size -= self._files.pop(name, 0)
+            return None
+
+    async def write(self, name: str, content: bytes) -> Path:
+        """
+        Write a file into the cache, without blocking the event loop
+
+            :param name: The file name
+            :param content: The content
+            :return: The cached path
+        """
+        temp_path = self.temp_path()
+        await asyncio.to_thread(temp_path.write_bytes, content)
+        return self.add(name, temp_path)
+
+    async def open(self, name: str) -> Optional[BinaryIO]:
+        """
+        Open a cached file for reading, without blocking the event loop
+
+            :param name: The file name
+            :return: The open file, stays readable if evicted while open,
+                     or None when not cached
+        """
+        if (path := self.get(name)) is None:
+            return None
+        try:
+            return await asyncio.to_thread(open, path, "rb")
+        except FileNotFoundError:
+            self.size -= self._files.pop(name, 0)
+            return None
+
+
+class DiskCacheBuild:
+    """
+    A file being written into a DiskCache from a stream of chunks,
+    which can be read by any number of readers while it is written
+    """
+    def __init__(self, disk: DiskCache, name: str):
+        self.disk = disk
+        self.name = name
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self._temp_path = disk.temp_path()
+        self._temp_path.touch()
+        self._changed = asyncio.Condition()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def write(self, chunks: AsyncIterable[bytes]):
+        """
+        Write the file, adding it to the cache once complete
+
+            :param chunks: The file content
+        """
+        try:
+            # unbuffered, so readers see each chunk once written
+            with await asyncio.to_thread(open, self._temp_path, "wb", 0) as file:
+                async for chunk in chunks:
+                    await asyncio.to_thread(file.write, chunk)
+                    self.size += len(chunk)
+                    await self._notify()
+            self.disk.add(self.name, self._temp_path)
+        except BaseException:
+            self.failed = True
+            self._temp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self.done = True
+            await self._notify()
+
+    async def iter_content(self) -> AsyncGenerator[bytes, None]:
+        """
+        Read the file, following it while it is written
+
+            :raises GitException: Writing the file failed
+            :yield: Each chunk
+        """
+        # opened without awaiting between checking and opening, as
+        # the temporary file is renamed into the cache once complete
+        path = self._temp_path if not self.done else self.disk.directory / self.name
+        if self.failed:
+            raise GitException(f"building '{self.name}' failed")
+        with open(path, "rb") as file:
+            position = 0
+            while True:
+                chunk = await asyncio.to_thread(file.read, FILE_READ_SIZE)
+                if chunk:
+                    position += len(chunk)
+                    yield chunk
+                    continue
+                if self.failed:
+                    raise GitException(f"building '{self.name}' failed")
+                if self.done and position >= self.size:
+                    return
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: self.done or self.size > position)
+
+
+async def iter_file(
+        file: BinaryIO,
+        start: int = 0,
+        stop: Optional[int] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Read an open file in chunks, closing it after
+
+        :param file: The file
+        :param start: The first byte, defaults to 0
+        :param stop: The byte to stop before, defaults to None for the end
+        :yield: Each chunk
+    """
+    with file:
+        file.seek(start)
+        remaining = sys.maxsize if stop is None else stop - start
+        while chunk := await asyncio.to_thread(file.read, min(FILE_READ_SIZE, remaining)):
+            remaining -= len(chunk)
+            yield chunk
+
+
+# builds in progress by cache directory and name, so concurrent requests share one
+_pending_builds: dict[tuple[Path, str], DiskCacheBuild] = {}
+# referenced until done, as the event loop only keeps weak references
+_build_tasks: set[asyncio.Task] = set()
+
+
+def _start_build(
+        disk: DiskCache,
+        name: str,
+        build: Callable[[], AsyncIterable[bytes]]) -> DiskCacheBuild:
+    key = (disk.directory, name)
+    pending = DiskCacheBuild(disk, name)
+    task = asyncio.ensure_future(pending.write(build()))
+    _pending_builds[key] = pending
+    _build_tasks.add(task)
+
+    def finished(task: asyncio.Task):
+        _pending_builds.pop(key, None)
+        _build_tasks.discard(task)
+        if not task.cancelled():
+            # readers are told of a failure by the build
+            task.exception()
+
+    task.add_done_callback(finished)
+    return pending
+
+
+async def open_or_build(
+        disk: DiskCache,
+        name: str,
+        build: Callable[[], AsyncIterable[bytes]],
+) -> tuple[Optional[int], AsyncGenerator[bytes, None]]:
+    """
+    Open a file from a DiskCache, building it when not cached.
+    The build continues when the reader stops early and is shared
+    with concurrent requests, which read it while it is written,
+    so only a chunk at a time is held in memory
+
+        :param disk: The cache
+        :param name: The file name
+        :param build: Makes the file content when called
+        :return: The file size (None while building) and its content
+    """
+    key = (disk.directory, name)
+    if (pending := _pending_builds.get(key)) is None:
+        if (file := await disk.open(name)) is not None:
+            return os.fstat(file.fileno()).st_size, iter_file(file)
+        if (pending := _pending_builds.get(key)) is None:
+            pending = _start_build(disk, name, build)
+    return None, pending.iter_content()
+
+
+# used for on-disk caches when CACHE_PATH is not set
+_temp_cache_path: Optional[Path] = None
+
+
+def get_cache_path(name: str) -> Path:
+    """
+    Get the directory of an on-disk cache, in CACHE_PATH
+    or in a temporary directory when it is not set
+
+        :param name: The cache name
+        :return: The directory path
+    """
+    global _temp_cache_path
+    if get_config().CACHE_PATH is not None:
+        return get_config().CACHE_PATH / name
+    if _temp_cache_path is None:
+        _temp_cache_path = Path(tempfile.mkdtemp(prefix="git-web-"))
+    return _temp_cache_path / name
+
+
+def remove_temp_cache_path():
+    """
+    Remove the temporary directory used
+    for on-disk caches when CACHE_PATH is not set
+    """
+    global _temp_cache_path
+    if _temp_cache_path is not None:
+        shutil.rmtree(_temp_cache_path, ignore_errors=True)
+        _temp_cache_path = None
+
+
+class HighlightCache:
+    """
+    Highlighted blob HTML keyed by blob hash and lexer,
+    held in memory up to max_size bytes and optionally
+    spilt to disk so a restart is not a cold start
+    """
+    def __init__(self, max_size: int, disk: Optional[DiskCache] = None):
+        self.memory = LRUCache(max_size, sys.getsizeof)
+        self.disk = disk
+        self.disk_hits = 0
+
+    @staticmethod
+    def _disk_name(key: tuple[str, str]) -> str:
+        return "{}-{}.html".format(*key).replace("/", "_")
+
+    @property
+    def hits(self) -> int:
+        return self.memory.hits
+
+    @property
+    def misses(self) -> int:
+        return self.memory.misses - self.disk_hits
+
+    async def get(self, object_hash: str, lexer_name: str) -> Optional[str]:
+        key = (object_hash, lexer_name)
+        if (html := self.memory.get(key)) is not None:
+            return html
+        if self.disk is not None:
+            if (content := await self.disk.read(self._disk_name(key))) is not None:
+                self.disk_hits += 1
+                html = content.decode()
+                self.memory.set(key, html)
+                return html
+        return None
+
+    async def set(self, object_hash: str, lexer_name: str, html: str):
+        key = (object_hash, lexer_name)
+        self.memory.set(key, html)
+        if self.disk is not None:
+            await self.disk.write(self._disk_name(key), html.encode())
+
+
+# caches with entries grouped by repository path
+_repo_caches: list[LRUCache] = []
+# called with the repo path by invalidate_repo
+_repo_listeners: list[Callable[[Path], None]] = []
+# bumped when a repository's refs are changed through this app
+_repo_generations: dict[str, int] = {}
+
+
+def register_repo_cache(cache: LRUCache) -> LRUCache:
+    """
+    Register a cache grouped by repository path
+    so it is cleared by invalidate_repo
+
+        :param cache: The cache
+        :return: The same cache
+    """
+    _repo_caches.append(cache)
+    return cache
+
+
+def register_repo_listener(listener: Callable[[Path], None]):
+    """
+    Register a function to call with a repository's
+    path when invalidate_repo is called for it
+
+        :param listener: The function
+    """
+    _repo_listeners.append(listener)
+
+
+def invalidate_repo(repo_path: Path):
+    """
+    Clear everything cached for a repository,
+    should be called after its refs have changed
+
+        :param repo_path: The repo path
+    """
+    key = str(repo_path)
+    _repo_generations[key] = _repo_generations.get(key, 0) + 1
+    for cache in _repo_caches:
+        cache.pop_group(key)
+    for listener in _repo_listeners:
+        listener(repo_path)
+
+
+def get_refs_fingerprint(repo_path: Path) -> tuple[int, ...]:
+    """
+    Get a cheap value that changes when the repository's refs change,
+    even when changed outside of this app e.g. a ssh push.
+
+    Uses the modification times of HEAD, packed-refs and
+    every directory under refs, as git updates a ref by
+    renaming a lock file in the ref's directory
+
+        :param repo_path: The repo path
+        :return: The fingerprint
+    """
+    fingerprint = [_repo_generations.get(str(repo_path), 0)]
+    for name in ("HEAD", "packed-refs"):
+        try:
+            fingerprint.append(os.stat(repo_path / name).st_mtime_ns)
+        except FileNotFoundError:
+            fingerprint.append(0)
+    latest = 0
+    for dir_path, _, _ in os.walk(repo_path / "refs"):
+        latest = max(latest, os.stat(dir_path).st_mtime_ns)
+    fingerprint.append(latest)
+    return tuple(fingerprint)
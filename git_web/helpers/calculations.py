@@ -8,6 +8,7 @@ from git_interface.datatypes import TreeContent, TreeContentTypes
 from .checkers import (is_allowed_dir, is_valid_directory_name,
                        is_valid_repo_name)
 from .config import get_config
+from .constants import BLOB_LINES_WINDOW, MAX_BLOB_LINES_WINDOW
 from .types import PathComponent
 
 __all__ = [
@@ -16,6 +17,7 @@ __all__ = [
     "sort_repo_tree", "create_ssh_uri",
     "pathlib_delete_ro_file", "safe_combine_full_dir",
     "safe_combine_full_dir_repo", "path_to_tree_components",
+    "parse_line_range", "format_size",
 ]
 
 
@@ -167,3 +169,37 @@ def path_to_tree_components(path: Path) -> Generator[None, None, PathComponent]:
         is_end = True if max_i == i else False
         curr_path = curr_path / part
         yield PathComponent(curr_path, part, is_end)
+
+
+def parse_line_range(line_range: str) -> tuple[int, int]:
+    """
+    Parse a line range given as 'start-end' or 'start',
+    counting from 1 and including the end, limited to
+    MAX_BLOB_LINES_WINDOW lines
+
+        :param line_range: The line range e.g. '12000-12200'
+        :raises ValueError: Range is not valid
+        :return: The first line counting from 0 and the line to stop before
+    """
+    start, _, end = line_range.partition("-")
+    start = int(start)
+    end = int(end) if end else start + BLOB_LINES_WINDOW - 1
+    if start < 1 or end < start:
+        raise ValueError("'line_range' not valid")
+    return start - 1, min(end, start + MAX_BLOB_LINES_WINDOW - 1)
+
+
+def format_size(size: int) -> str:
+    """
+    Format a size in bytes for display e.g. '1.5 MB'
+
+        :param size: The size in bytes
+        :return: The formatted size
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = "TB"
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
@@ -0,0 +1,437 @@
+"""
+Long-lived 'git cat-file --batch' processes,
+kept per repository to avoid a process spawn for every object read
+"""
+import asyncio
+import time
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from git_interface.constants import DEFAULT_BUFFER_SIZE
+from git_interface.exceptions import (GitException,
+                                      PathDoesNotExistInRevException)
+
+from .config import get_config
+
+__all__ = [
+    "ObjectInfo", "CatFileProcess", "CatFilePool",
+    "get_cat_file_pool", "close_cat_file_pool",
+    "get_object_info", "get_commit_hash",
+    "read_object", "stream_object", "open_object",
+]
+
+# how long to wait for git to answer a request before giving up on the process
+RESPONSE_TIMEOUT = 30
+
+
+@dataclass
+class ObjectInfo:
+    """
+    A 'cat-file' object header
+    """
+    object_hash: str
+    type_: str
+    size: int
+
+
+class CatFileProcess:
+    """
+    A single 'git cat-file --batch' or '--batch-check' process,
+    can only handle one request at a time
+    """
+    def __init__(self, repo_path: Path, check_only: bool):
+        self.repo_path = repo_path
+        self.check_only = check_only
+        self.last_used = time.monotonic()
+        # False while a response has not been fully read
+        self.in_sync = True
+        self._process: Optional[asyncio.subprocess.Process] = None
+
+    async def start(self):
+        mode = "--batch-check" if self.check_only else "--batch"
+        self._process = await asyncio.create_subprocess_exec(
+            "git", "-C", str(self.repo_path), "cat-file", mode,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    @property
+    def is_healthy(self) -> bool:
+        """
+        Whether the process can accept a new request
+        """
+        return (
+            self._process is not None and
+            self._process.returncode is None and
+            self.in_sync
+        )
+
+    async def request(self, object_name: str) -> ObjectInfo:
+        """
+        Request an object, when not in check only mode
+        the content must then be read before the next request
+
+            :param object_name: The object e.g. '<tree_ish>:<path>'
+            :raises PathDoesNotExistInRevException: Object not found
+            :raises GitException: Process gave an unexpected response
+            :return: The object header
+        """
+        if "\n" in object_name:
+            raise PathDoesNotExistInRevException(f"'{object_name}' not found in repo")
+        self.in_sync = False
+        self._process.stdin.write(object_name.encode() + b"\n")
+        try:
+            await self._process.stdin.drain()
+            header = await asyncio.wait_for(
+                self._process.stdout.readline(),
+                RESPONSE_TIMEOUT,
+            )
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            raise GitException("cat-file process not responding") from err
+        # the object name is echoed back and may contain spaces
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            self.in_sync = True
+            raise PathDoesNotExistInRevException(f"'{object_name}' not found in repo")
+        parts = header.decode().rstrip("\n").split(" ")
+        if len(parts) != 3 or not parts[2].isdigit():
+            raise GitException(f"unexpected cat-file response: {header!r}")
+        if self.check_only:
+            self.in_sync = True
+        return ObjectInfo(parts[0], parts[1], int(parts[2]))
+
+    async def read_content(self, size: int) -> bytes:
+        """
+        Read the content of the last requested object
+
+            :param size: The object size
+            :return: The content
+        """
+        content = await self._process.stdout.readexactly(size + 1)
+        self.in_sync = True
+        return content[:-1]
+
+    async def read_content_head(self, size: int, head_size: int) -> bytes:
+        """
+        Read the start of the last requested object's content,
+        the rest must then be read with read_content or skip_content,
+        otherwise the process is left out of sync
+
+            :param size: The object size
+            :param head_size: The most bytes to read
+            :return: The content head
+        """
+        return await self._process.stdout.readexactly(min(size, head_size))
+
+    async def skip_content(self, size: int):
+        """
+        Read and discard the (rest of the) content of the last requested object
+
+            :param size: The number of bytes left to read
+        """
+        async for _ in self.iter_content(size):
+            pass
+
+    async def iter_content(self, size: int) -> AsyncGenerator[bytes, None]:
+        """
+        Read the content of the last requested object in chunks,
+        stopping early leaves the process out of sync
+
+            :param size: The object size
+            :yield: Each chunk
+        """
+        remaining = size
+        while remaining > 0:
+            chunk = await self._process.stdout.read(min(remaining, DEFAULT_BUFFER_SIZE))
+            if not chunk:
+                raise GitException("cat-file process closed unexpectedly")
+            remaining -= len(chunk)
+            yield chunk
+        await self._process.stdout.readexactly(1)
+        self.in_sync = True
+
+    def kill(self):
+        if self._process is not None:
+            # closing the transport kills the process and closes its pipes,
+            # otherwise waiting for it never returns while output is left unread
+            self._process._transport.close()
+
+    async def wait_closed(self):
+        if self._process is not None:
+            await self._process.wait()
+
+
+class CatFilePool:
+    """
+    Pool of 'cat-file' processes, kept per repository path.
+
+    Idle processes are stopped after idle_timeout seconds,
+    when max_processes is reached the oldest idle process is
+    replaced or the request waits up to acquire_timeout
+    seconds for one to be released
+    """
+    def __init__(self, max_processes: int, idle_timeout: float, acquire_timeout: float):
+        self.max_processes = max_processes
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.loop = asyncio.get_running_loop()
+        self._idle: dict[tuple[str, bool], list[CatFileProcess]] = {}
+        self._total = 0
+        self._condition = asyncio.Condition()
+        self._reaper: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    def _remove_idle(self, key: tuple[str, bool], process: CatFileProcess):
+        self._idle[key].remove(process)
+        if not self._idle[key]:
+            del self._idle[key]
+        process.kill()
+        self._total -= 1
+
+    def _reap_idle(self, older_than: float) -> list[CatFileProcess]:
+        reaped = []
+        for key, processes in list(self._idle.items()):
+            for process in list(processes):
+                if process.last_used < older_than or not process.is_healthy:
+                    self._remove_idle(key, process)
+                    reaped.append(process)
+        return reaped
+
+    def _evict_oldest_idle(self) -> Optional[CatFileProcess]:
+        oldest = None
+        for key, processes in self._idle.items():
+            for process in processes:
+                if oldest is None or process.last_used < oldest[1].last_used:
+                    oldest = (key, process)
+        if oldest is None:
+            return None
+        self._remove_idle(*oldest)
+        return oldest[1]
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            async with self._condition:
+                reaped = self._reap_idle(time.monotonic() - self.idle_timeout)
+                self._condition.notify_all()
+            for process in reaped:
+                await process.wait_closed()
+
+    def _take_idle(self, key: tuple[str, bool]) -> Optional[CatFileProcess]:
+        while idle := self._idle.get(key):
+            process = idle[-1]
+            if not process.is_healthy:
+                self._remove_idle(key, process)
+                continue
+            idle.pop()
+            if not idle:
+                del self._idle[key]
+            return process
+        return None
+
+    async def _reserve(
+            self,
+            key: tuple[str, bool]) -> tuple[Optional[CatFileProcess], Optional[CatFileProcess]]:
+        """
+        Take an idle process or reserve a slot for a new one,
+        evicting the oldest idle process when the pool is full
+
+            :param key: The repo path and check only mode
+            :raises GitException: Nothing was released within acquire_timeout
+            :return: The idle process (or None) and the evicted process (or None)
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        async with self._condition:
+            while True:
+                if (process := self._take_idle(key)) is not None:
+                    return process, None
+                if self._total < self.max_processes:
+                    self._total += 1
+                    return None, None
+                if (evicted := self._evict_oldest_idle()) is not None:
+                    self._total += 1
+                    return None, evicted
+                try:
+                    await asyncio.wait_for(self._condition.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    raise GitException("no cat-file process available") from None
+
+    async def _acquire(self, repo_path: Path, check_only: bool) -> CatFileProcess:
+        if self._reaper is None and not self._closed:
+            self._reaper = asyncio.create_task(self._reap_forever())
+        process, evicted = await self._reserve((str(repo_path), check_only))
+        if process is not None:
+            return process
+        if evicted is not None:
+            await evicted.wait_closed()
+        process = CatFileProcess(repo_path, check_only)
+        try:
+            await process.start()
+        except BaseException:
+            async with self._condition:
+                self._total -= 1
+                self._condition.notify()
+            raise
+        return process
+
+    async def _release(self, process: CatFileProcess):
+        async with self._condition:
+            keep = process.is_healthy and not self._closed
+            if keep:
+                process.last_used = time.monotonic()
+                key = (str(process.repo_path), process.check_only)
+                self._idle.setdefault(key, []).append(process)
+            else:
+                process.kill()
+                self._total -= 1
+            self._condition.notify()
+        if not keep:
+            await process.wait_closed()
+
+    @asynccontextmanager
+    async def process(self, repo_path: Path, check_only: bool = False):
+        """
+        Borrow a process from the pool, it will be
+        stopped on release if left out of sync
+
+            :param repo_path: The repo path
+            :param check_only: Whether to use '--batch-check', defaults to False
+        """
+        process = await self._acquire(repo_path, check_only)
+        try:
+            yield process
+        finally:
+            await self._release(process)
+
+    async def close(self):
+        """
+        Stop the idle processes, busy ones are stopped on release
+        """
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        async with self._condition:
+            reaped = self._reap_idle(float("inf"))
+        for process in reaped:
+            await process.wait_closed()
+
+
+# keyed by whether the pool is for streaming reads
+_pools: dict[bool, CatFilePool] = {}
+
+
+def get_cat_file_pool(streaming: bool = False) -> CatFilePool:
+    """
+    Get the pool for the running event loop, streaming reads
+    (which hold a process for a whole download) get their
+    own pool so they cannot starve page requests
+
+        :param streaming: Whether to get the streaming pool, defaults to False
+        :return: The pool
+    """
+    pool = _pools.get(streaming)
+    if pool is None or pool.loop is not asyncio.get_running_loop():
+        config = get_config()
+        pool = _pools[streaming] = CatFilePool(
+            config.CAT_FILE_MAX_STREAMS if streaming else config.CAT_FILE_MAX_PROCESSES,
+            config.CAT_FILE_IDLE_TIMEOUT,
+            config.CAT_FILE_ACQUIRE_TIMEOUT,
+        )
+    return pool
+
+
+async def close_cat_file_pool():
+    for streaming in tuple(_pools):
+        await _pools.pop(streaming).close()
+
+
+async def get_object_info(repo_path: Path, tree_ish: str, file_path: str) -> ObjectInfo:
+    """
+    Get an object's hash, type and size
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :param file_path: The file path
+        :raises PathDoesNotExistInRevException: Object not found
+        :return: The object info
+    """
+    async with get_cat_file_pool().process(repo_path, True) as process:
+        return await process.request(f"{tree_ish}:{file_path}")
+
+
+async def get_commit_hash(repo_path: Path, tree_ish: str) -> str:
+    """
+    Resolve a tree ish into its commit hash
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :raises PathDoesNotExistInRevException: No matching commit
+        :return: The commit hash
+    """
+    async with get_cat_file_pool().process(repo_path, True) as process:
+        return (await process.request(f"{tree_ish}^{{commit}}")).object_hash
+
+
+async def read_object(
+        repo_path: Path,
+        tree_ish: str,
+        file_path: str,
+        max_size: Optional[int] = None) -> tuple[ObjectInfo, Optional[bytes]]:
+    """
+    Read an object's info and content in one request
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :param file_path: The file path
+        :param max_size: Skip the content when the object
+                         is not smaller than this, defaults to None
+        :raises PathDoesNotExistInRevException: Object not found
+        :return: The object info and content (None if skipped)
+    """
+    async with get_cat_file_pool().process(repo_path) as process:
+        info = await process.request(f"{tree_ish}:{file_path}")
+        if max_size is not None and info.size >= max_size:
+            # left out of sync, so the process gets replaced
+            return info, None
+        return info, await process.read_content(info.size)
+
+
+async def stream_object(repo_path: Path, info: ObjectInfo) -> AsyncGenerator[bytes, None]:
+    """
+    Read an object's content in chunks,
+    a process is only borrowed once reading starts
+
+        :param repo_path: The repo path
+        :param info: The object info
+        :yield: Each chunk
+    """
+    async with get_cat_file_pool(True).process(repo_path) as process:
+        info = await process.request(info.object_hash)
+        async for chunk in process.iter_content(info.size):
+            yield chunk
+
+
+async def open_object(
+        repo_path: Path,
+        tree_ish: str,
+        file_path: str) -> tuple[ObjectInfo, AsyncGenerator[bytes, None]]:
+    """
+    Get an object's info and a buffered reader for its content,
+    a process is only borrowed once reading starts
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :param file_path: The file path
+        :raises PathDoesNotExistInRevException: Object not found
+        :return: The object info and content reader
+    """
+    info = await get_object_info(repo_path, tree_ish, file_path)
+    return info, stream_object(repo_path, info)
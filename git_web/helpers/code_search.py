@@ -0,0 +1,537 @@
+"""
+Code search over the files on each repository's default branch, using
+a trigram index so only files that may match are read and searched.
+
+An update adds a segment indexing only the blobs no earlier segment has,
+once there are too many segments or they mostly index blobs no longer
+on the branch the index is built again as a single segment
+"""
+import asyncio
+import json
+import logging
+import re
+import shutil
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any, Optional
+
+from git_interface.exceptions import GitException
+from git_interface.helpers import subprocess_run
+from git_interface.symbolic_ref import get_symbolic_ref
+from werkzeug.exceptions import HTTPException
+
+from .admission import admitted
+from .background import start_background_task
+from .caching import LRUCache, get_cache_path, register_repo_listener
+from .cat_file_pool import get_cat_file_pool, get_commit_hash
+from .config import get_config
+from .content_preview import decode_text
+from .trigrams import (TrigramSegment, TrigramSegmentBuilder,
+                       find_content_trigrams, iter_trigrams)
+
+__all__ = [
+    "CodeIndex", "CodeMatch", "CodeSearchResults",
+    "get_code_index_directory", "find_required_literals",
+    "list_indexed_files", "update_code_index", "load_code_index", "search_code",
+    "CodeIndexer", "get_code_indexer",
+]
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+SEGMENT_SUFFIX = ".trigrams"
+FILES_SUFFIX = ".files"
+# segments an index may have before it is built again
+MAX_SEGMENTS = 8
+# bytes of blobs read before finding their trigrams in a thread
+INDEX_BATCH_SIZE = 2**22
+# files of loaded indexes kept in memory
+LOADED_FILES_LIMIT = 2*10**6
+# git treats content with a null byte in this many bytes as binary
+BINARY_CHECK_SIZE = 8000
+# matching lines shown for each file, and the characters shown of each
+MAX_FILE_LINES = 5
+MAX_LINE_LENGTH = 300
+# how a regular expression's brackets change the group depth
+GROUP_DEPTH_CHANGE = {"(": 1, ")": -1}
+
+
+@dataclass
+class CodeIndex:
+    """
+    A loaded index of the files at a commit
+    """
+    commit_hash: str
+    # blob hash by path
+    files: dict[str, str]
+    segments: list[TrigramSegment]
+
+
+@dataclass
+class CodeMatch:
+    """
+    A file's matching lines
+    """
+    path: str
+    # line number counting from 1, and line
+    lines: list[tuple[int, str]]
+
+
+@dataclass
+class CodeSearchResults:
+    """
+    The files matching a search, in path order
+    """
+    commit_hash: str
+    matches: list[CodeMatch]
+    # whether there may be more matching files
+    truncated: bool
+
+
+def get_code_index_directory(repo_path: Path) -> Path:
+    """
+    Get where a repository's index is stored
+
+        :param repo_path: The repo path
+        :return: The directory
+    """
+    return get_cache_path("code-search") / repo_path.parent.name / repo_path.name
+
+
+def _break_literal(literals: list[str], current: list[str]):
+    if current:
+        literals.append("".join(current))
+        current.clear()
+
+
+def _skip_to(pattern: str, position: int, end_char: str) -> int:
+    # the position after the closing character, stepping over escapes
+    while position < len(pattern) and pattern[position] != end_char:
+        position += 2 if pattern[position] == "\\" else 1
+    return position + 1
+
+
+def _add_escaped(literals: list[str], current: list[str], escaped: str):
+    if escaped and not escaped.isalnum():
+        current.append(escaped)
+    else:
+        # a character class, anchor or back reference
+        _break_literal(literals, current)
+
+
+def find_required_literals(pattern: str) -> list[str]:
+    """
+    Find strings every match of a regular expression contains,
+    only looking outside of groups, so it may find fewer than there are
+
+        :param pattern: The regular expression
+        :return: The strings, empty when none are certain
+    """
+    if re.compile(pattern).flags & re.VERBOSE:
+        return []
+    literals = []
+    current = []
+    depth = 0
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        position += 1
+        if char == "\\":
+            escaped = pattern[position:position + 1]
+            position += 1
+            _add_escaped(literals, current, escaped if depth == 0 else "")
+        elif char in "*?{":
+            # the character before may be absent or repeated
+            if char == "{":
+                position = _skip_to(pattern, position, "}")
+            del current[-1:]
+            _break_literal(literals, current)
+        elif char == "|" and depth == 0:
+            # either side may match
+            return []
+        elif char in "[()+.^$|":
+            if char == "[":
+                # a ']' straight after the opening is part of the set
+                position = _skip_to(pattern, position + 1, "]")
+            depth += GROUP_DEPTH_CHANGE.get(char, 0)
+            _break_literal(literals, current)
+        elif depth == 0:
+            current.append(char)
+    _break_literal(literals, current)
+    return literals
+
+
+async def list_indexed_files(repo_path: Path, commit_hash: str) -> dict[str, str]:
+    """
+    List the files at a commit that are indexed, skipping
+    symlinks, submodules and those over CODE_SEARCH_MAX_FILE_SIZE
+
+        :param repo_path: The repo path
+        :param commit_hash: The commit hash
+        :raises GitException: When git fails
+        :return: The blob hash by path
+    """
+    result = await subprocess_run([
+        "git", "-C", str(repo_path), "ls-tree", "-r", "-z", "-l", "--full-tree", commit_hash,
+    ])
+    if result.returncode != 0:
+        raise GitException(result.stderr.decode())
+    max_size = get_config().CODE_SEARCH_MAX_FILE_SIZE
+    files = {}
+    for entry in result.stdout.split(b"\0"):
+        if not entry:
+            continue
+        meta, _, path = entry.partition(b"\t")
+        mode, type_, object_hash, size = meta.split()
+        if type_ == b"blob" and mode != b"120000" and int(size) <= max_size:
+            files[path.decode(errors="surrogateescape")] = object_hash.decode()
+    return files
+
+
+def _read_manifest(directory: Path) -> Optional[dict[str, Any]]:
+    try:
+        return json.loads((directory / MANIFEST_NAME).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomically(path: Path, content: bytes):
+    # readers only ever see whole files
+    temp_path = path.with_name(f"{uuid.uuid4().hex}.tmp")
+    try:
+        temp_path.write_bytes(content)
+        temp_path.rename(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _write_files(directory: Path, files: dict[str, str]) -> str:
+    name = uuid.uuid4().hex + FILES_SUFFIX
+    _write_atomically(directory / name, b"".join(
+        f"{object_hash} {path}\0".encode(errors="surrogateescape")
+        for path, object_hash in sorted(files.items())
+    ))
+    return name
+
+
+def _read_files(path: Path) -> dict[str, str]:
+    files = {}
+    for entry in path.read_bytes().split(b"\0")[:-1]:
+        object_hash, _, file_path = entry.decode(errors="surrogateescape").partition(" ")
+        files[file_path] = object_hash
+    return files
+
+
+def _read_indexed_hashes(directory: Path, segment_names: list[str]) -> set[str]:
+    return {
+        key.hex()
+        for name in segment_names
+        for key in TrigramSegment(directory / name).iter_keys()
+    }
+
+
+def _add_blobs(builder: TrigramSegmentBuilder, blobs: list[tuple[bytes, bytes]]):
+    for key, content in blobs:
+        # binary blobs are kept so they are not read again, matching nothing
+        is_binary = b"\0" in content[:BINARY_CHECK_SIZE]
+        builder.add(key, () if is_binary else find_content_trigrams(content))
+
+
+def _write_segment(builder: TrigramSegmentBuilder, directory: Path) -> str:
+    name = uuid.uuid4().hex + SEGMENT_SUFFIX
+    temp_path = directory / f"{uuid.uuid4().hex}.tmp"
+    try:
+        builder.write(temp_path)
+        temp_path.rename(directory / name)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return name
+
+
+async def _index_blobs(repo_path: Path, directory: Path, object_hashes: set[str]) -> str:
+    builder = TrigramSegmentBuilder()
+    batch = []
+    batch_size = 0
+    # a streaming process, as it is held for the whole update
+    async with get_cat_file_pool(True).process(repo_path) as process:
+        for object_hash in sorted(object_hashes):
+            info = await process.request(object_hash)
+            batch.append((bytes.fromhex(object_hash), await process.read_content(info.size)))
+            batch_size += info.size
+            if batch_size >= INDEX_BATCH_SIZE:
+                await asyncio.to_thread(_add_blobs, builder, batch)
+                batch = []
+                batch_size = 0
+    await asyncio.to_thread(_add_blobs, builder, batch)
+    return await asyncio.to_thread(_write_segment, builder, directory)
+
+
+def _remove_unused(directory: Path, manifest: dict[str, Any]):
+    # searches that already loaded them keep reading the unlinked files
+    used = {MANIFEST_NAME, manifest["files"], *manifest["segments"]}
+    for path in directory.iterdir():
+        if path.name not in used:
+            path.unlink(missing_ok=True)
+
+
+async def update_code_index(repo_path: Path) -> bool:
+    """
+    Index the files on a repository's default branch, unless
+    already indexed at its latest commit, reading only
+    the blobs not indexed for an earlier commit
+
+        :param repo_path: The repo path
+        :raises GitException: When git fails
+        :raises ServiceUnavailable: When not admitted to run git in time
+        :return: Whether the index changed
+    """
+    directory = get_code_index_directory(repo_path)
+    if not repo_path.exists():
+        # deleted, renamed or moved
+        await asyncio.to_thread(shutil.rmtree, directory, True)
+        return False
+    try:
+        branch = await get_symbolic_ref(repo_path, "HEAD")
+        commit_hash = await get_commit_hash(repo_path, branch)
+    except GitException:
+        # no commits yet
+        return False
+    manifest = await asyncio.to_thread(_read_manifest, directory)
+    if manifest is not None and manifest["commit"] == commit_hash:
+        return False
+    segment_names = [] if manifest is None else manifest["segments"]
+    async with admitted("maintenance"):
+        files = await list_indexed_files(repo_path, commit_hash)
+        hashes = set(files.values())
+        try:
+            indexed = await asyncio.to_thread(_read_indexed_hashes, directory, segment_names)
+        except (FileNotFoundError, ValueError):
+            # removed or not whole, so built again
+            segment_names = []
+            indexed = set()
+        if len(segment_names) >= MAX_SEGMENTS or len(indexed - hashes) > len(hashes):
+            segment_names = []
+            indexed = set()
+        directory.mkdir(parents=True, exist_ok=True)
+        if new_hashes := hashes - indexed:
+            segment_names = [
+                *segment_names, await _index_blobs(repo_path, directory, new_hashes)]
+    manifest = {
+        "commit": commit_hash,
+        "files": await asyncio.to_thread(_write_files, directory, files),
+        "segments": segment_names,
+    }
+    await asyncio.to_thread(
+        _write_atomically, directory / MANIFEST_NAME, json.dumps(manifest).encode())
+    await asyncio.to_thread(_remove_unused, directory, manifest)
+    return True
+
+
+@cache
+def _get_loaded_indexes() -> LRUCache:
+    # by directory and file names, which are unique to each update
+    return LRUCache(
+        LOADED_FILES_LIMIT,
+        lambda index: len(index.files) + 1,
+        lambda key: key[0],
+    )
+
+
+def load_code_index(repo_path: Path) -> Optional[CodeIndex]:
+    """
+    Load a repository's latest index, reading files so is best run in a thread
+
+        :param repo_path: The repo path
+        :return: The index or None when not indexed yet
+    """
+    directory = get_code_index_directory(repo_path)
+    loaded = _get_loaded_indexes()
+    # a second try, in case an update removed the files while they were read
+    for _ in range(2):
+        if (manifest := _read_manifest(directory)) is None:
+            return None
+        key = (str(directory), manifest["files"], *manifest["segments"])
+        if (index := loaded.get(key)) is not None:
+            return index
+        try:
+            index = CodeIndex(
+                manifest["commit"],
+                _read_files(directory / manifest["files"]),
+                [TrigramSegment(directory / name) for name in manifest["segments"]],
+            )
+        except FileNotFoundError:
+            continue
+        loaded.pop_group(key[0])
+        loaded.set(key, index)
+        return index
+    return None
+
+
+def _find_candidates(
+        index: CodeIndex,
+        trigrams: set[bytes],
+        path_pattern: Optional[re.Pattern]) -> list[str]:
+    object_hashes = set()
+    for segment in index.segments:
+        object_hashes.update(segment.get_key(number).hex() for number in segment.find(trigrams))
+    # a blob can be at many paths, or indexed but no longer at any
+    return sorted(
+        path for path, object_hash in index.files.items()
+        if object_hash in object_hashes
+        and (path_pattern is None or path_pattern.search(path))
+    )
+
+
+def _match_lines(pattern: re.Pattern, content: bytes) -> list[tuple[int, str]]:
+    if b"\0" in content[:BINARY_CHECK_SIZE]:
+        return []
+    text = decode_text(content)
+    lines = []
+    line_number = 1
+    line_start = 0
+    for match in pattern.finditer(text):
+        if match.start() < line_start:
+            # on a line already shown
+            continue
+        line_number += text.count("\n", line_start, match.start())
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        line_end = text.find("\n", match.start())
+        line_end = len(text) if line_end == -1 else line_end
+        lines.append((line_number, text[line_start:line_end][:MAX_LINE_LENGTH]))
+        if len(lines) == MAX_FILE_LINES:
+            break
+        line_number += 1
+        line_start = line_end + 1
+    return lines
+
+
+async def search_code(
+        repo_path: Path,
+        query: str,
+        is_regex: bool = False,
+        path_query: Optional[str] = None,
+        limit: Optional[int] = None) -> Optional[CodeSearchResults]:
+    """
+    Search the files of a repository's latest index, case-insensitively
+
+        :param repo_path: The repo path
+        :param query: The text to find, or a regular expression
+        :param is_regex: Whether the query is a regular expression, defaults to False
+        :param path_query: A regular expression paths must contain, defaults to None
+        :param limit: The max matching files, defaults to None
+        :raises re.error: When a regular expression is not valid
+        :return: The results or None when not indexed yet
+    """
+    flags = re.IGNORECASE | re.MULTILINE
+    pattern = re.compile(query if is_regex else re.escape(query), flags)
+    path_pattern = re.compile(path_query, re.IGNORECASE) if path_query else None
+    if (index := await asyncio.to_thread(load_code_index, repo_path)) is None:
+        return None
+    literals = find_required_literals(query) if is_regex else [query]
+    # only ASCII is lowercased in the index
+    trigrams = {
+        trigram
+        for literal in literals
+        for trigram in iter_trigrams(literal.lower().encode())
+        if trigram.isascii()
+    }
+    paths = await asyncio.to_thread(_find_candidates, index, trigrams, path_pattern)
+    matches = []
+    async with get_cat_file_pool().process(repo_path) as process:
+        for path in paths:
+            if len(matches) == limit:
+                return CodeSearchResults(index.commit_hash, matches, True)
+            info = await process.request(index.files[path])
+            content = await process.read_content(info.size)
+            if lines := await asyncio.to_thread(_match_lines, pattern, content):
+                matches.append(CodeMatch(path, lines))
+    return CodeSearchResults(index.commit_hash, matches, False)
+
+
+class CodeIndexer:
+    """
+    A queue of repositories whose index to update,
+    filled by invalidate_repo once started
+    """
+    def __init__(self, workers: int):
+        """
+            :param workers: The max repositories indexed at once
+        """
+        self.workers = workers
+        self._queued: set[Path] = set()
+        self._queue: asyncio.Queue[Path] = asyncio.Queue()
+        # so a repository is only indexed by one worker at a time
+        self._locks: defaultdict[Path, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+
+    @property
+    def is_enabled(self) -> bool:
+        """
+        Whether indexes are updated, set by CODE_SEARCH_WORKERS
+        """
+        return self.workers > 0
+
+    def enqueue(self, repo_path: Path):
+        """
+        Queue a repository's index to be updated, unless already queued
+
+            :param repo_path: The repo path
+        """
+        if repo_path not in self._queued:
+            self._queued.add(repo_path)
+            self._queue.put_nowait(repo_path)
+
+    async def _work(self):
+        while True:
+            repo_path = await self._queue.get()
+            self._queued.discard(repo_path)
+            self._running += 1
+            try:
+                async with self._locks[repo_path]:
+                    if await update_code_index(repo_path):
+                        logger.info("indexed '%s' for code search", repo_path)
+                self._completed += 1
+            except (GitException, HTTPException, OSError) as err:
+                # tried again after the next change or search
+                logger.warning("indexing '%s' failed: %s", repo_path, err)
+                self._failed += 1
+            finally:
+                self._running -= 1
+
+    def start(self):
+        """
+        Start the workers, stopped with the other background tasks
+        """
+        if not self.is_enabled:
+            return
+        register_repo_listener(self.enqueue)
+        for _ in range(self.workers):
+            start_background_task(self._work)
+
+    def get_stats(self) -> dict[str, int]:
+        """
+        Get the queue depth and counts of indexed repositories
+
+            :return: The queued, running, completed and failed counts
+        """
+        return {
+            "queued": len(self._queued),
+            "running": self._running,
+            "completed": self._completed,
+            "failed": self._failed,
+        }
+
+
+@cache
+def get_code_indexer() -> CodeIndexer:
+    """
+    Get the indexer, configured by CODE_SEARCH_WORKERS
+
+        :return: The indexer
+    """
+    return CodeIndexer(get_config().CODE_SEARCH_WORKERS)
@@ -0,0 +1,125 @@
+"""
+Commit counts kept per commit, so counting a commit only walks
+the commits that differ from one counted before.
+
+The count of a commit is the count of an earlier counted commit,
+minus the commits only it reaches, plus the commits only the new
+one reaches; both found by one 'git rev-list --left-right', which
+stops at the commits they share and is quick with the commit-graph
+written by maintenance
+"""
+import asyncio
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from git_interface.exceptions import (GitException,
+                                      PathDoesNotExistInRevException,
+                                      UnknownRevisionException)
+from git_interface.helpers import subprocess_run
+
+from .caching import LRUCache
+from .cat_file_pool import get_commit_hash
+from .commit_log import get_commit_log_cache
+
+__all__ = [
+    "get_commit_count_cache", "get_cached_commit_count", "get_commit_count",
+]
+
+# commits whose count is kept
+COMMIT_COUNT_CACHE_COUNT = 2**14
+# the commit each tree ish was last counted at, to count from when it moves
+COUNTED_TIPS_CACHE_COUNT = 2**12
+
+
+@cache
+def get_commit_count_cache() -> LRUCache:
+    """
+    Get the commit count cache, keyed by repository and commit hash
+
+        :return: The cache
+    """
+    return LRUCache(COMMIT_COUNT_CACHE_COUNT)
+
+
+@cache
+def _get_counted_tips() -> LRUCache:
+    return LRUCache(COUNTED_TIPS_CACHE_COUNT)
+
+
+def get_cached_commit_count(repo_path: Path, commit_hash: str) -> Optional[int]:
+    """
+    Get the count of a commit when it is known without git,
+    from the count cache or a commit log read to the end
+
+        :param repo_path: The repo path
+        :param commit_hash: The full commit hash
+        :return: The count, or None when not known
+    """
+    key = (str(repo_path), commit_hash)
+    if (count := get_commit_count_cache().get(key)) is not None:
+        return count
+    if (commit_log := get_commit_log_cache().get(key)) is not None:
+        return commit_log.total
+    return None
+
+
+async def _rev_list_count(repo_path: Path, *args: str) -> list[int]:
+    result = await subprocess_run(["git", "-C", str(repo_path), "rev-list", "--count", *args])
+    if result.returncode != 0:
+        raise GitException(result.stderr.decode(errors="replace"))
+    return [int(count) for count in result.stdout.split()]
+
+
+async def _count_commits(repo_path: Path, tree_ish: str, commit_hash: str) -> int:
+    counted_tips = _get_counted_tips()
+    # the commit this tree ish was last counted at, else any counted in the repository
+    for base_hash in (
+            counted_tips.get((str(repo_path), tree_ish)),
+            counted_tips.get((str(repo_path), None))):
+        if base_hash is None:
+            continue
+        if (base_count := get_cached_commit_count(repo_path, base_hash)) is not None:
+            only_base, only_new = await _rev_list_count(
+                repo_path, "--left-right", f"{base_hash}...{commit_hash}")
+            return base_count - only_base + only_new
+    count, = await _rev_list_count(repo_path, commit_hash)
+    return count
+
+
+# counts being made, so concurrent requests share one
+_pending_counts: dict[tuple[str, str], asyncio.Future] = {}
+
+
+async def _get_count(repo_path: Path, tree_ish: str, commit_hash: str) -> int:
+    key = (str(repo_path), commit_hash)
+    if (count := get_cached_commit_count(repo_path, commit_hash)) is not None:
+        return count
+    if (pending := _pending_counts.get(key)) is None:
+        pending = asyncio.ensure_future(_count_commits(repo_path, tree_ish, commit_hash))
+        _pending_counts[key] = pending
+        pending.add_done_callback(lambda _: _pending_counts.pop(key, None))
+    count = await asyncio.shield(pending)
+    get_commit_count_cache().set(key, count)
+    return count
+
+
+async def get_commit_count(repo_path: Path, tree_ish: str) -> int:
+    """
+    Get the number of commits reachable from a tree ish, counting
+    only the commits that differ from one counted before
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :raises UnknownRevisionException: Unknown tree_ish
+        :raises GitException: Error to do with git
+        :return: The commit count
+    """
+    try:
+        commit_hash = await get_commit_hash(repo_path, tree_ish)
+    except PathDoesNotExistInRevException as err:
+        raise UnknownRevisionException(str(err)) from err
+    count = await _get_count(repo_path, tree_ish, commit_hash)
+    _get_counted_tips().set((str(repo_path), tree_ish), commit_hash)
+    _get_counted_tips().set((str(repo_path), None), commit_hash)
+    return count
@@ -0,0 +1,393 @@
+"""
+Commit logs read once per repository and tip commit, so any page,
+forward or backward, is found by commit hash in memory.
+
+A log's commit hashes are read by one 'git rev-list' in the background
+and a page only waits for the hashes it shows. When a branch moves
+forward its new log lists the commits since the old tip before the
+old tip's log, sharing the hashes already read
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from git_interface.datatypes import Log
+from git_interface.exceptions import GitException
+from git_interface.helpers import subprocess_run
+
+from .background import start_background_task
+from .caching import LRUCache
+from .cat_file_pool import get_cat_file_pool
+from .config import get_config
+
+__all__ = [
+    "CommitLog", "CommitLogPage",
+    "get_commit_log_cache", "get_commit_cache",
+    "parse_commit", "get_commit_log", "read_log_page",
+]
+
+logger = logging.getLogger(__name__)
+
+# bytes of 'git rev-list' output read at once
+REV_LIST_READ_SIZE = 2**16
+# parsed commits kept for log pages
+COMMIT_CACHE_COUNT = 2**14
+# the branch or tag each log was last read for, to extend when it moves
+LOG_TIPS_CACHE_COUNT = 2**12
+
+
+class _RevList:
+    """
+    The binary commit hashes listed by 'git rev-list',
+    read in the background while pages are served
+    """
+    def __init__(self, repo_path: Path, args: list[str]):
+        self.repo_path = repo_path
+        self.args = args
+        self.hashes = bytearray()
+        self.is_complete = False
+        self.error: Optional[GitException] = None
+        # replaced after every read, so waiting readers are woken
+        self._read = asyncio.Event()
+
+    async def read(self):
+        process = await asyncio.create_subprocess_exec(
+            "git", "-C", str(self.repo_path), "rev-list", *self.args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr = asyncio.ensure_future(process.stderr.read())
+        pending = b""
+        try:
+            while (chunk := await process.stdout.read(REV_LIST_READ_SIZE)) != b"":
+                pending += chunk
+                end = pending.rfind(b"\n") + 1
+                # fromhex skips the newlines between hashes
+                self.hashes += bytes.fromhex(pending[:end].decode())
+                pending = pending[end:]
+                self._wake()
+            if await process.wait() != 0:
+                self.error = GitException((await stderr).decode(errors="replace"))
+        finally:
+            stderr.cancel()
+            if process.returncode is None:
+                # stopped early, so the hashes read are not every commit
+                self.error = GitException("reading commits was stopped")
+                process.kill()
+                await process.wait()
+            self.is_complete = True
+            self._wake()
+
+    def _wake(self):
+        self._read.set()
+        self._read = asyncio.Event()
+
+    async def wait_for_more(self):
+        """
+        Wait until more hashes are read or all of them have been
+
+            :raises GitException: When git failed
+        """
+        if not self.is_complete:
+            await self._read.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def _find_hash(hashes: bytes, commit: bytes, start: int = 0) -> Optional[int]:
+    # the byte offset of a hash, only matching on hash boundaries
+    offset = hashes.find(commit, start)
+    while offset != -1 and offset % len(commit):
+        offset = hashes.find(commit, offset + 1)
+    return None if offset == -1 else offset
+
+
+class CommitLog:
+    """
+    The commits reachable from a tip, newest first as listed
+    by 'git rev-list', or the commits since an earlier tip
+    followed by the earlier tip's log
+    """
+    def __init__(self, tip: str, rev_list: _RevList, newer: bytes = b""):
+        self.tip = tip
+        self.width = len(tip) // 2
+        # commits since the tip of the log this one extends
+        self.newer = newer
+        self.rev_list = rev_list
+
+    @property
+    def size(self) -> int:
+        """
+        The bytes of hashes read so far
+        """
+        return len(self.newer) + len(self.rev_list.hashes)
+
+    @property
+    def total(self) -> Optional[int]:
+        """
+        The number of commits, once they have all been read
+        """
+        if not self.rev_list.is_complete:
+            return None
+        return self.size // self.width
+
+    async def get_hashes(self, start: int, stop: Optional[int]) -> list[str]:
+        """
+        Get the hashes of a range of commits,
+        waiting until they have been read
+
+            :param start: The first position, counting from 0
+            :param stop: The position to stop before, or None for every commit
+            :raises GitException: When git failed
+            :return: The hashes, fewer when the log ends first
+        """
+        end = None if stop is None else stop * self.width
+        while not self.rev_list.is_complete and (end is None or self.size < end):
+            await self.rev_list.wait_for_more()
+        if self.rev_list.error is not None:
+            raise self.rev_list.error
+        hashes = (self.newer + self.rev_list.hashes)[start * self.width:end]
+        return [
+            hashes[offset:offset + self.width].hex()
+            for offset in range(0, len(hashes), self.width)
+        ]
+
+    async def find(self, commit_hash: str) -> Optional[int]:
+        """
+        Find the position of a commit, waiting
+        until it or every commit has been read
+
+            :param commit_hash: The full commit hash
+            :raises GitException: When git failed
+            :return: The position, or None when not in the log
+        """
+        commit = bytes.fromhex(commit_hash)
+        if (offset := _find_hash(self.newer, commit)) is not None:
+            return offset // self.width
+        searched = 0
+        while True:
+            hashes = self.rev_list.hashes
+            if (offset := _find_hash(hashes, commit, searched)) is not None:
+                return (len(self.newer) + offset) // self.width
+            if self.rev_list.is_complete:
+                if self.rev_list.error is not None:
+                    raise self.rev_list.error
+                return None
+            searched = len(hashes) - len(hashes) % self.width
+            await self.rev_list.wait_for_more()
+
+
+@dataclass
+class CommitLogPage:
+    """
+    A page of a commit log, with the commits to page from
+    """
+    logs: list[Log]
+    start: int
+    total: Optional[int]
+    previous_hash: Optional[str]
+    next_hash: Optional[str]
+
+
+@cache
+def get_commit_log_cache() -> LRUCache:
+    """
+    Get the commit log cache, keyed by repository and tip commit
+    and limited by COMMIT_LOG_CACHE_SIZE in bytes of hashes
+
+        :return: The cache
+    """
+    return LRUCache(get_config().COMMIT_LOG_CACHE_SIZE, lambda log: log.size)
+
+
+@cache
+def get_commit_cache() -> LRUCache:
+    """
+    Get the parsed commit cache, keyed by commit hash
+
+        :return: The cache
+    """
+    return LRUCache(COMMIT_CACHE_COUNT)
+
+
+@cache
+def _get_log_tips() -> LRUCache:
+    return LRUCache(LOG_TIPS_CACHE_COUNT)
+
+
+def _parse_identity(value: bytes) -> tuple[str, str, datetime]:
+    # 'name <email> timestamp offset'
+    identity, timestamp, offset = value.rsplit(b" ", 2)
+    name, _, email = identity.partition(b" <")
+    sign = -1 if offset.startswith(b"-") else 1
+    hours, minutes = int(offset[1:3]), int(offset[3:5])
+    tz = timezone(sign * timedelta(hours=hours, minutes=minutes))
+    return (
+        name.decode(errors="replace"),
+        email.removesuffix(b">").decode(errors="replace"),
+        datetime.fromtimestamp(int(timestamp), tz),
+    )
+
+
+def parse_commit(commit_hash: str, content: bytes) -> Log:
+    """
+    Parse a commit object into a log, as 'git log' would show it
+
+        :param commit_hash: The commit hash
+        :param content: The commit object's content
+        :return: The log
+    """
+    headers, _, message = content.partition(b"\n\n")
+    parents = []
+    author_name = author_email = ""
+    commit_date = None
+    for line in headers.split(b"\n"):
+        key, _, value = line.partition(b" ")
+        # continued headers (e.g. signatures) start with a space, so have no key
+        if key == b"parent":
+            parents.append(value.decode())
+        elif key == b"author":
+            author_name, author_email, _ = _parse_identity(value)
+        elif key == b"committer":
+            commit_date = _parse_identity(value)[2]
+    # the subject is the first paragraph on one line
+    subject = b" ".join(message.split(b"\n\n", 1)[0].strip().split(b"\n"))
+    return Log(
+        commit_hash,
+        " ".join(parents),
+        author_email,
+        author_name,
+        commit_date,
+        subject.decode(errors="replace"),
+    )
+
+
+async def _read_logs(repo_path: Path, commit_hashes: list[str]) -> list[Log]:
+    cache = get_commit_cache()
+    logs = {commit_hash: cache.get(commit_hash) for commit_hash in commit_hashes}
+    missing = [commit_hash for commit_hash, log in logs.items() if log is None]
+    if missing:
+        async with get_cat_file_pool().process(repo_path) as process:
+            for commit_hash in missing:
+                info = await process.request(commit_hash)
+                log = parse_commit(commit_hash, await process.read_content(info.size))
+                cache.set(commit_hash, log)
+                logs[commit_hash] = log
+    return [logs[commit_hash] for commit_hash in commit_hashes]
+
+
+async def _read_in_background(key: tuple[str, str], commit_log: CommitLog):
+    try:
+        await commit_log.rev_list.read()
+    finally:
+        cache = get_commit_log_cache()
+        if cache.get(key) is commit_log:
+            if commit_log.rev_list.error is not None:
+                logger.error("reading commits of '%s' failed", key[0])
+                cache.pop(key)
+            else:
+                # stored again, now its size is known
+                cache.set(key, commit_log)
+
+
+async def _is_ancestor(repo_path: Path, ancestor: str, commit_hash: str) -> bool:
+    result = await subprocess_run([
+        "git", "-C", str(repo_path), "merge-base", "--is-ancestor", ancestor, commit_hash,
+    ])
+    return result.returncode == 0
+
+
+async def _make_commit_log(repo_path: Path, tree_ish: str, commit_hash: str) -> CommitLog:
+    cache = get_commit_log_cache()
+    key = (str(repo_path), commit_hash)
+    previous_tip = _get_log_tips().get((str(repo_path), tree_ish))
+    previous = cache.get((str(repo_path), previous_tip))
+    if (
+            previous is not None and previous.rev_list.error is None
+            and await _is_ancestor(repo_path, previous.tip, commit_hash)):
+        result = await subprocess_run([
+            "git", "-C", str(repo_path), "rev-list", commit_hash, f"^{previous.tip}",
+        ])
+        if result.returncode != 0:
+            raise GitException(result.stderr.decode(errors="replace"))
+        newer = bytes.fromhex(result.stdout.decode())
+        commit_log = CommitLog(commit_hash, previous.rev_list, newer + previous.newer)
+        cache.set(key, commit_log)
+    else:
+        commit_log = CommitLog(commit_hash, _RevList(repo_path, [commit_hash]))
+        cache.set(key, commit_log)
+        start_background_task(lambda: _read_in_background(key, commit_log))
+    return commit_log
+
+
+# logs being made, so concurrent requests share one
+_pending_logs: dict[tuple[str, str], asyncio.Future] = {}
+
+
+async def get_commit_log(repo_path: Path, tree_ish: str, commit_hash: str) -> CommitLog:
+    """
+    Get the log of a commit, reading it in the background, or extending
+    the log last read for the same tree ish when it has moved forward
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish, e.g. a branch
+        :param commit_hash: The full commit hash it resolves to
+        :raises GitException: When git fails
+        :return: The log
+    """
+    key = (str(repo_path), commit_hash)
+    commit_log = get_commit_log_cache().get(key)
+    if commit_log is None or commit_log.rev_list.error is not None:
+        if (pending := _pending_logs.get(key)) is None:
+            pending = asyncio.ensure_future(_make_commit_log(repo_path, tree_ish, commit_hash))
+            _pending_logs[key] = pending
+            pending.add_done_callback(lambda _: _pending_logs.pop(key, None))
+        commit_log = await asyncio.shield(pending)
+    _get_log_tips().set((str(repo_path), tree_ish), commit_hash)
+    return commit_log
+
+
+async def read_log_page(
+        repo_path: Path,
+        commit_log: CommitLog,
+        count: Optional[int],
+        after: Optional[str] = None,
+        before: Optional[str] = None) -> Optional[CommitLogPage]:
+    """
+    Read a page of a commit log, starting after a
+    commit or ending before one, or the first page
+
+        :param repo_path: The repo path
+        :param commit_log: The log
+        :param count: The commits per page, or None for every commit
+        :param after: The full hash of the commit before the page, defaults to None
+        :param before: The full hash of the commit after the page, defaults to None
+        :raises GitException: When git fails
+        :return: The page, or None when the commit paged from is not in the log
+    """
+    start, stop = 0, count
+    if after is not None:
+        if (position := await commit_log.find(after)) is None:
+            return None
+        start = position + 1
+        stop = None if count is None else start + count
+    elif before is not None:
+        if (position := await commit_log.find(before)) is None:
+            return None
+        if count is not None and position > count:
+            start, stop = position - count, position
+    commit_hashes = await commit_log.get_hashes(start, stop)
+    logs = await _read_logs(repo_path, commit_hashes)
+    end = start + len(commit_hashes)
+    has_next = bool(commit_hashes) and bool(await commit_log.get_hashes(end, end + 1))
+    return CommitLogPage(
+        logs,
+        start,
+        commit_log.total,
+        commit_hashes[0] if start > 0 and commit_hashes else None,
+        commit_hashes[-1] if has_next else None,
+    )
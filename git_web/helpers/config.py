@@ -23,6 +23,42 @@ class Config(BaseSettings):
     SSH_PUB_KEY_PATH: Optional[Path] = None
     SSH_AUTH_KEYS_PATH: Optional[Path] = None
     HTTP_GIT_ENABLED: Optional[bool] = True
+    CAT_FILE_MAX_PROCESSES: int = 16
+    CAT_FILE_IDLE_TIMEOUT: float = 60
+    CAT_FILE_MAX_STREAMS: int = 8
+    CAT_FILE_ACQUIRE_TIMEOUT: float = 10
+    PAGE_CACHE_SIZE: int = 32*10**6
+    README_CACHE_SIZE: int = 8*10**6
+    HIGHLIGHT_CACHE_SIZE: int = 64*10**6
+    HIGHLIGHT_DISK_CACHE_SIZE: int = 512*10**6
+    CACHE_PATH: Optional[Path] = None
+    RENDER_WORKERS: Optional[int] = None
+    RENDER_TIMEOUT: float = 5
+    LINE_INDEX_CACHE_SIZE: int = 16*10**6
+    BLOB_DISK_CACHE_SIZE: int = 10**9
+    ARCHIVE_CACHE_SIZE: int = 2*10**9
+    ARCHIVE_ZSTD_COMMAND: Optional[str] = "zstd -c -T0"
+    ADMISSION_MAX_TOTAL: int = 24
+    ADMISSION_INTERACTIVE_LIMIT: int = 16
+    ADMISSION_PUSH_LIMIT: int = 4
+    ADMISSION_FETCH_LIMIT: int = 8
+    ADMISSION_ARCHIVE_LIMIT: int = 2
+    ADMISSION_MAINTENANCE_LIMIT: int = 1
+    ADMISSION_QUEUE_TIMEOUT: float = 10
+    ADVERTISEMENT_CACHE_SIZE: int = 64*10**6
+    PACK_CACHE_SIZE: int = 4*10**9
+    HTTP_GIT_MAX_BODY_SIZE: int = 4*10**9
+    BUNDLE_INTERVAL: float = 6*60*60
+    MAINTENANCE_WORKERS: int = 1
+    MAINTENANCE_PUSH_THRESHOLD: int = 8
+    MAINTENANCE_LOOSE_OBJECT_LIMIT: int = 1024
+    MAINTENANCE_LOOSE_REF_LIMIT: int = 64
+    MAINTENANCE_SWEEP_INTERVAL: float = 24*60*60
+    REPO_INDEX_INTERVAL: float = 5*60
+    CODE_SEARCH_WORKERS: int = 1
+    CODE_SEARCH_MAX_FILE_SIZE: int = 10**6
+    FILE_FINDER_CACHE_SIZE: int = 128*10**6
+    COMMIT_LOG_CACHE_SIZE: int = 64*10**6
 
     class Config:
         case_sensitive = True
@@ -1,5 +1,8 @@
 __all__ = [
     "RESERVED_NAMES", "MAX_BLOB_SIZE",
+    "BLOB_LINES_WINDOW", "MAX_BLOB_LINES_WINDOW",
+    "SEARCH_RESULTS_LIMIT", "SEARCH_SUGGESTIONS_LIMIT", "CODE_SEARCH_RESULTS_LIMIT",
+    "FILE_FINDER_RESULTS_LIMIT",
 ]
 
 RESERVED_NAMES = (
@@ -10,6 +13,18 @@ RESERVED_NAMES = (
     "new-dir",
     "import",
     "settings",
+    "search",
+    "stats",
 )
 
 MAX_BLOB_SIZE = 2*10**6
+# lines shown at once for blobs too large to show whole
+BLOB_LINES_WINDOW = 200
+MAX_BLOB_LINES_WINDOW = 5000
+# repositories shown for a search, and suggested while typing one
+SEARCH_RESULTS_LIMIT = 100
+SEARCH_SUGGESTIONS_LIMIT = 10
+# files shown for a code search
+CODE_SEARCH_RESULTS_LIMIT = 50
+# files shown by the file finder
+FILE_FINDER_RESULTS_LIMIT = 50
@@ -1,49 +1,181 @@
+import fnmatch
 import mimetypes
+import re
+from functools import cache, lru_cache
+from pathlib import PurePosixPath
+from typing import Optional
 from urllib.parse import urlparse
 
 from markdown_it import MarkdownIt
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+from pygments.lexer import Lexer
+from pygments.lexers import (LEXERS, get_lexer_by_name,
+                             get_lexer_for_filename)
 from pygments.util import ClassNotFound
 
 
-def markdown_it_highlighter(content, langName, langAttrs):
+# shared as formatting does not change the formatter
+HTML_FORMATTER = HtmlFormatter(nowrap=True)
+
+# content prefixes that identify a file type
+MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"\x00\x00\x01\x00", "image/vnd.microsoft.icon"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"\x7fELF", "application/x-executable"),
+)
+# bytes read from the start of a blob to sniff its type
+CONTENT_SNIFF_SIZE = 4096
+# control bytes that are rare in text
+_BINARY_CONTROL_BYTES = bytes(set(range(32)) - set(b"\t\n\r\f\b\x1b")) + b"\x7f"
+
+# matches file names that pygments would not match by extension alone
+_lexer_name_patterns = None
+
+
+@lru_cache(maxsize=1024)
+def get_lexer_by_lang(lang_name: str) -> Lexer:
     """
-    Code highlighter for markdown-it using pygments
+    Get a lexer by its name or alias, the lexer is
+    shared between calls as it holds no highlighting state
+
+        :param lang_name: The language name e.g. 'python'
+        :return: The lexer, falling back to plain text
     """
-    if not langName:
-        langName = "text"
     try:
-        lexer = get_lexer_by_name(langName)
+        return get_lexer_by_name(lang_name)
     except ClassNotFound:
-        lexer = get_lexer_by_name("text")
-    finally:
-        return highlight(content, lexer, HtmlFormatter(nowrap=True))
+        return get_lexer_by_name("text")
+
+
+@lru_cache(maxsize=4096)
+def _get_lexer_for_filename(file_name: str) -> Lexer:
+    try:
+        return get_lexer_for_filename(file_name)
+    except ClassNotFound:
+        return get_lexer_by_name("text")
+
+
+def _matches_lexer_name_pattern(file_name: str) -> bool:
+    global _lexer_name_patterns
+    if _lexer_name_patterns is None:
+        patterns = []
+        for _, _, _, file_patterns, _ in LEXERS.values():
+            patterns.extend(
+                fnmatch.translate(pattern) for pattern in file_patterns
+                if not re.fullmatch(r"\*\.[^*?\[\].]+", pattern)
+            )
+        _lexer_name_patterns = re.compile("|".join(patterns))
+    return _lexer_name_patterns.match(file_name) is not None
+
+
+def markdown_it_highlighter(content, langName, langAttrs):
+    """
+    Code highlighter for markdown-it using pygments
+    """
+    return highlight(content, get_lexer_by_lang(langName or "text"), HTML_FORMATTER)
 
 
 def markdown_it_render_readme_link(self, tokens, idx, options, env):
     """
     Markdown-it render rule for a readme
-    link to convert relative links to absolute
+    link to convert relative links to absolute,
+    using the 'url_relative_to_blob' env value
     """
     token = tokens[idx]
-    if not urlparse(token.attrs["href"]).netloc:
-        tokens[idx].attrSet("href", options["url_relative_to_blob"] + token.attrs["href"])
+    url_relative_to_blob = env.get("url_relative_to_blob")
+    if url_relative_to_blob and not urlparse(token.attrs["href"]).netloc:
+        tokens[idx].attrSet("href", url_relative_to_blob + token.attrs["href"])
     return self.renderToken(tokens, idx, options, env)
 
 
 def markdown_it_render_readme_image(self, tokens, idx, options, env):
     """
     Markdown-it render rule for a readme
-    image to convert relative links to absolute
+    image to convert relative links to absolute,
+    using the 'url_relative_to_raw' env value
     """
     token = tokens[idx]
+    url_relative_to_raw = env.get("url_relative_to_raw")
+    if not url_relative_to_raw:
+        return self.image(tokens, idx, options, env)
     if not urlparse(token.attrs["src"]).netloc:
-        tokens[idx].attrSet("src", options["url_relative_to_raw"] + token.attrs["src"])
+        tokens[idx].attrSet("src", url_relative_to_raw + token.attrs["src"])
     return self.renderToken(tokens, idx, options, env)
 
 
+@cache
+def get_markdown_parser() -> MarkdownIt:
+    """
+    Get the markdown-it parser, built once as adding
+    the plugins and render rules is costly. Per render
+    options are given through the render env
+
+        :return: The parser
+    """
+    md = MarkdownIt(
+        "gfm-like",
+        {
+            "html": False,
+            "highlight": markdown_it_highlighter,
+        }
+    )
+    md.add_render_rule("link_open", markdown_it_render_readme_link)
+    md.add_render_rule("image", markdown_it_render_readme_image)
+    return md
+
+
+def get_lexer_for_path(file_path: str) -> Lexer:
+    """
+    Get the lexer to highlight a file with,
+    looked up by extension unless the file name
+    could match a more specific lexer
+
+        :param file_path: The file path or extention
+        :return: The lexer, falling back to plain text
+    """
+    file_name = PurePosixPath(file_path).name
+    extension = PurePosixPath(file_name).suffix
+    if extension and not _matches_lexer_name_pattern(file_name):
+        file_name = "file" + extension
+    return _get_lexer_for_filename(file_name)
+
+
+def highlight_by_lexer(content: str, lexer: Lexer) -> str:
+    """
+    Highlight some text with a lexer
+
+        :param content: The file content
+        :param lexer: The lexer
+        :return: Rendered HTML
+    """
+    return highlight(content, lexer, HTML_FORMATTER)
+
+
+@lru_cache(maxsize=1024)
+def _get_line_lexer(lexer_type: type[Lexer]) -> Lexer:
+    return lexer_type(stripnl=False, ensurenl=True)
+
+
+def highlight_lines(content: str, file_path: str) -> list[str]:
+    """
+    Highlight some lines of a file, keeping leading and
+    trailing blank lines so each input line has an output line
+
+        :param content: The lines joined by newlines
+        :param file_path: The file path or extention
+        :return: Rendered HTML for each line
+    """
+    lexer = _get_line_lexer(type(get_lexer_for_path(file_path)))
+    return highlight(content, lexer, HTML_FORMATTER).split("\n")[:-1]
+
+
 def highlight_by_ext(content: str, ext: str) -> str:
     """
     Highlight some text based on an extention
@@ -52,12 +184,7 @@ def highlight_by_ext(content: str, ext: str) -> str:
         :param ext: The file extention
         :return: Rendered HTML
     """
-    try:
-        lexer = get_lexer_for_filename(ext)
-    except ClassNotFound:
-        lexer = get_lexer_by_name("text")
-    finally:
-        return highlight(content, lexer, HtmlFormatter(nowrap=True))
+    return highlight_by_lexer(content, get_lexer_for_path(ext))
 
 
 def render_markdown(
@@ -74,30 +201,68 @@ def render_markdown(
                                     relative paths, defaults to None
         :return: Rendered HTML
     """
-    md = MarkdownIt(
-        "gfm-like",
+    return get_markdown_parser().render(
+        content,
         {
-            "html": False,
-            "highlight": markdown_it_highlighter,
             "url_relative_to_blob": url_relative_to_blob,
             "url_relative_to_raw": url_relative_to_raw,
         }
     )
-    if url_relative_to_blob:
-        md.add_render_rule("link_open", markdown_it_render_readme_link)
-    if url_relative_to_raw:
-        md.add_render_rule("image", markdown_it_render_readme_image)
-    return md.render(content)
 
 
-def guess_mimetype(file_path: str) -> str | None:
+def sniff_content_type(head: bytes, truncated: bool = True) -> str:
+    """
+    Classify content from its first bytes using magic numbers,
+    NUL bytes and UTF-8 validity, content that is not UTF-8
+    is still text (e.g. Latin-1) when it has few control bytes
+
+        :param head: The first bytes of the content
+        :param truncated: Whether there is more content after head,
+                          so a cut off UTF-8 sequence is allowed, defaults to True
+        :return: The matched mimetype, 'text/plain' or 'application/octet-stream'
+    """
+    for magic, mimetype in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mimetype
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if b"\0" in head:
+        return "application/octet-stream"
+    try:
+        head.decode("utf-8")
+        return "text/plain"
+    except UnicodeDecodeError as err:
+        # a multi-byte character may have been cut off by the read
+        if truncated and err.start >= len(head) - 3 and err.end == len(head):
+            return "text/plain"
+    control_bytes = len(head) - len(head.translate(None, _BINARY_CONTROL_BYTES))
+    if control_bytes * 100 > len(head):
+        return "application/octet-stream"
+    return "text/plain"
+
+
+def decode_text(content: bytes) -> str:
+    """
+    Decode text content as UTF-8, falling back to Latin-1
+
+        :param content: The content
+        :return: The text
+    """
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        return content.decode("latin-1")
+
+
+def guess_mimetype(file_path: str, content_type: Optional[str] = None) -> str | None:
     """
     Guess a mimetype
 
         :param file_path: The filepath to use for a guess
+        :param content_type: The result of sniff_content_type
+                             for the file content, defaults to None
         :return: The guessed mimetype
     """
-    # TODO add content guessing for fallback
     guess_path = None
     if file_path.startswith("."):
         guess_path = "file" + file_path
@@ -105,4 +270,10 @@ def guess_mimetype(file_path: str) -> str | None:
         guess_path = file_path
     else:
         guess_path = "file." + file_path
-    return mimetypes.guess_type(guess_path)[0]
+    guessed = mimetypes.guess_type(guess_path)[0]
+    if content_type is None or content_type == "text/plain":
+        return guessed or content_type
+    # binary content, the extension is only trusted when not text
+    if guessed is None or guessed.startswith("text"):
+        return content_type
+    return guessed
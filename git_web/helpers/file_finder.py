@@ -0,0 +1,313 @@
+"""
+Every file path of a commit kept as one sorted buffer, and
+fuzzy matching against it for the "go to file" finder.
+
+A query matches a path containing its characters in order, matches
+are ranked by whether the query is found whole in the file name or
+path before those only matching fuzzily, then by path length
+"""
+import asyncio
+import re
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from functools import cache
+from itertools import accumulate
+from pathlib import Path
+from typing import Optional
+
+from git_interface.exceptions import GitException
+from git_interface.helpers import subprocess_run
+
+from .caching import LRUCache
+from .config import get_config
+
+__all__ = [
+    "PathList", "get_path_list_cache", "get_path_list", "find_paths",
+]
+
+# new matching lines each pass collects, passes stop once there are enough to rank
+CANDIDATE_LIMIT = 1000
+# queries of each path list whose every match is kept, narrowing longer queries
+NARROWED_QUERIES = 16
+# lines sharing a bit in the masks of which lines contain each byte
+BLOCK_LINES = 8
+# the share of blocks a query may need scanned before the whole list is scanned instead
+MAX_BLOCK_SHARE = 1/2
+
+
+@dataclass
+class PathList:
+    """
+    The file paths of a commit, newline-joined and sorted, with the
+    offset of each path, a lowercase copy to match against and the
+    lowercase file names line for line with their own offsets.
+
+    The lowercase paths are split into blocks of BLOCK_LINES lines,
+    each byte has a mask of the blocks containing it so a query
+    only scans the blocks containing all of its bytes
+    """
+    commit_hash: str
+    paths: bytes
+    offsets: array
+    folded: bytes
+    names: bytes
+    name_offsets: array
+    byte_blocks: dict[int, int]
+    # lines matching a query, when all of them were found
+    matches: dict[bytes, array] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def size(self) -> int:
+        """
+        The bytes held by the buffers and offsets
+        """
+        size = len(self.paths) + len(self.names)
+        if self.folded is not self.paths:
+            size += len(self.folded)
+        size += (len(self.offsets) + len(self.name_offsets)) * self.offsets.itemsize
+        return size + len(self.byte_blocks) * -(-len(self) // BLOCK_LINES // 8)
+
+    def get_path(self, number: int) -> str:
+        """
+        Get a path by its line number
+
+            :param number: The line number, counting from 0
+            :return: The path
+        """
+        path = self.paths[self.offsets[number]:self.offsets[number + 1] - 1]
+        return path.decode(errors="replace")
+
+
+def _make_byte_blocks(folded: bytes, offsets: array) -> dict[int, int]:
+    count = len(offsets) - 1
+    block_count = -(-count // BLOCK_LINES)
+    flags: defaultdict[int, bytearray] = defaultdict(lambda: bytearray(block_count))
+    for block, first in enumerate(range(0, count, BLOCK_LINES)):
+        last = min(first + BLOCK_LINES, count)
+        for byte in set(folded[offsets[first]:offsets[last]]):
+            flags[byte][block] = 1
+    # the last digit is the lowest bit, so block n is bit n
+    digits = bytes.maketrans(b"\0\1", b"01")
+    return {byte: int(flag[::-1].translate(digits), 2) for byte, flag in flags.items()}
+
+
+def _make_path_list(commit_hash: str, output: bytes) -> PathList:
+    # a path containing a newline could not be told apart from two paths
+    paths = sorted(path for path in output.split(b"\0") if path and b"\n" not in path)
+    names = [path.rpartition(b"/")[2] for path in paths]
+    buffer = b"".join(path + b"\n" for path in paths)
+    offsets = array("I", accumulate((len(path) + 1 for path in paths), initial=0))
+    folded = buffer.lower()
+    if folded == buffer:
+        # share the buffer when no path has uppercase characters
+        folded = buffer
+    return PathList(
+        commit_hash,
+        buffer,
+        offsets,
+        folded,
+        b"".join(name + b"\n" for name in names).lower(),
+        array("I", accumulate((len(name) + 1 for name in names), initial=0)),
+        _make_byte_blocks(folded, offsets),
+    )
+
+
+@cache
+def get_path_list_cache() -> LRUCache:
+    """
+    Get the path list cache, keyed by repository and commit
+    and limited by FILE_FINDER_CACHE_SIZE in bytes
+
+        :return: The cache
+    """
+    return LRUCache(get_config().FILE_FINDER_CACHE_SIZE, lambda path_list: path_list.size)
+
+
+async def _load_path_list(repo_path: Path, commit_hash: str) -> PathList:
+    result = await subprocess_run([
+        "git", "-C", str(repo_path), "ls-tree", "-r", "-z", "--name-only", "--full-tree",
+        commit_hash,
+    ])
+    if result.returncode != 0:
+        raise GitException(result.stderr.decode())
+    path_list = await asyncio.to_thread(_make_path_list, commit_hash, result.stdout)
+    get_path_list_cache().set((str(repo_path), commit_hash), path_list)
+    return path_list
+
+
+# path lists being loaded, so concurrent requests share one listing
+_pending_path_lists: dict[tuple[str, str], asyncio.Future] = {}
+
+
+async def get_path_list(repo_path: Path, commit_hash: str) -> PathList:
+    """
+    Get every file path of a commit, listing the
+    commit's tree when it has not been cached
+
+        :param repo_path: The repo path
+        :param commit_hash: The full commit hash
+        :raises GitException: When git fails
+        :return: The path list
+    """
+    key = (str(repo_path), commit_hash)
+    if (path_list := get_path_list_cache().get(key)) is not None:
+        return path_list
+    if (pending := _pending_path_lists.get(key)) is None:
+        pending = asyncio.ensure_future(_load_path_list(repo_path, commit_hash))
+        _pending_path_lists[key] = pending
+        pending.add_done_callback(lambda _: _pending_path_lists.pop(key, None))
+    return await asyncio.shield(pending)
+
+
+def _make_fuzzy_pattern(query: str) -> re.Pattern:
+    # starting with the first character, so the search can skip to it
+    parts = [re.escape(query[0].encode().lower())]
+    for char in query[1:]:
+        encoded = char.encode().lower()
+        if len(encoded) == 1:
+            # without backtracking, each character is the next one on the line
+            parts.append(b"[^\n" + re.escape(encoded) + b"]*" + re.escape(encoded))
+        else:
+            parts.append(b"[^\n]*?" + re.escape(encoded))
+    return re.compile(b"".join(parts))
+
+
+def _make_passes(path_list: PathList, query: str) -> list[tuple[bytes, array, re.Pattern]]:
+    # the buffer, its offsets and pattern of each pass, best matches first
+    literal = re.compile(re.escape(query.encode().lower()))
+    fuzzy = _make_fuzzy_pattern(query)
+    return [
+        (path_list.names, path_list.name_offsets, literal),
+        (path_list.folded, path_list.offsets, literal),
+        (path_list.names, path_list.name_offsets, fuzzy),
+        (path_list.folded, path_list.offsets, fuzzy),
+    ]
+
+
+def _find_line_ranges(path_list: PathList, query: str) -> list[tuple[int, int]]:
+    # runs of lines in blocks containing every byte of the query
+    count = len(path_list)
+    block_count = -(-count // BLOCK_LINES)
+    blocks = (1 << block_count) - 1
+    for byte in set(query.encode().lower()):
+        blocks &= path_list.byte_blocks.get(byte, 0)
+    if blocks.bit_count() > block_count * MAX_BLOCK_SHARE:
+        return [(0, count)]
+    return [
+        (match.start() * BLOCK_LINES, min(match.end() * BLOCK_LINES, count))
+        for match in re.finditer("1+", bin(blocks)[:1:-1])
+    ]
+
+
+def _scan_lines(
+        buffer: bytes,
+        offsets: array,
+        pattern: re.Pattern,
+        ranges: list[tuple[int, int]],
+        found: dict[int, int],
+        limit: int) -> tuple[list[int], bool]:
+    # new lines matching the pattern, and whether every line was scanned
+    lines = []
+    for first, stop in ranges:
+        position = offsets[first]
+        end = offsets[stop]
+        while (match := pattern.search(buffer, position, end)) is not None:
+            number = bisect_right(offsets, match.start()) - 1
+            position = offsets[number + 1]
+            if number not in found:
+                lines.append(number)
+                if len(lines) >= limit:
+                    return lines, False
+    return lines, True
+
+
+def _find_matches(
+        path_list: PathList,
+        query: str,
+        limit: int,
+        candidates: Optional[array]) -> tuple[dict[int, int], bool]:
+    # the pass each matching line was found by, and whether every match was found
+    passes = _make_passes(path_list, query)
+    found: dict[int, int] = {}
+    if candidates is not None:
+        # narrowed to the matches of a shorter query
+        for number in candidates:
+            for kind, (buffer, offsets, pattern) in enumerate(passes):
+                if pattern.search(buffer, offsets[number], offsets[number + 1]):
+                    found[number] = kind
+                    break
+        return found, True
+    ranges = _find_line_ranges(path_list, query)
+    last = len(passes) - 1
+    for kind, (buffer, offsets, pattern) in enumerate(passes):
+        # paths only matching across directories are the slowest to find
+        # and the worst matches, so only as many as are returned are found
+        wanted = CANDIDATE_LIMIT if kind < last else limit - len(found)
+        lines, is_complete = _scan_lines(buffer, offsets, pattern, ranges, found, wanted)
+        found.update((number, kind) for number in lines)
+        if len(found) >= limit or not is_complete:
+            # the last pass matches every path the others do
+            return found, kind == last and is_complete
+    return found, True
+
+
+def _rank_matches(path_list: PathList, query: str, found: dict[int, int], limit: int) -> list[int]:
+    prefix = query.encode().lower()
+
+    def get_rank(number: int) -> tuple[int, bool, int, int]:
+        kind = found[number]
+        is_name_prefix = kind == 0 and path_list.names.startswith(
+            prefix, path_list.name_offsets[number])
+        length = path_list.offsets[number + 1] - path_list.offsets[number]
+        return kind, not is_name_prefix, length, number
+
+    return sorted(found, key=get_rank)[:limit]
+
+
+def _find_ranked(
+        path_list: PathList,
+        query: str,
+        limit: int,
+        candidates: Optional[array]) -> tuple[list[int], Optional[array]]:
+    # the best matching lines, and every matching line when all were found
+    found, is_complete = _find_matches(path_list, query, limit, candidates)
+    return _rank_matches(path_list, query, found, limit), array("I", found) if is_complete else None
+
+
+def _get_narrowed(path_list: PathList, query: str) -> Optional[array]:
+    # every match of a query is also a match of its prefixes
+    for end in range(len(query) - 1, 0, -1):
+        if (candidates := path_list.matches.get(query[:end].encode().lower())) is not None:
+            return candidates
+    return None
+
+
+async def find_paths(path_list: PathList, query: str, limit: int) -> list[str]:
+    """
+    Find paths fuzzily matching a query, ranked by how well they match.
+
+    Matching stops once enough paths to rank are found, when a query's
+    every match was found they are kept so a longer query typed
+    after it only checks those
+
+        :param path_list: The path list
+        :param query: The query, whitespace is ignored
+        :param limit: The max paths returned
+        :return: The paths, best match first
+    """
+    query = "".join(query.split())
+    if not query:
+        return []
+    candidates = _get_narrowed(path_list, query)
+    numbers, matches = await asyncio.to_thread(
+        _find_ranked, path_list, query, limit, candidates)
+    if matches is not None:
+        if len(path_list.matches) >= NARROWED_QUERIES:
+            del path_list.matches[next(iter(path_list.matches))]
+        path_list.matches[query.encode().lower()] = matches
+    return [path_list.get_path(number) for number in numbers]
@@ -0,0 +1,232 @@
+"""
+Line offset indexes and disk copies of large blobs, so a window
+of lines or a byte range can be read without reading the whole blob
+"""
+import asyncio
+from array import array
+from collections.abc import AsyncGenerator
+from dataclasses import dataclass
+from functools import cache
+from itertools import accumulate
+from pathlib import Path
+from typing import BinaryIO
+
+from git_interface.exceptions import GitException
+
+from .caching import DiskCache, LRUCache, get_cache_path
+from .cat_file_pool import ObjectInfo, stream_object
+from .config import get_config
+
+__all__ = [
+    "LINE_INDEX_STEP", "LineIndex",
+    "get_line_index_cache", "get_blob_disk_cache",
+    "get_line_index", "open_blob_copy", "read_lines", "iter_blob_range",
+]
+
+# lines between each stored offset
+LINE_INDEX_STEP = 128
+# bytes to buffer before writing a blob copy to disk
+DISK_WRITE_SIZE = 2**20
+# bytes read from a blob copy at once when streaming a range
+DISK_READ_SIZE = 2**16
+
+
+@dataclass
+class LineIndex:
+    """
+    The byte offset of every LINE_INDEX_STEP'th line of a blob
+    """
+    object_hash: str
+    size: int
+    line_count: int
+    offsets: array
+
+    def byte_range(self, start: int, stop: int) -> tuple[int, int, int]:
+        """
+        Get the byte range covering some lines
+
+            :param start: The first line, counting from 0
+            :param stop: The line to stop before
+            :return: The start and end offsets and
+                     the line number found at the start offset
+        """
+        first = min(start // LINE_INDEX_STEP, len(self.offsets) - 1)
+        last = -(-stop // LINE_INDEX_STEP)
+        end = self.offsets[last] if last < len(self.offsets) else self.size
+        return self.offsets[first], end, first * LINE_INDEX_STEP
+
+
+class _LineIndexBuilder:
+    def __init__(self):
+        self.offsets = array("Q", [0])
+        self.newlines = 0
+        self.position = 0
+        self.ends_with_newline = False
+
+    def feed(self, chunk: bytes):
+        lines = chunk.split(b"\n")[:-1]
+        # position after each newline, relative to the chunk
+        line_ends = list(accumulate(len(line) + 1 for line in lines))
+        first = -(self.newlines + 1) % LINE_INDEX_STEP
+        self.offsets.extend(self.position + end for end in line_ends[first::LINE_INDEX_STEP])
+        self.newlines += len(lines)
+        self.position += len(chunk)
+        self.ends_with_newline = chunk.endswith(b"\n")
+
+    def finish(self, object_hash: str) -> LineIndex:
+        line_count = self.newlines
+        if self.position and not self.ends_with_newline:
+            line_count += 1
+        return LineIndex(object_hash, self.position, line_count, self.offsets)
+
+
+@cache
+def get_line_index_cache() -> LRUCache:
+    """
+    Get the line index cache, keyed by blob hash
+    and limited by LINE_INDEX_CACHE_SIZE in bytes of offsets
+
+        :return: The cache
+    """
+    return LRUCache(
+        get_config().LINE_INDEX_CACHE_SIZE,
+        lambda index: len(index.offsets) * index.offsets.itemsize,
+    )
+
+
+@cache
+def get_blob_disk_cache() -> DiskCache:
+    """
+    Get the cache of indexed blobs copied to disk,
+    limited by BLOB_DISK_CACHE_SIZE
+
+        :return: The cache
+    """
+    return DiskCache(get_cache_path("blobs"), get_config().BLOB_DISK_CACHE_SIZE)
+
+
+async def _build_line_index(repo_path: Path, info: ObjectInfo) -> LineIndex:
+    builder = _LineIndexBuilder()
+    disk = get_blob_disk_cache()
+    temp_path = None
+    if info.object_hash not in disk:
+        temp_path = disk.temp_path()
+    pending = bytearray()
+    file = None
+    try:
+        if temp_path is not None:
+            file = await asyncio.to_thread(open, temp_path, "wb")
+        async for chunk in stream_object(repo_path, info):
+            builder.feed(chunk)
+            if file is not None:
+                pending += chunk
+                if len(pending) >= DISK_WRITE_SIZE:
+                    await asyncio.to_thread(file.write, bytes(pending))
+                    pending.clear()
+        if file is not None:
+            await asyncio.to_thread(file.write, bytes(pending))
+            await asyncio.to_thread(file.close)
+            file = None
+            disk.add(info.object_hash, temp_path)
+    finally:
+        if file is not None:
+            file.close()
+            temp_path.unlink(missing_ok=True)
+    index = builder.finish(info.object_hash)
+    get_line_index_cache().set(info.object_hash, index)
+    return index
+
+
+# indexes being built, so concurrent requests share one read
+_pending_indexes: dict[str, asyncio.Future] = {}
+
+
+async def get_line_index(repo_path: Path, info: ObjectInfo) -> LineIndex:
+    """
+    Get the line index of a blob, building it by streaming the blob
+    once and copying it to the blob disk cache, the index is
+    rebuilt when the copy has been evicted
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :return: The index
+    """
+    index = get_line_index_cache().get(info.object_hash)
+    if index is not None and info.object_hash in get_blob_disk_cache():
+        return index
+    if (pending := _pending_indexes.get(info.object_hash)) is None:
+        pending = asyncio.ensure_future(_build_line_index(repo_path, info))
+        _pending_indexes[info.object_hash] = pending
+        pending.add_done_callback(lambda _: _pending_indexes.pop(info.object_hash, None))
+    return await asyncio.shield(pending)
+
+
+async def open_blob_copy(repo_path: Path, info: ObjectInfo) -> BinaryIO:
+    """
+    Open the disk copy of a blob, copying the blob
+    (and indexing it) first when there is no copy
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :raises GitException: The blob copy was evicted while copying it again
+        :return: The open copy, stays readable if evicted while open
+    """
+    for _ in range(2):
+        if (file := await get_blob_disk_cache().open(info.object_hash)) is not None:
+            return file
+        await get_line_index(repo_path, info)
+    raise GitException("blob copy evicted while reading")
+
+
+def _read_file_range(file: BinaryIO, start: int, end: int) -> bytes:
+    file.seek(start)
+    return file.read(end - start)
+
+
+async def read_lines(repo_path: Path, index: LineIndex, start: int, stop: int) -> list[str]:
+    """
+    Read a window of lines from an indexed blob by seeking in its
+    disk copy, copying the blob again when it has been evicted
+
+        :param repo_path: The repo path
+        :param index: The blob's line index
+        :param start: The first line, counting from 0
+        :param stop: The line to stop before
+        :raises GitException: The blob copy was evicted while copying it again
+        :return: The lines, without line endings
+    """
+    begin, end, first_line = index.byte_range(start, stop)
+    info = ObjectInfo(index.object_hash, "blob", index.size)
+    with await open_blob_copy(repo_path, info) as file:
+        content = await asyncio.to_thread(_read_file_range, file, begin, end)
+    lines = content.decode(errors="replace").split("\n")
+    if content.endswith(b"\n"):
+        lines.pop()
+    return lines[start - first_line:stop - first_line]
+
+
+async def iter_blob_range(
+        repo_path: Path,
+        info: ObjectInfo,
+        start: int,
+        stop: int) -> AsyncGenerator[bytes, None]:
+    """
+    Read a byte range of a blob in chunks by seeking in its
+    disk copy, copying the blob first when there is no copy
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :param start: The first byte
+        :param stop: The byte to stop before
+        :raises GitException: The blob copy was evicted while copying it again
+        :yield: Each chunk
+    """
+    with await open_blob_copy(repo_path, info) as file:
+        await asyncio.to_thread(file.seek, start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = await asyncio.to_thread(file.read, min(remaining, DISK_READ_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
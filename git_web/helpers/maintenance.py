@@ -0,0 +1,259 @@
+"""
+Background maintenance of repositories, queued once a repository
+has been pushed to enough times and by a sweep over every repository,
+running only the tasks its object and ref counts call for
+"""
+import asyncio
+import logging
+import os
+from collections import Counter
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from git_interface.exceptions import GitException
+from git_interface.helpers import subprocess_run
+from werkzeug.exceptions import HTTPException
+
+from .admission import admitted
+from .background import start_background_task
+from .calculations import find_dirs, find_repos
+from .config import get_config
+
+__all__ = [
+    "MAINTENANCE_TASKS", "count_loose_objects", "count_loose_refs",
+    "is_task_needed", "run_maintenance_task", "maintain_repo",
+    "MaintenanceScheduler", "get_maintenance_scheduler", "sweep_repos",
+]
+
+logger = logging.getLogger(__name__)
+
+# in the order they run, a repack makes a newer commit-graph needed
+MAINTENANCE_TASKS = {
+    "pack-refs": ["pack-refs", "--all"],
+    # packs loose objects and rolls up small packs, keeping pack sizes
+    # a geometric progression, then writes a multi-pack-index with
+    # a reachability bitmap so packs don't need combining into one
+    "repack": ["repack", "-d", "-q", "--geometric=2", "--write-midx", "--write-bitmap-index"],
+    "commit-graph": ["commit-graph", "write", "--reachable", "--split", "--changed-paths"],
+}
+# loose objects are counted in one of the 256 directories, as 'git gc --auto' does
+LOOSE_OBJECT_SAMPLE = "17"
+COMMIT_GRAPH_PATHS = ("objects/info/commit-graph", "objects/info/commit-graphs/commit-graph-chain")
+
+
+def count_loose_objects(repo_path: Path) -> int:
+    """
+    Estimate the number of loose objects in a repository
+
+        :param repo_path: The repo path
+        :return: The estimated count
+    """
+    try:
+        sampled = len(os.listdir(repo_path / "objects" / LOOSE_OBJECT_SAMPLE))
+    except FileNotFoundError:
+        return 0
+    return sampled * 256
+
+
+def count_loose_refs(repo_path: Path) -> int:
+    """
+    Count the refs of a repository not in its packed-refs
+
+        :param repo_path: The repo path
+        :return: The count
+    """
+    return sum(len(file_names) for _, _, file_names in os.walk(repo_path / "refs"))
+
+
+def _get_modified(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _is_repack_needed(repo_path: Path) -> bool:
+    if count_loose_objects(repo_path) >= get_config().MAINTENANCE_LOOSE_OBJECT_LIMIT:
+        return True
+    pack_path = repo_path / "objects" / "pack"
+    midx_modified = _get_modified(pack_path / "multi-pack-index")
+    for path in pack_path.glob("*.pack"):
+        modified = _get_modified(path)
+        if midx_modified is None or (modified is not None and modified > midx_modified):
+            # not in the multi-pack-index, so without a bitmap
+            return True
+    return False
+
+
+def _is_commit_graph_needed(repo_path: Path) -> bool:
+    graph_modified = [_get_modified(repo_path / path) for path in COMMIT_GRAPH_PATHS]
+    if all(modified is None for modified in graph_modified):
+        return True
+    graph_modified = max(modified for modified in graph_modified if modified is not None)
+    # a push updates refs, and adds a pack unless its objects were unpacked
+    changed = [
+        _get_modified(path)
+        for path in (repo_path / "objects" / "pack").glob("*.pack")
+    ]
+    changed.append(_get_modified(repo_path / "packed-refs"))
+    changed.extend(
+        _get_modified(Path(dir_path))
+        for dir_path, _, _ in os.walk(repo_path / "refs")
+    )
+    return any(modified is not None and modified > graph_modified for modified in changed)
+
+
+def is_task_needed(repo_path: Path, task: str) -> bool:
+    """
+    Whether a repository is due a maintenance task,
+    reads the file system so is best run in a thread
+
+        :param repo_path: The repo path
+        :param task: The task from MAINTENANCE_TASKS
+        :return: Whether it is needed
+    """
+    if task == "pack-refs":
+        return count_loose_refs(repo_path) >= get_config().MAINTENANCE_LOOSE_REF_LIMIT
+    if task == "repack":
+        return _is_repack_needed(repo_path)
+    return _is_commit_graph_needed(repo_path)
+
+
+async def run_maintenance_task(repo_path: Path, task: str):
+    """
+    Run a maintenance task on a repository
+
+        :param repo_path: The repo path
+        :param task: The task from MAINTENANCE_TASKS
+        :raises GitException: When git fails
+    """
+    result = await subprocess_run(["git", "-C", str(repo_path), *MAINTENANCE_TASKS[task]])
+    if result.returncode != 0:
+        raise GitException(result.stderr.decode())
+
+
+async def maintain_repo(repo_path: Path, forced: bool = False) -> list[str]:
+    """
+    Run the maintenance tasks a repository is due
+
+        :param repo_path: The repo path
+        :param forced: Whether to run every task, defaults to False
+        :raises GitException: When git fails
+        :raises ServiceUnavailable: When not admitted to run git in time
+        :return: The tasks run
+    """
+    run = []
+    for task in MAINTENANCE_TASKS:
+        # checked after the previous task ran, as it may have made this one due
+        if forced or await asyncio.to_thread(is_task_needed, repo_path, task):
+            async with admitted("maintenance"):
+                await run_maintenance_task(repo_path, task)
+            run.append(task)
+    return run
+
+
+class MaintenanceScheduler:
+    """
+    A queue of repositories to maintain, counting pushes
+    to queue a repository once it reaches a threshold
+    """
+    def __init__(self, push_threshold: int, workers: int):
+        """
+            :param push_threshold: The pushes to a repository before it is queued
+            :param workers: The max repositories maintained at once
+        """
+        self.push_threshold = push_threshold
+        self.workers = workers
+        self._pushes = Counter()
+        # queued repositories and whether to force every task
+        self._queued: dict[Path, bool] = {}
+        self._queue: asyncio.Queue[Path] = asyncio.Queue()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+
+    def record_push(self, repo_path: Path):
+        """
+        Count a push to a repository, queueing it once at the threshold
+
+            :param repo_path: The repo path
+        """
+        self._pushes[repo_path] += 1
+        if self._pushes[repo_path] >= self.push_threshold:
+            self.enqueue(repo_path)
+
+    def enqueue(self, repo_path: Path, forced: bool = False):
+        """
+        Queue a repository to be maintained, unless already queued
+
+            :param repo_path: The repo path
+            :param forced: Whether to run every task, defaults to False
+        """
+        if repo_path in self._queued:
+            self._queued[repo_path] |= forced
+            return
+        self._queued[repo_path] = forced
+        self._queue.put_nowait(repo_path)
+
+    async def _work(self):
+        while True:
+            repo_path = await self._queue.get()
+            forced = self._queued.pop(repo_path)
+            # pushes during the run are counted towards the next
+            self._pushes.pop(repo_path, None)
+            self._running += 1
+            try:
+                tasks = await maintain_repo(repo_path, forced)
+                if tasks:
+                    logger.info("maintained '%s': %s", repo_path, ", ".join(tasks))
+                self._completed += 1
+            except (GitException, HTTPException) as err:
+                # tried again by the next push or sweep
+                logger.warning("maintaining '%s' failed: %s", repo_path, err)
+                self._failed += 1
+            finally:
+                self._running -= 1
+
+    def start(self):
+        """
+        Start the workers, stopped with the other background tasks
+        """
+        for _ in range(self.workers):
+            start_background_task(self._work)
+
+    def get_stats(self) -> dict[str, int]:
+        """
+        Get the queue depth and counts of maintained repositories
+
+            :return: The queued, running, completed and failed counts
+        """
+        return {
+            "queued": len(self._queued),
+            "running": self._running,
+            "completed": self._completed,
+            "failed": self._failed,
+        }
+
+
+@cache
+def get_maintenance_scheduler() -> MaintenanceScheduler:
+    """
+    Get the scheduler, configured by the MAINTENANCE_* config
+
+        :return: The scheduler
+    """
+    config = get_config()
+    return MaintenanceScheduler(config.MAINTENANCE_PUSH_THRESHOLD, config.MAINTENANCE_WORKERS)
+
+
+async def sweep_repos():
+    """
+    Queue every repository, so those changed outside of
+    this app are maintained too, called every MAINTENANCE_SWEEP_INTERVAL seconds
+    """
+    scheduler = get_maintenance_scheduler()
+    repos_path = get_config().REPOS_PATH
+    for directory in find_dirs():
+        for repo_path in find_repos(repos_path / directory):
+            scheduler.enqueue(repo_path)
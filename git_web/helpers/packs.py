@@ -0,0 +1,329 @@
+"""
+Running git's pack commands for the smart HTTP protocol,
+passing on the protocol version the client asked for
+"""
+import asyncio
+import gzip
+import hashlib
+import os
+import re
+from collections.abc import AsyncGenerator, AsyncIterable, Hashable
+from functools import cache
+from pathlib import Path
+from typing import Optional, Union
+
+from git_interface.exceptions import GitException
+from git_interface.pack import RECEIVE_PACK_TYPE, UPLOAD_PACK_TYPE
+
+from .admission import admitted
+from .bundles import get_bundle_list, is_bundle_uri_enabled
+from .caching import (DiskCache, LRUCache, get_cache_path,
+                      get_refs_fingerprint, open_or_build,
+                      register_repo_cache)
+from .config import get_config
+
+__all__ = [
+    "PACK_REQUEST_BUFFER_SIZE", "is_valid_git_protocol", "is_protocol_v2",
+    "pkt_line", "advertise_pack", "exchange_pack",
+    "is_bundle_uri_request", "get_bundle_uri_response",
+    "get_advertisement_cache", "get_advertisement",
+    "is_final_pack_request", "get_pack_disk_cache",
+    "get_pack_name", "open_pack",
+]
+
+PACK_READ_SIZE = 2**16
+ADVERTISEMENT_GZIP_LEVEL = 6
+FLUSH_PKT = b"0000"
+# the pkt-line ending negotiation, after which upload-pack sends the pack
+DONE_PKT_LINE = b"0009done\n"
+# upload-pack requests up to this size are read whole, so their packs can be
+# cached, larger ones (with very many common commits) are streamed to git
+PACK_REQUEST_BUFFER_SIZE = 2**22
+BUNDLE_URI_COMMANDS = (b"0017command=bundle-uri\n", b"0016command=bundle-uri")
+# colon separated 'key' or 'key=value' parameters, as given in the 'Git-Protocol' header
+GIT_PROTOCOL_RE = re.compile(r"[a-z0-9-]+(=[\w.-]*)?(:[a-z0-9-]+(=[\w.-]*)?)*", re.ASCII)
+
+
+def is_valid_git_protocol(protocol: str) -> bool:
+    """
+    Whether a 'Git-Protocol' header value is safe to give to git
+
+        :param protocol: The header value
+        :return: Whether it is valid
+    """
+    return GIT_PROTOCOL_RE.fullmatch(protocol) is not None
+
+
+def is_protocol_v2(protocol: Optional[str]) -> bool:
+    """
+    Whether a 'Git-Protocol' header value asks for protocol v2
+
+        :param protocol: The header value or None when not given
+        :return: Whether v2 was asked for
+    """
+    return protocol is not None and "version=2" in protocol.split(":")
+
+
+def pkt_line(content: bytes) -> bytes:
+    """
+    Prefix content with its length, as a git 'pkt-line'
+
+        :param content: The content
+        :return: The pkt-line
+    """
+    return f"{len(content) + 4:04x}".encode() + content
+
+
+async def _write_input(
+        process: asyncio.subprocess.Process,
+        content: Union[bytes, AsyncIterable[bytes]]):
+    try:
+        if isinstance(content, bytes):
+            process.stdin.write(content)
+            await process.stdin.drain()
+        else:
+            async for chunk in content:
+                process.stdin.write(chunk)
+                # only a chunk at a time is buffered, while git reads at its own pace
+                await process.stdin.drain()
+        process.stdin.write_eof()
+    except (BrokenPipeError, ConnectionResetError):
+        # git stopped reading, its exit status says why
+        pass
+    except BaseException:
+        # reading the request failed, git would otherwise wait for the rest
+        if process.returncode is None:
+            process.kill()
+        raise
+
+
+async def _run_pack_command(
+        repo_path: Path,
+        pack_type: str,
+        protocol: Optional[str],
+        content: Union[None, bytes, AsyncIterable[bytes]]) -> AsyncGenerator[bytes, None]:
+    args = ["git", pack_type.removeprefix("git-"), "--stateless-rpc"]
+    if content is None:
+        args.append("--http-backend-info-refs")
+    args.append(str(repo_path))
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL if content is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=None if protocol is None else dict(os.environ, GIT_PROTOCOL=protocol),
+    )
+    # both read alongside the output, so git never blocks on a full pipe
+    tasks = [asyncio.ensure_future(process.stderr.read())]
+    if content is not None:
+        tasks.append(asyncio.ensure_future(_write_input(process, content)))
+    try:
+        while (chunk := await process.stdout.read(PACK_READ_SIZE)) != b"":
+            yield chunk
+        # a failure reading the request is raised before git's exit status
+        stderr, *_ = await asyncio.gather(*tasks)
+        if await process.wait() != 0:
+            raise GitException(stderr.decode(errors="replace"))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if process.returncode is None:
+            # closing the transport kills the process and closes its pipes
+            process._transport.close()
+            await process.wait()
+
+
+async def advertise_pack(
+        repo_path: Path,
+        pack_type: str,
+        protocol: Optional[str] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Advertise the refs for a pack command, or the
+    capabilities when the client asked for protocol v2
+
+        :param repo_path: The repo path
+        :param pack_type: The pack type from ALLOWED_PACK_TYPES
+        :param protocol: The 'Git-Protocol' header, defaults to None
+        :raises GitException: When git fails
+        :yield: The advertisement
+    """
+    if not is_protocol_v2(protocol):
+        # v2 capabilities are sent without the service line
+        yield pkt_line(f"# service={pack_type}\n".encode()) + FLUSH_PKT
+    elif pack_type == UPLOAD_PACK_TYPE and is_bundle_uri_enabled():
+        # answered here, as git only supports it from 2.40
+        capabilities = b"".join([
+            chunk async for chunk in _run_pack_command(repo_path, pack_type, protocol, None)
+        ])
+        yield capabilities.removesuffix(FLUSH_PKT) + pkt_line(b"bundle-uri\n") + FLUSH_PKT
+        return
+    async for chunk in _run_pack_command(repo_path, pack_type, protocol, None):
+        yield chunk
+
+
+def exchange_pack(
+        repo_path: Path,
+        pack_type: str,
+        content: Union[bytes, AsyncIterable[bytes]],
+        protocol: Optional[str] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Run a pack command with the client's request,
+    streaming both ways with only a chunk at a time buffered
+
+        :param repo_path: The repo path
+        :param pack_type: The pack type from ALLOWED_PACK_TYPES
+        :param content: The request body, read or as a stream
+        :param protocol: The 'Git-Protocol' header, defaults to None
+        :raises GitException: When git fails
+        :return: The response body
+    """
+    return _run_pack_command(repo_path, pack_type, protocol, content)
+
+
+@cache
+def get_advertisement_cache() -> LRUCache:
+    """
+    Get the cache of ref advertisements, limited by
+    ADVERTISEMENT_CACHE_SIZE in bytes (plain and gzipped)
+
+        :return: The cache
+    """
+    return register_repo_cache(LRUCache(
+        get_config().ADVERTISEMENT_CACHE_SIZE,
+        lambda advertisement: len(advertisement[0]) + len(advertisement[1]),
+        lambda key: key[0],
+    ))
+
+
+# advertisements being generated by cache key, so concurrent requests share one
+_pending_advertisements: dict[Hashable, asyncio.Task] = {}
+
+
+async def _build_advertisement(
+        repo_path: Path,
+        pack_type: str,
+        protocol: Optional[str],
+        key: Hashable) -> tuple[bytes, bytes]:
+    async with admitted("push" if pack_type == RECEIVE_PACK_TYPE else "fetch"):
+        content = b"".join([
+            chunk async for chunk in advertise_pack(repo_path, pack_type, protocol)
+        ])
+    gzipped = await asyncio.to_thread(gzip.compress, content, ADVERTISEMENT_GZIP_LEVEL)
+    get_advertisement_cache().set(key, (content, gzipped))
+    return content, gzipped
+
+
+async def get_advertisement(
+        repo_path: Path,
+        pack_type: str,
+        protocol: Optional[str] = None) -> tuple[bytes, bytes]:
+    """
+    Get the advertisement for a pack command, cached until
+    the repository's refs change and shared by concurrent requests
+
+        :param repo_path: The repo path
+        :param pack_type: The pack type from ALLOWED_PACK_TYPES
+        :param protocol: The 'Git-Protocol' header, defaults to None
+        :raises GitException: When git fails
+        :raises ServiceUnavailable: When not admitted to run git in time
+        :return: The advertisement and its gzipped copy
+    """
+    # taken before git runs, so a ref changed while it runs gives a new key
+    fingerprint = await asyncio.to_thread(get_refs_fingerprint, repo_path)
+    key = (str(repo_path), pack_type, protocol, fingerprint)
+    if (advertisement := get_advertisement_cache().get(key)) is not None:
+        return advertisement
+    if (task := _pending_advertisements.get(key)) is None:
+        task = asyncio.ensure_future(_build_advertisement(repo_path, pack_type, protocol, key))
+        _pending_advertisements[key] = task
+
+        def finished(task: asyncio.Task):
+            _pending_advertisements.pop(key, None)
+            if not task.cancelled():
+                # waiting requests are given the exception
+                task.exception()
+
+        task.add_done_callback(finished)
+    # one request giving up doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+
+def is_bundle_uri_request(content: bytes) -> bool:
+    """
+    Whether an upload-pack request is a protocol v2 'bundle-uri' command,
+    which is only answered when bundles are enabled
+
+        :param content: The request body
+        :return: Whether it is
+    """
+    return is_bundle_uri_enabled() and content.startswith(BUNDLE_URI_COMMANDS)
+
+
+def get_bundle_uri_response(repo_path: Path) -> bytes:
+    """
+    Answer a 'bundle-uri' command with the repository's bundle
+
+        :param repo_path: The repo path
+        :return: The response body
+    """
+    lines = get_bundle_list(repo_path)
+    return b"".join(pkt_line(f"{line}\n".encode()) for line in lines) + FLUSH_PKT
+
+
+def is_final_pack_request(content: bytes) -> bool:
+    """
+    Whether an upload-pack request ends negotiation,
+    so is answered with a pack rather than acknowledgements
+
+        :param content: The request body
+        :return: Whether it is final
+    """
+    return DONE_PKT_LINE in content
+
+
+@cache
+def get_pack_disk_cache() -> DiskCache:
+    """
+    Get the cache of generated packs, limited by PACK_CACHE_SIZE
+
+        :return: The cache
+    """
+    return DiskCache(get_cache_path("packs"), get_config().PACK_CACHE_SIZE)
+
+
+def get_pack_name(repo_path: Path, content: bytes, protocol: Optional[str]) -> str:
+    """
+    Get the cache file name of a pack, from the repository and
+    the request naming the wanted and common commits, which
+    give the same pack as long as those commits exist
+
+        :param repo_path: The repo path
+        :param content: The final upload-pack request body
+        :param protocol: The 'Git-Protocol' header
+        :return: The name
+    """
+    digest = hashlib.sha256()
+    for part in (str(repo_path).encode(), (protocol or "").encode(), content):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+async def open_pack(
+        repo_path: Path,
+        content: bytes,
+        protocol: Optional[str] = None) -> tuple[Optional[int], AsyncGenerator[bytes, None]]:
+    """
+    Open the upload-pack response to a final request,
+    generating it when not cached, see 'open_or_build'
+
+        :param repo_path: The repo path
+        :param content: The request body
+        :param protocol: The 'Git-Protocol' header, defaults to None
+        :return: The response size (None while generating) and its content
+    """
+    return await open_or_build(
+        get_pack_disk_cache(),
+        get_pack_name(repo_path, content, protocol),
+        lambda: exchange_pack(repo_path, UPLOAD_PACK_TYPE, content, protocol),
+    )
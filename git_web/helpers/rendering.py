@@ -0,0 +1,220 @@
+"""
+Runs CPU heavy rendering (highlighting, markdown)
+outside of the event loop in worker processes
+"""
+import asyncio
+import multiprocessing
+import os
+from collections.abc import Callable, Hashable
+from functools import cache
+from multiprocessing.connection import Connection
+from typing import Any, Optional
+
+from quart import g, has_app_context
+
+from .caching import LRUCache
+from .config import get_config
+
+__all__ = [
+    "RenderTimeout", "RenderWorker", "RenderPool",
+    "get_render_pool", "close_render_pool",
+    "get_slow_render_cache", "render",
+]
+
+# renders remembered as too slow, so they are not tried again
+SLOW_RENDER_CACHE_COUNT = 4096
+
+
+class RenderTimeout(Exception):
+    """
+    Raised when a render runs longer than RENDER_TIMEOUT,
+    or has timed out before for the same key.
+
+    Marks the current request with 'g.render_timed_out'
+    so a page showing the fallback is not cached
+    """
+
+
+def _work(conn: Connection):
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, func(*args))
+        except Exception as err:
+            result = (False, err)
+        conn.send(result)
+
+
+class RenderWorker:
+    """
+    A worker process running one render at a time,
+    killed when a render runs too long
+    """
+    def __init__(self):
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn: Optional[Connection] = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        # spawn so workers do not inherit the server's sockets and pipes
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_work, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+            self._process = None
+            self._conn = None
+
+    async def _wait_readable(self, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = self._conn.fileno()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+    async def run(self, func: Callable[..., str], args: tuple, timeout: float) -> str:
+        """
+        Run a render, func and args must be picklable
+
+            :param func: The render function
+            :param args: The function arguments
+            :param timeout: Seconds the render may run for
+            :raises RenderTimeout: Render ran too long, the worker is killed
+            :return: The render result
+        """
+        if not self.is_alive:
+            self.kill()
+            self.start()
+        try:
+            await asyncio.to_thread(self._conn.send, (func, args))
+            if not await self._wait_readable(timeout):
+                self.kill()
+                raise RenderTimeout("render timed out")
+            ok, result = await asyncio.to_thread(self._conn.recv)
+        except BaseException:
+            # e.g. cancelled while rendering, the worker state is unknown
+            self.kill()
+            raise
+        if not ok:
+            raise result
+        return result
+
+
+class RenderPool:
+    """
+    A fixed number of render workers, renders wait for a free worker
+    before their timeout starts, so queueing is not counted
+    """
+    def __init__(self, workers: int):
+        self.loop = asyncio.get_running_loop()
+        self._idle: asyncio.Queue[RenderWorker] = asyncio.Queue()
+        self._workers = [RenderWorker() for _ in range(workers)]
+        for worker in self._workers:
+            self._idle.put_nowait(worker)
+
+    async def run(self, func: Callable[..., str], args: tuple, timeout: float) -> str:
+        worker = await self._idle.get()
+        try:
+            return await worker.run(func, args, timeout)
+        finally:
+            self._idle.put_nowait(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.kill()
+
+
+_pool: Optional[RenderPool] = None
+# renders in progress by key, so identical renders share a worker
+_pending_renders: dict[Hashable, asyncio.Future] = {}
+
+
+def get_render_pool() -> Optional[RenderPool]:
+    """
+    Get the render pool for the running event loop, sized by RENDER_WORKERS
+
+        :return: The pool, or None when rendering in the event loop
+    """
+    global _pool
+    workers = get_config().RENDER_WORKERS
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 0:
+        return None
+    if _pool is None or _pool.loop is not asyncio.get_running_loop():
+        if _pool is not None:
+            _pool.close()
+        _pool = RenderPool(workers)
+    return _pool
+
+
+def close_render_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+@cache
+def get_slow_render_cache() -> LRUCache:
+    """
+    Get the keys of renders that timed out
+
+        :return: The cache
+    """
+    return LRUCache(SLOW_RENDER_CACHE_COUNT)
+
+
+async def render(func: Callable[..., str], *args: Any, key: Optional[Hashable] = None) -> str:
+    """
+    Run a render function in the render pool,
+    func and args must be picklable
+
+        :param func: The render function
+        :param key: Identifies the render, when given identical
+                    renders in progress are shared and a render
+                    that timed out is not tried again, defaults to None
+        :raises RenderTimeout: Render ran longer than RENDER_TIMEOUT
+        :return: The render result
+    """
+    pool = get_render_pool()
+    if pool is None:
+        return func(*args)
+    if key is not None and key in get_slow_render_cache():
+        raise RenderTimeout("render timed out before")
+    if key is None:
+        return await _run_render(pool, func, args, key)
+    if (pending := _pending_renders.get(key)) is None:
+        pending = asyncio.ensure_future(_run_render(pool, func, args, key))
+        _pending_renders[key] = pending
+        pending.add_done_callback(lambda _: _pending_renders.pop(key, None))
+    return await asyncio.shield(pending)
+
+
+async def _run_render(pool: RenderPool, func: Callable[..., str], args: tuple, key) -> str:
+    try:
+        return await pool.run(func, args, get_config().RENDER_TIMEOUT)
+    except RenderTimeout:
+        if has_app_context():
+            g.render_timed_out = True
+        if key is not None:
+            get_slow_render_cache().set(key, True)
+        raise
@@ -0,0 +1,414 @@
+"""
+An in-memory index of every repository and its metadata,
+so directory pages don't read each repository per request
+"""
+import asyncio
+import bisect
+import os
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from itertools import islice
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+from git_interface.helpers import subprocess_run
+
+from .caching import get_refs_fingerprint, register_repo_listener
+from .calculations import find_dirs, find_repos
+from .config import get_config
+from .trigrams import TrigramIndex
+
+__all__ = [
+    "RepoInfo", "read_repo_info", "REPO_SORT_KEYS", "SEARCH_RANKS",
+    "RepoIndex", "get_repo_index",
+]
+
+# repositories read at once while scanning
+SCAN_CONCURRENCY = 8
+# a directory changed this recently may change again without
+# its modification time changing, so is scanned again next time
+RACY_MODIFIED_NS = 10**9
+# how a search term matched a repository, best first
+SEARCH_RANKS = ("name", "name prefix", "in name", "in directory", "in description")
+# greater than any character, ending the names starting with a prefix
+MAX_CHAR = chr(0x10FFFF)
+
+
+@dataclass
+class RepoInfo:
+    """
+    A repository's metadata, as shown on directory pages
+    """
+    path: Path
+    last_commit: Optional[datetime]
+    default_branch: Optional[str]
+    description: str
+    size: int
+    ref_count: int
+
+    @property
+    def name(self) -> str:
+        return self.path.stem
+
+    @property
+    def directory(self) -> str:
+        return self.path.parent.name
+
+
+def _get_modified(path: Path) -> int:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _get_dir_modified(path: Path) -> int:
+    modified = _get_modified(path)
+    return 0 if time.time_ns() - modified < RACY_MODIFIED_NS else modified
+
+
+def _get_fingerprint(repo_path: Path) -> tuple[int, ...]:
+    # refs change on push, packs on push and maintenance
+    return (
+        *get_refs_fingerprint(repo_path),
+        _get_modified(repo_path / "description"),
+        _get_modified(repo_path / "objects" / "pack"),
+    )
+
+
+def _read_default_branch(repo_path: Path) -> Optional[str]:
+    head = (repo_path / "HEAD").read_text().strip()
+    if not head.startswith("ref: refs/heads/"):
+        return None
+    return head.removeprefix("ref: refs/heads/")
+
+
+def _count_refs(repo_path: Path) -> int:
+    # a ref can be both loose and packed, so counted by name
+    names = {
+        os.path.relpath(os.path.join(dir_path, name), repo_path)
+        for dir_path, _, file_names in os.walk(repo_path / "refs")
+        for name in file_names
+    }
+    try:
+        with open(repo_path / "packed-refs") as file:
+            for line in file:
+                # skipping the header and peeled tags
+                if not line.startswith(("#", "^")):
+                    names.add(line.split()[-1])
+    except FileNotFoundError:
+        pass
+    return len(names)
+
+
+def _get_size(repo_path: Path) -> int:
+    size = 0
+    for dir_path, _, file_names in os.walk(repo_path):
+        for name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def _read_repo_files(repo_path: Path) -> tuple[tuple[int, ...], Optional[str], str, int, int]:
+    fingerprint = _get_fingerprint(repo_path)
+    try:
+        description = (repo_path / "description").read_text().strip()
+    except FileNotFoundError:
+        description = ""
+    return (
+        fingerprint, _read_default_branch(repo_path), description,
+        _get_size(repo_path), _count_refs(repo_path),
+    )
+
+
+async def _read_last_commit(repo_path: Path) -> Optional[datetime]:
+    result = await subprocess_run([
+        "git", "-C", str(repo_path), "for-each-ref", "--sort=-committerdate",
+        "--count=1", "--format=%(committerdate:unix)", "refs/heads",
+    ])
+    if result.returncode != 0 or not result.stdout.strip():
+        # no branches yet
+        return None
+    return datetime.fromtimestamp(int(result.stdout), timezone.utc)
+
+
+async def read_repo_info(repo_path: Path) -> tuple[tuple[int, ...], RepoInfo]:
+    """
+    Read a repository's metadata
+
+        :param repo_path: The repo path
+        :raises FileNotFoundError: When the repository no longer exists
+        :return: A fingerprint changing when it does and the metadata
+    """
+    fingerprint, default_branch, description, size, ref_count = await asyncio.to_thread(
+        _read_repo_files, repo_path)
+    return fingerprint, RepoInfo(
+        repo_path, await _read_last_commit(repo_path),
+        default_branch, description, size, ref_count,
+    )
+
+
+# sort keys for a directory's repositories, by 'sort' query value
+REPO_SORT_KEYS: dict[str, Callable[[RepoInfo], object]] = {
+    "name": lambda repo: repo.name,
+    # most recent first, without commits last
+    "activity": lambda repo: (
+        repo.last_commit is None,
+        -repo.last_commit.timestamp() if repo.last_commit is not None else 0,
+        repo.name,
+    ),
+}
+
+
+class RepoIndex:
+    """
+    Repositories and their metadata by directory. A directory is rescanned
+    when it has changed since last read, changed repositories when their
+    caches are invalidated and every repository by a periodic rescan
+    """
+    def __init__(self):
+        self._dirs: Optional[list[str]] = None
+        self._dirs_modified = 0
+        # by directory then repository name
+        self._repos: dict[str, dict[str, RepoInfo]] = {}
+        self._fingerprints: dict[Path, tuple[int, ...]] = {}
+        self._dir_modified: dict[str, int] = {}
+        self._changed: set[Path] = set()
+        # for searching every directory, by repo path as a string
+        self._searched: dict[str, RepoInfo] = {}
+        # lowercase names sorted with their keys, to find those with a prefix
+        self._sorted_names: list[str] = []
+        self._sorted_keys: list[str] = []
+        self._names = TrigramIndex()
+        self._descriptions = TrigramIndex()
+        # by lowercase directory name
+        self._dir_keys: defaultdict[str, set[str]] = defaultdict(set)
+        # equally ranked results are ordered by name length, directory then name
+        self._search_sort: dict[str, tuple[int, str, str, str]] = {}
+        self._search_order: list[tuple[int, str, str, str]] = []
+        # so a directory is only scanned once at a time
+        self._locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def mark_changed(self, repo_path: Path):
+        """
+        Mark a repository to be read again when next shown
+
+            :param repo_path: The repo path
+        """
+        self._changed.add(repo_path)
+
+    def _set_repo(self, info: RepoInfo, fingerprint: tuple[int, ...]):
+        self._repos.setdefault(info.directory, {})[info.name] = info
+        self._fingerprints[info.path] = fingerprint
+        key = str(info.path)
+        if key not in self._searched:
+            name = info.name.lower()
+            position = bisect.bisect(self._sorted_names, name)
+            self._sorted_names.insert(position, name)
+            self._sorted_keys.insert(position, key)
+            self._names.add(key, name)
+            self._dir_keys[info.directory.lower()].add(key)
+            sort_key = self._search_sort[key] = len(name), info.directory, name, key
+            bisect.insort(self._search_order, sort_key)
+        self._searched[key] = info
+        self._descriptions.add(key, info.description)
+
+    def _remove_repo(self, repo_path: Path):
+        self._repos.get(repo_path.parent.name, {}).pop(repo_path.stem, None)
+        self._fingerprints.pop(repo_path, None)
+        key = str(repo_path)
+        if self._searched.pop(key, None) is None:
+            return
+        name = repo_path.stem.lower()
+        position = bisect.bisect_left(self._sorted_names, name)
+        position = self._sorted_keys.index(key, position)
+        del self._sorted_names[position]
+        del self._sorted_keys[position]
+        self._names.remove(key)
+        self._descriptions.remove(key)
+        directory = repo_path.parent.name.lower()
+        self._dir_keys[directory].discard(key)
+        if not self._dir_keys[directory]:
+            del self._dir_keys[directory]
+        sort_key = self._search_sort.pop(key)
+        del self._search_order[bisect.bisect_left(self._search_order, sort_key)]
+
+    async def _read_repos(self, repo_paths: list[Path]):
+        semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+
+        async def read(repo_path: Path):
+            async with semaphore:
+                try:
+                    fingerprint, info = await read_repo_info(repo_path)
+                except FileNotFoundError:
+                    # removed while being read
+                    self._remove_repo(repo_path)
+                    return
+                self._set_repo(info, fingerprint)
+
+        await asyncio.gather(*map(read, repo_paths))
+
+    async def _scan_directory(self, directory: str, check_all: bool):
+        dir_path = get_config().REPOS_PATH / directory
+        modified = _get_dir_modified(dir_path)
+        repo_paths = await asyncio.to_thread(lambda: list(find_repos(dir_path)))
+        repos = self._repos.setdefault(directory, {})
+        names = {path.stem for path in repo_paths}
+        for name in set(repos) - names:
+            self._remove_repo(repos[name].path)
+        if check_all:
+            fingerprints = await asyncio.to_thread(
+                lambda: {path: _get_fingerprint(path) for path in repo_paths})
+            to_read = [
+                path for path in repo_paths
+                if fingerprints[path] != self._fingerprints.get(path)
+            ]
+        else:
+            to_read = [
+                path for path in repo_paths
+                if path.stem not in repos or path in self._changed
+            ]
+        self._changed = {path for path in self._changed if path.parent != dir_path}
+        await self._read_repos(to_read)
+        self._dir_modified[directory] = modified
+
+    async def get_dirs(self) -> list[str]:
+        """
+        Get the allowed directories, read again when changed
+
+            :return: The directory names, sorted
+        """
+        modified = _get_dir_modified(get_config().REPOS_PATH)
+        if self._dirs is None or modified == 0 or modified != self._dirs_modified:
+            self._dirs = sorted(await asyncio.to_thread(lambda: list(find_dirs())))
+            self._dirs_modified = modified
+            for directory in set(self._repos) - set(self._dirs):
+                for repo in list(self._repos.pop(directory).values()):
+                    self._remove_repo(repo.path)
+        return self._dirs
+
+    async def get_repos(self, directory: str) -> list[RepoInfo]:
+        """
+        Get a directory's repositories, reading only
+        those added or changed since last shown
+
+            :param directory: The directory name
+            :return: The repositories, in no order
+        """
+        async with self._locks[directory]:
+            dir_path = get_config().REPOS_PATH / directory
+            changed = any(path.parent == dir_path for path in self._changed)
+            modified = self._dir_modified.get(directory, 0)
+            if changed or modified == 0 or _get_modified(dir_path) != modified:
+                await self._scan_directory(directory, False)
+        return list(self._repos.get(directory, {}).values())
+
+    def _find_prefixed(self, prefix: str) -> tuple[set[str], set[str]]:
+        # the keys named a lowercase prefix and those starting with it
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        prefix_start = bisect.bisect_right(self._sorted_names, prefix, start)
+        end = bisect.bisect_left(self._sorted_names, prefix + MAX_CHAR, prefix_start)
+        return (
+            set(self._sorted_keys[start:prefix_start]),
+            set(self._sorted_keys[prefix_start:end]),
+        )
+
+    def _find_in_directory(self, term: str) -> set[str]:
+        # the keys whose 'directory/name' contains a lowercase term
+        if "/" not in term:
+            return set().union(*(
+                keys for directory, keys in self._dir_keys.items() if term in directory))
+        directory, _, name = term.partition("/")
+        if "/" in name:
+            return set()
+        # the directory ending with its part and the name starting with its
+        in_directories = set().union(*(
+            keys for dir_name, keys in self._dir_keys.items() if dir_name.endswith(directory)))
+        return in_directories & set().union(*self._find_prefixed(name))
+
+    def _match_term(self, term: str) -> list[set[str]]:
+        # the keys a lowercase term matches by rank, see SEARCH_RANKS
+        matches = [
+            *self._find_prefixed(term),
+            self._names.find(term),
+            self._find_in_directory(term),
+            self._descriptions.find(term),
+        ]
+        # each only in its best rank
+        matched = set()
+        for keys in matches:
+            keys -= matched
+            matched |= keys
+        return matches
+
+    def _get_ordered(self, keys: set[str], count: int) -> list[str]:
+        # the first of equally ranked keys
+        if len(keys) * 8 < len(self._search_order):
+            return sorted(keys, key=self._search_sort.__getitem__)[:count]
+        # many match, so the first are found soon
+        ordered = (sort_key[-1] for sort_key in self._search_order)
+        return list(islice((key for key in ordered if key in keys), count))
+
+    async def search(self, query: str, limit: Optional[int] = None) -> list[RepoInfo]:
+        """
+        Search every directory's repositories, matching each
+        of the query's words to their names and descriptions
+
+            :param query: The query
+            :param limit: The max results, defaults to None
+            :return: The best matching repositories first
+        """
+        # so repositories created, moved or changed since are found
+        for directory in await self.get_dirs():
+            await self.get_repos(directory)
+        terms = query.lower().split()
+        if not terms:
+            return []
+        by_rank = self._match_term(terms[0])
+        if len(terms) > 1:
+            # every term must match, ranked by the sum of their ranks
+            term_matches = [by_rank, *map(self._match_term, terms[1:])]
+            matched = set.intersection(*(set().union(*matches) for matches in term_matches))
+            ranks = dict.fromkeys(matched, 0)
+            for matches in term_matches:
+                for rank, keys in enumerate(matches):
+                    for key in keys & matched:
+                        ranks[key] += rank
+            by_rank = [set() for _ in range(len(SEARCH_RANKS) * len(terms))]
+            for key, rank in ranks.items():
+                by_rank[rank].add(key)
+        results = []
+        limit = limit or len(self._searched)
+        for keys in by_rank:
+            if len(results) == limit:
+                break
+            results.extend(self._get_ordered(keys, limit - len(results)))
+        return [self._searched[key] for key in results]
+
+    async def rescan(self):
+        """
+        Read every repository changed since last read, including those
+        changed outside of this app, called every REPO_INDEX_INTERVAL seconds
+        """
+        for directory in await self.get_dirs():
+            async with self._locks[directory]:
+                await self._scan_directory(directory, True)
+
+
+@cache
+def get_repo_index() -> RepoIndex:
+    """
+    Get the index, kept current through invalidate_repo
+
+        :return: The index
+    """
+    index = RepoIndex()
+    register_repo_listener(index.mark_changed)
+    return index
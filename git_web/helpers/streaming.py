@@ -0,0 +1,173 @@
+"""
+Streaming request and response bodies, so large
+git pushes and fetches are held a chunk at a time
+"""
+import asyncio
+import zlib
+from collections.abc import AsyncGenerator, AsyncIterable, AsyncIterator
+from typing import Any, Generator, Optional, Union
+
+from quart.asgi import ASGIHTTPConnection
+from quart.wrappers import Body, Request
+from werkzeug.exceptions import (BadRequest, RequestEntityTooLarge,
+                                 UnsupportedMediaType)
+
+__all__ = [
+    "STREAM_BUFFER_SIZE", "StreamingBody", "StreamingRequest",
+    "StreamingHTTPConnection", "decode_body", "buffer_body", "start_stream",
+]
+
+# received bytes held before reading from the client pauses
+STREAM_BUFFER_SIZE = 2**20
+DECODE_SIZE = 2**16
+GZIP_ENCODINGS = ("gzip", "x-gzip")
+
+
+class StreamingBody(Body):
+    """
+    A request body which, when iterated over, only holds up to
+    STREAM_BUFFER_SIZE bytes before the client is made to wait
+    """
+    def __init__(
+            self,
+            expected_content_length: Optional[int],
+            max_content_length: Optional[int]):
+        # a streamed body is held a buffer at a time,
+        # so only one read whole is refused by its length up front
+        super().__init__(None, max_content_length)
+        self._expected_content_length = expected_content_length
+        self._drained = asyncio.Event()
+        self._awaited = False
+
+    async def __anext__(self) -> bytes:
+        data = await super().__anext__()
+        self._drained.set()
+        return data
+
+    def __await__(self) -> Generator[Any, None, Any]:
+        if (
+            self._expected_content_length is not None and
+            self._max_content_length is not None and
+            self._expected_content_length > self._max_content_length
+        ):
+            raise RequestEntityTooLarge()
+        # read whole, so waiting for it to be drained would never end
+        self._awaited = True
+        self._drained.set()
+        return (yield from super().__await__())
+
+    async def wait_for_space(self):
+        """
+        Wait until the buffered data has been read, unless
+        the body is read whole or has failed
+        """
+        while (
+            not self._awaited and self._must_raise is None and
+            len(self._data) >= STREAM_BUFFER_SIZE
+        ):
+            self._drained.clear()
+            await self._drained.wait()
+
+
+class StreamingRequest(Request):
+    body_class = StreamingBody
+
+
+class StreamingHTTPConnection(ASGIHTTPConnection):
+    """
+    Receives a request's body no faster than it is read,
+    so a slow git process slows down the client sending to it
+    """
+    async def handle_messages(self, request: StreamingRequest, receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.request":
+                request.body.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    request.body.set_complete()
+                else:
+                    await request.body.wait_for_space()
+            elif message["type"] == "http.disconnect":
+                return
+
+
+def _iter_decompressed(decompressor, data: bytes) -> Generator[bytes, None, None]:
+    while data and not decompressor.eof:
+        # limited, so a small chunk can't expand into a huge one
+        if (part := decompressor.decompress(data, DECODE_SIZE)) != b"":
+            yield part
+        data = decompressor.unconsumed_tail
+
+
+async def decode_body(
+        body: AsyncIterable[bytes],
+        content_encoding: Optional[str],
+        max_size: int) -> AsyncGenerator[bytes, None]:
+    """
+    Decode a request body as it is received
+
+        :param body: The request body
+        :param content_encoding: The 'Content-Encoding' header, None when not given
+        :param max_size: The max decoded size in bytes
+        :raises UnsupportedMediaType: When the encoding is not supported
+        :raises RequestEntityTooLarge: When the decoded body is larger than max_size
+        :raises BadRequest: When the body is not validly encoded
+        :yield: Each decoded chunk
+    """
+    if content_encoding in (None, "identity"):
+        decompressor = None
+    elif content_encoding in GZIP_ENCODINGS:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        raise UnsupportedMediaType(f"Content-Encoding '{content_encoding}' is not supported")
+    size = 0
+    async for chunk in body:
+        try:
+            parts = [chunk] if decompressor is None else _iter_decompressed(decompressor, chunk)
+            for part in parts:
+                size += len(part)
+                if size > max_size:
+                    raise RequestEntityTooLarge(f"Request body is larger than {max_size} bytes")
+                yield part
+        except zlib.error as err:
+            raise BadRequest(f"Request body is not valid {content_encoding}") from err
+    if decompressor is not None and not decompressor.eof:
+        raise BadRequest(f"Request body is not valid {content_encoding}")
+
+
+async def _prepend(first: bytes, rest: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    if first != b"":
+        yield first
+    async for chunk in rest:
+        yield chunk
+
+
+async def buffer_body(
+        body: AsyncIterable[bytes],
+        max_size: int) -> Union[bytes, AsyncGenerator[bytes, None]]:
+    """
+    Read a request body whole, unless it is larger than max_size
+
+        :param body: The request body
+        :param max_size: The max size to read whole
+        :return: The body, or a stream of it when larger
+    """
+    body = aiter(body)
+    content = bytearray()
+    async for chunk in body:
+        content += chunk
+        if len(content) > max_size:
+            return _prepend(bytes(content), body)
+    return bytes(content)
+
+
+async def start_stream(stream: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    """
+    Wait for the first chunk of a stream, so it failing
+    before then can still be answered with an error response
+
+        :param stream: The stream
+        :return: The same stream
+    """
+    first = await anext(stream, b"")
+    return _prepend(first, stream)
@@ -0,0 +1,232 @@
+"""
+Trigram indexes, finding the texts containing a substring
+without scanning every text, either in memory or
+as segment files that are memory-mapped when searched
+"""
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Hashable, Iterable, Iterator
+from pathlib import Path
+from typing import AnyStr
+
+__all__ = [
+    "iter_trigrams", "find_content_trigrams", "TrigramIndex",
+    "TrigramSegmentBuilder", "TrigramSegment",
+]
+
+SEGMENT_MAGIC = b"GWTRIGR1"
+# the magic, key size, key count and trigram count, followed by
+# the keys, the sorted trigrams, where each trigram's postings start
+# and the postings, as native 32 bit integers as the files are a local cache
+SEGMENT_HEADER = struct.Struct("=8sIII")
+
+
+def iter_trigrams(text: AnyStr) -> Iterator[AnyStr]:
+    """
+    Iterate over every three character substring of a text
+
+        :param text: The text
+        :yield: Each trigram, including repeats
+    """
+    for start in range(len(text) - 2):
+        yield text[start:start + 3]
+
+
+def find_content_trigrams(content: bytes) -> set[bytes]:
+    """
+    Find the distinct trigrams of a file's content, with ASCII lowercased
+
+        :param content: The content
+        :return: The trigrams
+    """
+    content = content.lower()
+    # quicker than iter_trigrams, which matters for large files
+    return {content[start:start + 3] for start in range(len(content) - 2)}
+
+
+def _get_trigram_value(trigram: bytes) -> int:
+    # ordered as the trigrams are
+    return int.from_bytes(trigram, "big")
+
+
+class TrigramIndex:
+    """
+    Texts by key, searched case-insensitively
+    """
+    def __init__(self):
+        self._texts: dict[Hashable, str] = {}
+        self._postings: defaultdict[str, set[Hashable]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def add(self, key: Hashable, text: str):
+        """
+        Add a text or replace the text of a key
+
+            :param key: The key
+            :param text: The text
+        """
+        self.remove(key)
+        text = text.lower()
+        self._texts[key] = text
+        for trigram in set(iter_trigrams(text)):
+            self._postings[trigram].add(key)
+
+    def remove(self, key: Hashable):
+        """
+        Remove a key's text, if it has one
+
+            :param key: The key
+        """
+        if (text := self._texts.pop(key, None)) is None:
+            return
+        for trigram in set(iter_trigrams(text)):
+            keys = self._postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[trigram]
+
+    def find(self, term: str) -> set[Hashable]:
+        """
+        Find the keys whose text contains a term
+
+            :param term: The term
+            :return: The keys
+        """
+        term = term.lower()
+        if len(term) < 3:
+            # too short to have a trigram
+            return self._scan(term)
+        # checking the texts with the rarest trigram is cheaper than
+        # intersecting every trigram's keys when the term is common
+        candidates = min(
+            (self._postings.get(trigram, set()) for trigram in set(iter_trigrams(term))),
+            key=len,
+        )
+        if len(term) == 3:
+            return set(candidates)
+        if len(candidates) * 4 > len(self._texts):
+            # most texts would be checked anyway
+            return self._scan(term)
+        return {key for key in candidates if term in self._texts[key]}
+
+    def _scan(self, term: str) -> set[Hashable]:
+        return {key for key, text in self._texts.items() if term in text}
+
+
+class TrigramSegmentBuilder:
+    """
+    The trigrams of documents, numbered in the
+    order added, to be written as a segment file
+    """
+    def __init__(self):
+        self.keys: list[bytes] = []
+        self._postings: defaultdict[bytes, array] = defaultdict(lambda: array("I"))
+
+    def add(self, key: bytes, trigrams: Iterable[bytes]):
+        """
+        Add a document
+
+            :param key: The document's key, all keys must be the same length
+            :param trigrams: The document's distinct trigrams
+        """
+        number = len(self.keys)
+        self.keys.append(key)
+        for trigram in trigrams:
+            self._postings[trigram].append(number)
+
+    def write(self, path: Path):
+        """
+        Write the segment file
+
+            :param path: Where to write it
+        """
+        trigrams = sorted(self._postings)
+        offsets = array("I", [0])
+        postings = array("I")
+        for trigram in trigrams:
+            postings.extend(self._postings[trigram])
+            offsets.append(len(postings))
+        key_size = len(self.keys[0]) if self.keys else 0
+        with open(path, "wb") as file:
+            file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, key_size, len(self.keys), len(trigrams)))
+            file.write(b"".join(self.keys))
+            array("I", map(_get_trigram_value, trigrams)).tofile(file)
+            offsets.tofile(file)
+            postings.tofile(file)
+
+
+class TrigramSegment:
+    """
+    A memory-mapped segment file, so only
+    the pages a search reads are loaded
+    """
+    def __init__(self, path: Path):
+        """
+            :param path: The segment file
+            :raises ValueError: When not a segment file
+        """
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_size, self._key_count, trigram_count = SEGMENT_HEADER.unpack_from(
+            self._map)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"'{path}' is not a trigram segment")
+        view = memoryview(self._map)
+        keys_end = SEGMENT_HEADER.size + self.key_size * self._key_count
+        trigrams_end = keys_end + 4 * trigram_count
+        offsets_end = trigrams_end + 4 * (trigram_count + 1)
+        self._keys = view[SEGMENT_HEADER.size:keys_end]
+        self._trigrams = view[keys_end:trigrams_end].cast("I")
+        self._offsets = view[trigrams_end:offsets_end].cast("I")
+        self._postings = view[offsets_end:].cast("I")
+
+    def __len__(self) -> int:
+        return self._key_count
+
+    def get_key(self, number: int) -> bytes:
+        """
+        Get a document's key
+
+            :param number: The document number
+            :return: The key
+        """
+        return bytes(self._keys[number * self.key_size:(number + 1) * self.key_size])
+
+    def iter_keys(self) -> Iterator[bytes]:
+        """
+        Iterate over every document's key
+
+            :yield: Each key, in document number order
+        """
+        for number in range(len(self)):
+            yield self.get_key(number)
+
+    def find(self, trigrams: Iterable[bytes]) -> set[int]:
+        """
+        Find the documents containing every trigram
+
+            :param trigrams: The lowercase trigrams, all documents match none
+            :return: The document numbers
+        """
+        ranges = []
+        for trigram in trigrams:
+            value = _get_trigram_value(trigram)
+            position = bisect_left(self._trigrams, value)
+            if position == len(self._trigrams) or self._trigrams[position] != value:
+                return set()
+            ranges.append((self._offsets[position], self._offsets[position + 1]))
+        if not ranges:
+            return set(range(len(self)))
+        # the rarest first, so the intersections stay small
+        ranges.sort(key=lambda postings_range: postings_range[1] - postings_range[0])
+        found = set(self._postings[ranges[0][0]:ranges[0][1]])
+        for start, end in ranges[1:]:
+            if not found:
+                break
+            found.intersection_update(self._postings[start:end])
+        return found
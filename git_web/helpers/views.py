@@ -1,19 +1,46 @@
-from dataclasses import dataclass
+import asyncio
+import os
+from collections.abc import AsyncGenerator, Awaitable, Callable, Hashable
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from functools import cache
+from html import escape
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 from git_interface.branch import get_branches
 from git_interface.datatypes import Log, TreeContent
-from git_interface.exceptions import (NoBranchesException,
+from git_interface.exceptions import (GitException, NoBranchesException,
                                       PathDoesNotExistInRevException)
 from git_interface.log import get_logs
 from git_interface.ls import ls_tree
-from git_interface.show import show_file
 from git_interface.tag import list_tags
-from quart import url_for
+from quart import (Response, abort, g, make_response, request, session,
+                   url_for)
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
+from .caching import (DiskCache, HighlightCache, LRUCache,
+                      get_refs_fingerprint, iter_file, register_repo_cache)
 from .calculations import sort_repo_tree
-from .content_preview import render_markdown
+from .cat_file_pool import (CatFileProcess, ObjectInfo, get_cat_file_pool,
+                            get_commit_hash, get_object_info, read_object,
+                            stream_object)
+from .config import get_config
+from .constants import BLOB_LINES_WINDOW, MAX_BLOB_LINES_WINDOW, MAX_BLOB_SIZE
+from .content_preview import (CONTENT_SNIFF_SIZE, get_lexer_for_path,
+                              guess_mimetype, highlight_by_ext,
+                              highlight_lines, render_markdown,
+                              sniff_content_type)
+from .line_index import get_line_index, iter_blob_range, read_lines
+from .rendering import RenderTimeout, render
+
+RepoFetcher = Callable[[str], Awaitable[Any]]
+
+MISSING_README_CACHE_COUNT = 4096
+# for raw files requested by commit hash, which never change
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+CONTENT_TYPE_CACHE_COUNT = 2**16
 
 
 @dataclass
@@ -24,59 +51,589 @@ class RepoContent:
     tags: list[str]
     root_tree: tuple[TreeContent]
     recent_log: Log
+    extra: dict[str, Any] = field(default_factory=dict)
+
+
+@cache
+def get_page_cache() -> LRUCache:
+    """
+    Get the rendered page cache, limited by
+    PAGE_CACHE_SIZE in characters of HTML
+
+        :return: The cache
+    """
+    return register_repo_cache(LRUCache(
+        get_config().PAGE_CACHE_SIZE,
+        len,
+        lambda key: key[0],
+    ))
+
+
+async def get_page_cache_key(
+        repo_path: Path,
+        tree_ish: Optional[str],
+        kind: str,
+        path: str = "",
+        *extra: Hashable) -> Optional[tuple]:
+    """
+    Make the cache key for a repository page,
+    which depends on the commit the tree_ish resolves to
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree_ish or None to use the head
+        :param kind: The page kind
+        :param path: The path in the repository, defaults to ""
+        :param extra: Any other values the page depends on
+        :return: The key, or None when the page should not be cached
+    """
+    if get_config().PAGE_CACHE_SIZE <= 0 or "_flashes" in session:
+        # pending flashed messages get rendered into the page
+        return None
+    try:
+        commit_hash = await get_commit_hash(repo_path, tree_ish or "HEAD")
+    except PathDoesNotExistInRevException:
+        return None
+    refs_fingerprint = None
+    if tree_ish != commit_hash:
+        # pages pinned to a full commit hash stay cached across pushes
+        refs_fingerprint = await asyncio.to_thread(get_refs_fingerprint, repo_path)
+    return (
+        str(repo_path), commit_hash, refs_fingerprint,
+        tree_ish, path, kind, *extra,
+    )
+
+
+def get_cached_page(key: Optional[tuple]) -> Optional[str]:
+    if key is None:
+        return None
+    return get_page_cache().get(key)
+
+
+def cache_page(key: Optional[tuple], page: str) -> str:
+    if key is not None and not g.get("render_timed_out", False):
+        get_page_cache().set(key, page)
+    return page
+
+
+async def gather_or_cancel(*aws: Awaitable) -> list:
+    """
+    Run awaitables concurrently, if one fails
+    the others are cancelled before the error is raised
+
+        :return: The results, in the order given
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def get_repo_refs(repo_path: Path) -> tuple[str, list[str], list[str]]:
+    """
+    Get the head, branches (including head) and tags of a repo
+
+        :param repo_path: The repo path
+        :raises NoBranchesException: Repo has no branches
+        :return: The head, branches and tags
+    """
+    (head, branches), tags = await gather_or_cancel(
+        get_branches(repo_path),
+        list_tags(repo_path),
+    )
+    branches = list(branches)
+    branches.append(head)
+    return head, branches, tags
 
 
 async def get_repo_view_content(
         tree_ish: str,
         repo_path: Path,
-        tree_path: Optional[str] = None) -> RepoContent:
-    head = None
-    branches = None
-    tags = None
-    root_tree = None
-    recent_log = None
+        tree_path: Optional[str] = None,
+        **fetchers: RepoFetcher) -> RepoContent:
+    """
+    Get the content shared by the repository pages,
+    all git calls are started as soon as the tree_ish is known
 
+        :param tree_ish: The tree_ish or None to use the head
+        :param repo_path: The repo path
+        :param tree_path: Path to filter the tree with, defaults to None
+        :param fetchers: Extra calls given the resolved tree_ish,
+                         their results are stored in RepoContent.extra
+        :return: The content
+    """
+    refs = asyncio.ensure_future(get_repo_refs(repo_path))
     try:
-        head, branches = await get_branches(repo_path)
-        tags = await list_tags(repo_path)
+        if tree_ish is None:
+            tree_ish = (await refs)[0]
+        try:
+            root_tree, recent_log, *extra = await gather_or_cancel(
+                ls_tree(repo_path, tree_ish, False, False, tree_path),
+                get_logs(repo_path, tree_ish, 1),
+                *(fetcher(tree_ish) for fetcher in fetchers.values()),
+            )
+        except GitException:
+            # an empty repo fails here first, let the ref lookup decide
+            await refs
+            raise
+        head, branches, tags = await refs
     except NoBranchesException:
-        pass
+        return RepoContent(tree_ish, None, None, None, None, None)
+    finally:
+        refs.cancel()
+    return RepoContent(
+        tree_ish, head, branches, tags,
+        sort_repo_tree(root_tree),
+        next(recent_log),
+        dict(zip(fetchers.keys(), extra)),
+    )
+
+
+@cache
+def get_readme_cache() -> LRUCache:
+    """
+    Get the rendered README cache, keyed by the blob hash
+    and relative url prefixes, limited by README_CACHE_SIZE
+    in characters of HTML
+
+        :return: The cache
+    """
+    return LRUCache(get_config().README_CACHE_SIZE, len)
+
+
+@cache
+def get_no_readme_cache() -> LRUCache:
+    """
+    Get the cache of commits known to have no README
+
+        :return: The cache
+    """
+    return LRUCache(MISSING_README_CACHE_COUNT)
+
+
+@cache
+def get_content_type_cache() -> LRUCache:
+    """
+    Get the cache of sniffed blob content types, keyed by blob hash
+
+        :return: The cache
+    """
+    return LRUCache(CONTENT_TYPE_CACHE_COUNT)
+
+
+def get_sniffed_content_type(info: ObjectInfo, head: bytes) -> str:
+    """
+    Sniff a blob's content type from its first bytes,
+    storing it in the content type cache
+
+        :param info: The blob info
+        :param head: The first bytes of the blob
+        :return: The content type, see 'sniff_content_type'
+    """
+    head = head[:CONTENT_SNIFF_SIZE]
+    content_type = sniff_content_type(head, info.size > len(head))
+    get_content_type_cache().set(info.object_hash, content_type)
+    return content_type
+
+
+async def read_blob_preview(
+        repo_path: Path,
+        tree_ish: str,
+        file_path: str,
+        with_content: bool = True) -> tuple[ObjectInfo, Optional[str], Optional[bytes]]:
+    """
+    Read what is needed to preview a blob in one request,
+    its type is sniffed from the first CONTENT_SNIFF_SIZE bytes
+    and the rest is only read when it is text smaller than MAX_BLOB_SIZE,
+    so a binary is never held in memory
+
+        :param repo_path: The repo path
+        :param tree_ish: The tree ish
+        :param file_path: The file path
+        :param with_content: Whether to read the content, defaults to True
+        :raises PathDoesNotExistInRevException: Object not found
+        :return: The object info, mimetype (None if not a blob)
+                 and content (None if not read)
+    """
+    async with get_cat_file_pool().process(repo_path) as process:
+        info = await process.request(f"{tree_ish}:{file_path}")
+        head = b""
+        if info.type_ != "blob":
+            mimetype = None
+        elif (content_type := get_content_type_cache().get(info.object_hash)) is None:
+            head = await process.read_content_head(info.size, CONTENT_SNIFF_SIZE)
+            mimetype = guess_mimetype(file_path, get_sniffed_content_type(info, head))
+        else:
+            mimetype = guess_mimetype(file_path, content_type)
+        if (with_content and info.size < MAX_BLOB_SIZE and
+                mimetype is not None and mimetype.startswith("text")):
+            return info, mimetype, head + await process.read_content(info.size - len(head))
+        await skip_rest_of_blob(process, info, len(head))
+        return info, mimetype, None
+
+
+async def skip_rest_of_blob(process: CatFileProcess, info: ObjectInfo, read: int):
+    """
+    Skip the unread content of a requested blob when it is smaller than
+    MAX_BLOB_SIZE, larger ones are left out of sync so the process gets replaced
+
+        :param process: The process the blob was requested from
+        :param info: The blob info
+        :param read: The number of bytes already read
+    """
+    if info.size < MAX_BLOB_SIZE:
+        await process.skip_content(info.size - read)
+
+
+async def get_blob_mimetype(repo_path: Path, info: ObjectInfo, file_path: str) -> str:
+    """
+    Guess a blob's mimetype from its file path and content,
+    reading only the first CONTENT_SNIFF_SIZE bytes when not already known
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :param file_path: The blob file path
+        :return: The guessed mimetype
+    """
+    if (content_type := get_content_type_cache().get(info.object_hash)) is None:
+        async with get_cat_file_pool().process(repo_path) as process:
+            info = await process.request(info.object_hash)
+            head = await process.read_content_head(info.size, CONTENT_SNIFF_SIZE)
+            content_type = get_sniffed_content_type(info, head)
+            await skip_rest_of_blob(process, info, len(head))
+    return guess_mimetype(file_path, content_type)
+
+
+async def sniff_blob_stream(
+        file_path: str,
+        info: ObjectInfo,
+        content: AsyncGenerator[bytes, None]) -> tuple[str, AsyncGenerator[bytes, None]]:
+    """
+    Guess a blob's mimetype, sniffing from the first chunk
+    of its content stream when not already known
+
+        :param file_path: The blob file path
+        :param info: The blob info
+        :param content: The blob content stream
+        :return: The mimetype and the content stream to send
+    """
+    if (content_type := get_content_type_cache().get(info.object_hash)) is not None:
+        return guess_mimetype(file_path, content_type), content
+    first = await anext(content, b"")
+    content_type = get_sniffed_content_type(info, first)
+
+    async def chained() -> AsyncGenerator[bytes, None]:
+        async with aclosing(content):
+            yield first
+            async for chunk in content:
+                yield chunk
+
+    return guess_mimetype(file_path, content_type), chained()
+
+
+def get_requested_byte_range(etag: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Get the byte range requested for unchanging content, only a single range
+    is supported so multiple ranges get the whole content, as does
+    an 'If-Range' that does not match the content
+
+        :param etag: The content's strong ETag
+        :param size: The content's size
+        :raises RequestedRangeNotSatisfiable: The range is outside the content
+        :return: The first byte and the byte to stop before, or None for the whole content
+    """
+    byte_range = request.range
+    if byte_range is None or byte_range.units != "bytes" or len(byte_range.ranges) != 1:
+        return None
+    if request.if_range.date is not None or request.if_range.etag not in (None, etag):
+        return None
+    if (requested := byte_range.range_for_length(size)) is None:
+        raise RequestedRangeNotSatisfiable(length=size)
+    return requested
+
+
+async def make_raw_blob_response(
+        repo_path: Path,
+        info: ObjectInfo,
+        file_path: str,
+        immutable: bool) -> Response:
+    """
+    Make the response for a raw blob, with its hash as the ETag,
+    answering 'If-None-Match', 'HEAD' and single range requests
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :param file_path: The blob file path
+        :param immutable: Whether the url always gives this blob
+        :raises RequestedRangeNotSatisfiable: The range is outside the blob
+        :return: The response
+    """
+    headers = {
+        "ETag": f'"{info.object_hash}"',
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "no-cache",
+        "Accept-Ranges": "bytes",
+    }
+    if request.if_none_match.contains_weak(info.object_hash):
+        return await make_response("", 304, headers)
+    byte_range = get_requested_byte_range(info.object_hash, info.size)
+    start, stop = byte_range or (0, info.size)
+    if request.method == "HEAD":
+        mimetype, content = await get_blob_mimetype(repo_path, info, file_path), b""
+    elif byte_range is not None:
+        mimetype = await get_blob_mimetype(repo_path, info, file_path)
+        content = iter_blob_range(repo_path, info, start, stop)
     else:
-        if tree_ish is None:
-            tree_ish = head
+        mimetype, content = await sniff_blob_stream(
+            file_path, info, stream_object(repo_path, info))
+    response = await make_response(content, 200 if byte_range is None else 206, headers)
+    response.mimetype = mimetype or "application/octet-stream"
+    response.content_length = stop - start
+    if byte_range is not None:
+        response.content_range = ContentRange("bytes", start, stop, info.size)
+    return response
 
-        branches = list(branches)
-        branches.append(head)
 
-        root_tree = await ls_tree(repo_path, tree_ish, False, False, tree_path)
-        root_tree = sort_repo_tree(root_tree)
+async def make_immutable_file_response(path: Path, etag: str, mimetype: str) -> Response:
+    """
+    Make the response for a file which never changes while it exists,
+    answering 'If-None-Match', 'HEAD' and single range requests
 
-        recent_log = next(await get_logs(repo_path, tree_ish, 1))
-    return RepoContent(tree_ish, head, branches, tags, root_tree, recent_log)
+        :param path: The file path
+        :param etag: The file's strong ETag
+        :param mimetype: The file's mimetype
+        :raises NotFound: The file does not exist
+        :raises RequestedRangeNotSatisfiable: The range is outside the file
+        :return: The response
+    """
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if request.if_none_match.contains_weak(etag):
+        return await make_response("", 304, headers)
+    try:
+        size = os.stat(path).st_size
+        byte_range = get_requested_byte_range(etag, size)
+        start, stop = byte_range or (0, size)
+        # a file removed before it is opened is a 404 too
+        content = b"" if request.method == "HEAD" else iter_file(open(path, "rb"), start, stop)
+    except FileNotFoundError:
+        abort(404)
+    response = await make_response(content, 200 if byte_range is None else 206, headers)
+    response.mimetype = mimetype
+    response.content_length = stop - start
+    if byte_range is not None:
+        response.content_range = ContentRange("bytes", start, stop, size)
+    return response
 
 
-async def try_get_readme(repo_path: Path, repo_dir: str, repo_name: str, repo_content: RepoContent) -> str:
-    readme_content = ""
-    # TODO implement more intelligent readme logic
-    if repo_content.head:
+@cache
+def get_highlight_cache() -> HighlightCache:
+    """
+    Get the highlighted blob cache, limited by HIGHLIGHT_CACHE_SIZE bytes
+    in memory and spilling to CACHE_PATH (when set) up to HIGHLIGHT_DISK_CACHE_SIZE
+
+        :return: The cache
+    """
+    disk = None
+    if get_config().CACHE_PATH is not None:
+        disk = DiskCache(
+            get_config().CACHE_PATH / "highlight",
+            get_config().HIGHLIGHT_DISK_CACHE_SIZE,
+        )
+    return HighlightCache(get_config().HIGHLIGHT_CACHE_SIZE, disk)
+
+
+async def highlight_blob(object_hash: str, content: str, file_path: str) -> str:
+    """
+    Highlight a blob based on its file path in the render pool,
+    reusing a previous result for the same blob and lexer
+
+        :param object_hash: The blob hash
+        :param content: The blob content
+        :param file_path: The blob file path
+        :return: Rendered HTML, or escaped text if highlighting is too slow
+    """
+    lexer_name = type(get_lexer_for_path(file_path)).__name__
+    cache = get_highlight_cache()
+    if (html := await cache.get(object_hash, lexer_name)) is None:
         try:
-            content = (await show_file(repo_path, repo_content.tree_ish, "README.md")).decode()
-            readme_content = render_markdown(
-                content,
-                url_for(
-                    ".get_repo_blob_file",
-                    repo_dir=repo_dir,
-                    repo_name=repo_name,
-                    tree_ish=repo_content.tree_ish,
-                    file_path=""),
-                url_for(
-                    ".get_repo_raw_file",
-                    repo_dir=repo_dir,
-                    repo_name=repo_name,
-                    tree_ish=repo_content.tree_ish,
-                    file_path="")
+            html = await render(
+                highlight_by_ext, content, file_path,
+                key=("highlight", object_hash, lexer_name),
             )
-        except PathDoesNotExistInRevException:
-            # no readme recognised
+        except RenderTimeout:
+            return escape(content)
+        await cache.set(object_hash, lexer_name, html)
+    return html
+
+
+async def highlight_blob_lines(lines: list[str], file_path: str) -> list[str]:
+    """
+    Highlight a window of lines from a blob in the render pool,
+    lexing starts at the first line so a window starting inside
+    e.g. a multi-line string may be highlighted wrongly
+
+        :param lines: The lines
+        :param file_path: The blob file path
+        :return: Rendered HTML for each line, or escaped text if highlighting is too slow
+    """
+    if lines:
+        try:
+            html_lines = await render(highlight_lines, "\n".join(lines) + "\n", file_path)
+            if len(html_lines) == len(lines):
+                return html_lines
+        except RenderTimeout:
             pass
+    return [escape(line) for line in lines]
+
+
+async def render_markdown_or_text(
+        content: str,
+        url_relative_to_blob: Optional[str] = None,
+        url_relative_to_raw: Optional[str] = None,
+        store: Optional[Callable[[str], Awaitable[None]]] = None,
+        key: Optional[Hashable] = None) -> str:
+    """
+    Render markdown in the render pool
+
+        :param content: Markdown content
+        :param url_relative_to_blob: Url to use for converting
+                                     relative paths, defaults to None
+        :param url_relative_to_raw: Url to use for converting
+                                    relative paths, defaults to None
+        :param store: Given the rendered HTML when rendered in time, defaults to None
+        :param key: Identifies the render, see 'render', defaults to None
+        :return: Rendered HTML, or escaped text if rendering is too slow
+    """
+    try:
+        html = await render(
+            render_markdown, content, url_relative_to_blob, url_relative_to_raw,
+            key=key,
+        )
+    except RenderTimeout:
+        return f"<pre>{escape(content)}</pre>"
+    if store is not None:
+        await store(html)
+    return html
+
+
+async def try_get_readme(repo_path: Path, repo_dir: str, repo_name: str, tree_ish: str) -> str:
+    # TODO implement more intelligent readme logic
+    try:
+        commit_hash = await get_commit_hash(repo_path, tree_ish)
+        no_readme_key = (str(repo_path), commit_hash)
+        if no_readme_key in get_no_readme_cache():
+            return ""
+        try:
+            info = await get_object_info(repo_path, commit_hash, "README.md")
+        except PathDoesNotExistInRevException:
+            get_no_readme_cache().set(no_readme_key, True)
+            raise
+    except PathDoesNotExistInRevException:
+        # no readme recognised
+        return ""
+
+    url_relative_to_blob = url_for(
+        ".get_repo_blob_file",
+        repo_dir=repo_dir,
+        repo_name=repo_name,
+        tree_ish=tree_ish,
+        file_path="")
+    url_relative_to_raw = url_for(
+        ".get_repo_raw_file",
+        repo_dir=repo_dir,
+        repo_name=repo_name,
+        tree_ish=tree_ish,
+        file_path="")
+    cache_key = (info.object_hash, url_relative_to_blob, url_relative_to_raw)
+
+    if (readme_content := get_readme_cache().get(cache_key)) is None:
+        async def store(readme_content: str):
+            get_readme_cache().set(cache_key, readme_content)
+
+        _, content = await read_object(repo_path, commit_hash, "README.md")
+        readme_content = await render_markdown_or_text(
+            content.decode(),
+            url_relative_to_blob,
+            url_relative_to_raw,
+            store,
+            key=("readme", *cache_key),
+        )
     return readme_content
+
+
+def get_line_window_links(first: int, last: int, line_count: int) -> dict:
+    """
+    Get the shown line window of a large blob
+    and the line ranges to navigate to from it
+
+        :param first: The first shown line, counting from 1
+        :param last: The last shown line
+        :param line_count: The blob's line count
+        :return: The window values for the blob template
+    """
+    window = {
+        "first": first, "last": last, "line_count": line_count,
+        "previous": None, "more": None, "next": None,
+    }
+    if first > 1:
+        window["previous"] = f"{max(first - BLOB_LINES_WINDOW, 1)}-{first - 1}"
+    if last < line_count:
+        window["next"] = f"{last + 1}-{last + BLOB_LINES_WINDOW}"
+        if last - first + BLOB_LINES_WINDOW < MAX_BLOB_LINES_WINDOW:
+            window["more"] = f"{first}-{last + BLOB_LINES_WINDOW}"
+    return window
+
+
+async def render_blob_lines(
+        repo_path: Path,
+        info: ObjectInfo,
+        file_path: str,
+        line_range: Optional[tuple[int, int]]) -> tuple[list[str], dict]:
+    """
+    Render a window of lines from a blob,
+    a window past the end shows the last line instead
+
+        :param repo_path: The repo path
+        :param info: The blob info
+        :param file_path: The blob file path
+        :param line_range: The lines to show, from 'parse_line_range',
+                           or None for the first BLOB_LINES_WINDOW lines
+        :return: Rendered HTML for each line and the window values for the blob template
+    """
+    start, stop = line_range or (0, BLOB_LINES_WINDOW)
+    index = await get_line_index(repo_path, info)
+    start = min(start, max(index.line_count - 1, 0))
+    stop = max(stop, start + 1)
+    lines = await highlight_blob_lines(await read_lines(repo_path, index, start, stop), file_path)
+    return lines, get_line_window_links(start + 1, start + len(lines), index.line_count)
+
+
+async def render_text_blob(
+        info: ObjectInfo,
+        content: str,
+        file_path: str,
+        mimetype: str,
+        url_relative_to_raw: str) -> tuple[str, str]:
+    """
+    Render a whole text blob, as markdown or highlighted
+
+        :param info: The blob info
+        :param content: The blob content
+        :param file_path: The blob file path
+        :param mimetype: The blob mimetype
+        :param url_relative_to_raw: Url to use for converting relative paths
+        :return: The content type for the blob template and rendered HTML
+    """
+    if mimetype.endswith("markdown"):
+        return "HTML", await render_markdown_or_text(
+            content,
+            url_relative_to_raw=url_relative_to_raw,
+            key=("markdown", info.object_hash, url_relative_to_raw),
+        )
+    return "TEXT", await highlight_blob(info.object_hash, content, file_path)
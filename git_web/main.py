@@ -5,11 +5,23 @@ from quart_auth import AuthManager, Unauthorized
 from web_health_checker.contrib import quart as health_check
 
 from . import __version__
-from .helpers import get_config
+from .helpers import format_size, get_config
+from .helpers.background import start_periodic_task, stop_background_tasks
+from .helpers.bundles import create_all_bundles, is_bundle_uri_enabled
+from .helpers.caching import remove_temp_cache_path
+from .helpers.cat_file_pool import close_cat_file_pool
+from .helpers.code_search import get_code_indexer
 from .helpers.known_mimetypes import register_extra_types
+from .helpers.maintenance import get_maintenance_scheduler, sweep_repos
+from .helpers.rendering import close_render_pool
+from .helpers.repo_index import get_repo_index
+from .helpers.streaming import StreamingHTTPConnection, StreamingRequest
 from .views import auth, directory, git_http, home, repository
 
 app = Quart(__name__)
+# request bodies are received no faster than they are read
+app.request_class = StreamingRequest
+app.asgi_http_class = StreamingHTTPConnection
 auth_manager = AuthManager()
 
 
@@ -36,6 +48,7 @@ def create_app() -> Quart:
     app.config["VERSION"] = __version__
     app.config["SHOW_SSH_PUB"] = True if get_config().SSH_PUB_KEY_PATH else False
     app.config["SHOW_SSH_AUTHORISED"] = True if get_config().SSH_AUTH_KEYS_PATH else False
+    app.add_template_filter(format_size)
     # register blueprints
     app.register_blueprint(health_check.blueprint)
     app.register_blueprint(home.blueprint)
@@ -45,6 +58,23 @@ def create_app() -> Quart:
     app.register_blueprint(git_http.blueprint)
     # register plugins
     auth_manager.init_app(app)
+
+    @app.before_serving
+    async def start_background_tasks():
+        if is_bundle_uri_enabled():
+            start_periodic_task(config.BUNDLE_INTERVAL, create_all_bundles)
+        get_maintenance_scheduler().start()
+        get_code_indexer().start()
+        if config.REPO_INDEX_INTERVAL > 0:
+            # also builds the index at startup
+            start_periodic_task(config.REPO_INDEX_INTERVAL, get_repo_index().rescan)
+        if config.MAINTENANCE_SWEEP_INTERVAL > 0:
+            start_periodic_task(config.MAINTENANCE_SWEEP_INTERVAL, sweep_repos)
+
+    app.after_serving(stop_background_tasks)
+    app.after_serving(close_cat_file_pool)
+    app.after_serving(close_render_pool)
+    app.after_serving(remove_temp_cache_path)
     # try to setup app folders
     try:
         config.REPOS_PATH.mkdir(parents=True, exist_ok=True)
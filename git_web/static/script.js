@@ -24,3 +24,64 @@ ThemeChanger.on_load();
 document.querySelectorAll("[data-dismiss='flash']").forEach(element => {
     setTimeout(() => { element.remove() }, 4000);
 });
+
+// Suggest repositories while typing a search
+document.querySelectorAll("input[data-suggest-url]").forEach(input => {
+    const suggestions = input.parentElement.querySelector(".search-suggestions");
+    let latest = 0;
+    input.addEventListener("input", async () => {
+        const request = ++latest;
+        const url = new URL(input.dataset.suggestUrl, document.location);
+        url.searchParams.set("q", input.value);
+        const response = await fetch(url);
+        // an earlier request may answer after a later one
+        if (request !== latest || !response.ok) { return }
+        suggestions.replaceChildren(...(await response.json()).map(repo => {
+            const link = document.createElement("a");
+            link.href = repo.url;
+            link.className = "bnt";
+            link.title = repo.description;
+            link.textContent = `${repo.directory}/${repo.name}`;
+            return link;
+        }));
+    });
+});
+
+// Follow a link by pressing its key, e.g. "t" to find a file
+document.addEventListener("keydown", event => {
+    if (event.ctrlKey || event.metaKey || event.altKey || event.target.closest("input, textarea, select")) {
+        return;
+    }
+    const link = document.querySelector(`a[data-hotkey="${CSS.escape(event.key)}"]`);
+    if (link) {
+        event.preventDefault();
+        document.location.assign(link.href);
+    }
+});
+
+// Find files while typing, opening the best match on enter
+document.querySelectorAll("input[data-find-url]").forEach(input => {
+    const found = input.form.parentElement.querySelector(".found-files");
+    let latest = 0;
+    input.addEventListener("input", async () => {
+        const request = ++latest;
+        const url = new URL(input.dataset.findUrl, document.location);
+        url.searchParams.set("q", input.value);
+        const response = await fetch(url);
+        // an earlier request may answer after a later one
+        if (request !== latest || !response.ok) { return }
+        found.replaceChildren(...(await response.json()).map(file => {
+            const link = document.createElement("a");
+            link.href = file.url;
+            link.textContent = file.path;
+            return link;
+        }));
+    });
+    input.form.addEventListener("submit", event => {
+        const best = found.querySelector("a");
+        if (best) {
+            event.preventDefault();
+            document.location.assign(best.href);
+        }
+    });
+});
@@ -2,9 +2,11 @@ from quart import Blueprint, abort, redirect, render_template, request, url_for
 from quart.helpers import flash
 from quart_auth import login_required
 
-from ..helpers.calculations import find_dirs, find_repos, safe_combine_full_dir
+from ..helpers.calculations import safe_combine_full_dir
 from ..helpers.checkers import (does_path_contain, is_name_reserved,
                                 is_valid_directory_name)
+from ..helpers.constants import SEARCH_RESULTS_LIMIT, SEARCH_SUGGESTIONS_LIMIT
+from ..helpers.repo_index import REPO_SORT_KEYS, get_repo_index
 from ..helpers.requests import ensure_repo_dir_path_valid
 
 blueprint = Blueprint("directory", __name__)
@@ -15,10 +17,37 @@ blueprint = Blueprint("directory", __name__)
 async def get_dir_list():
     return await render_template(
         "directory/directories.html",
-        dir_paths=sorted(find_dirs()),
+        dir_paths=await get_repo_index().get_dirs(),
     )
 
 
+@blueprint.get("/search")
+@login_required
+async def get_search():
+    search_query = request.args.get("q", "").strip()
+    repos = await get_repo_index().search(search_query, SEARCH_RESULTS_LIMIT)
+    return await render_template(
+        "directory/search.html",
+        repos=repos,
+        search_query=search_query,
+    )
+
+
+@blueprint.get("/search/suggest")
+@login_required
+async def get_search_suggestions():
+    repos = await get_repo_index().search(request.args.get("q", ""), SEARCH_SUGGESTIONS_LIMIT)
+    return [
+        {
+            "directory": repo.directory,
+            "name": repo.name,
+            "description": repo.description,
+            "url": url_for("repository.repo_view", repo_dir=repo.directory, repo_name=repo.name),
+        }
+        for repo in repos
+    ]
+
+
 @blueprint.get("/new-dir")
 @login_required
 async def get_new_dir():
@@ -69,28 +98,32 @@ async def get_dir_delete(directory: str):
 @login_required
 async def repo_list(directory):
     search_query = request.args.get("q", "").strip()
+    sort = request.args.get("sort", "name")
+    if sort not in REPO_SORT_KEYS:
+        abort(400, "unknown sort")
 
-    directory_absolute = ensure_repo_dir_path_valid(directory)
+    ensure_repo_dir_path_valid(directory)
 
-    repo_paths = find_repos(directory_absolute, True)
+    repos = await get_repo_index().get_repos(directory)
 
     if search_query:
         # only filter repo list if search was entered
-        repo_paths = filter(lambda path: does_path_contain(path, search_query), repo_paths)
+        repos = filter(lambda repo: does_path_contain(repo.path, search_query), repos)
 
-    repo_paths = tuple(sorted(repo_paths))
+    repos = sorted(repos, key=REPO_SORT_KEYS[sort])
 
     # if there is only one repo left navigate to it instead
-    if len(repo_paths) == 1:
+    if len(repos) == 1:
         return redirect(url_for(
             "repository.repo_view",
             repo_dir=directory,
-            repo_name=repo_paths[0].stem
+            repo_name=repos[0].name
         ))
 
     return await render_template(
         "directory/repos.html",
         directory=directory,
-        repo_paths=repo_paths,
-        search_query=search_query
+        repos=repos,
+        search_query=search_query,
+        sort=sort,
     )
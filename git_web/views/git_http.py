@@ -2,15 +2,29 @@
 Methods for supporting git's 'Smart HTTP' protocol
 """
 from functools import wraps
+from pathlib import Path
+from typing import AsyncGenerator, Optional, Union
 
-from git_interface.pack import ALLOWED_PACK_TYPES
-from git_interface.smart_http.quart import (get_info_refs_response,
-                                            post_pack_response)
-from quart import Blueprint, abort, current_app, request
+from git_interface.pack import ALLOWED_PACK_TYPES, UPLOAD_PACK_TYPE
+from quart import Blueprint, Response, abort, current_app, make_response, request
+from quart.wrappers.response import IterableBody, ResponseBody
 from quart_auth import basic_auth_required as git_auth_required
 
+from ..helpers.admission import admitted_response
+from ..helpers.caching import invalidate_repo
 from ..helpers.config import get_config
+from ..helpers.bundles import BUNDLE_SUFFIX, get_bundle_directory
+from ..helpers.checkers import is_commit_hash
+from ..helpers.maintenance import get_maintenance_scheduler
+from ..helpers.packs import (PACK_REQUEST_BUFFER_SIZE, exchange_pack,
+                             get_advertisement,
+                             get_bundle_uri_response, get_pack_disk_cache,
+                             get_pack_name, is_bundle_uri_request,
+                             is_final_pack_request, is_protocol_v2,
+                             is_valid_git_protocol, open_pack)
 from ..helpers.requests import ensure_repo_path_valid
+from ..helpers.streaming import buffer_body, decode_body, start_stream
+from ..helpers.views import make_immutable_file_response
 
 blueprint = Blueprint("git_http", __name__)
 
@@ -24,6 +38,83 @@ def require_http_git_enabled(func):
     return wrapper
 
 
+def get_git_protocol() -> Optional[str]:
+    """
+    Get the 'Git-Protocol' header, which asks for a protocol version
+    """
+    protocol = request.headers.get("Git-Protocol")
+    if protocol is not None and not is_valid_git_protocol(protocol):
+        abort(400, "invalid 'Git-Protocol' header")
+    return protocol
+
+
+async def make_pack_response(
+        content: Union[bytes, AsyncGenerator[bytes, None]],
+        content_type: str) -> Response:
+    if not isinstance(content, bytes):
+        # git fails or the request is refused as an error response, not a cut off one
+        content = await start_stream(content)
+    response = await make_response(content)
+    response.content_type = content_type
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["Expires"] = "0"
+    # a large clone takes as long as the client takes to receive it
+    response.timeout = None
+    return response
+
+
+async def make_upload_pack_response(
+        repo_path: Path,
+        content: Union[bytes, AsyncGenerator[bytes, None]],
+        protocol: Optional[str]) -> Response:
+    """
+    Make the response to an upload-pack request, the pack
+    sent once negotiation is done is cached by request
+    """
+    content_type = f"application/x-{UPLOAD_PACK_TYPE}-result"
+    if not isinstance(content, bytes):
+        # too large to read whole, so streamed to git and not cached
+        return await admitted_response("fetch", lambda: make_pack_response(
+            exchange_pack(repo_path, UPLOAD_PACK_TYPE, content, protocol),
+            content_type,
+        ))
+    if is_protocol_v2(protocol) and is_bundle_uri_request(content):
+        return await make_pack_response(get_bundle_uri_response(repo_path), content_type)
+    if not is_final_pack_request(content):
+        return await admitted_response("fetch", lambda: make_pack_response(
+            exchange_pack(repo_path, UPLOAD_PACK_TYPE, content, protocol),
+            content_type,
+        ))
+
+    async def make_cached_pack_response():
+        size, pack = await open_pack(repo_path, content, protocol)
+        response = await make_pack_response(pack, content_type)
+        if size is not None:
+            response.content_length = size
+        return response
+
+    if get_pack_name(repo_path, content, protocol) in get_pack_disk_cache():
+        return await make_cached_pack_response()
+    return await admitted_response("fetch", make_cached_pack_response)
+
+
+async def invalidate_after_push(
+        repo_path: Path,
+        body: ResponseBody) -> AsyncGenerator[bytes, None]:
+    """
+    Pass through a receive-pack response body, invalidating
+    the repository's caches once the push has finished
+    and counting it towards the repository's maintenance
+    """
+    try:
+        async with body as content:
+            async for chunk in content:
+                yield chunk
+    finally:
+        invalidate_repo(repo_path)
+        get_maintenance_scheduler().record_push(repo_path)
+
+
 @blueprint.post("/<repo_dir>/<repo_name>.git/<pack_type>")
 @require_http_git_enabled
 @git_auth_required()
@@ -31,7 +122,22 @@ async def post_pack(repo_dir: str, repo_name: str, pack_type: str):
     if pack_type not in ALLOWED_PACK_TYPES:
         abort(404)
     repo_path = ensure_repo_path_valid(repo_dir, repo_name)
-    return await post_pack_response(repo_path, pack_type)
+    protocol = get_git_protocol()
+    max_size = get_config().HTTP_GIT_MAX_BODY_SIZE
+    if request.content_length is not None and request.content_length > max_size:
+        abort(413, f"Request body is larger than {max_size} bytes")
+    # decoded as it is received, as git gzips larger fetch requests
+    body = decode_body(request.body, request.headers.get("Content-Encoding"), max_size)
+    if pack_type == UPLOAD_PACK_TYPE:
+        # usually only wanted and common commits, so small enough to read at once
+        content = await buffer_body(body, PACK_REQUEST_BUFFER_SIZE)
+        return await make_upload_pack_response(repo_path, content, protocol)
+    response = await admitted_response("push", lambda: make_pack_response(
+        exchange_pack(repo_path, pack_type, body, protocol),
+        f"application/x-{pack_type}-result",
+    ))
+    response.response = IterableBody(invalidate_after_push(repo_path, response.response))
+    return response
 
 
 @blueprint.get("/<repo_dir>/<repo_name>.git/info/refs")
@@ -42,4 +148,31 @@ async def get_info_refs(repo_dir: str, repo_name: str):
     pack_type = request.args.get("service")
     if pack_type not in ALLOWED_PACK_TYPES:
         abort(403)
-    return await get_info_refs_response(repo_path, pack_type)
+    content, gzipped = await get_advertisement(repo_path, pack_type, get_git_protocol())
+    content_type = f"application/x-{pack_type}-advertisement"
+    if "gzip" not in request.accept_encodings:
+        response = await make_pack_response(content, content_type)
+    else:
+        response = await make_pack_response(gzipped, content_type)
+        response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@blueprint.get("/<repo_dir>/<repo_name>.git/bundles/<bundle_name>")
+@require_http_git_enabled
+@git_auth_required()
+async def get_bundle(repo_dir: str, repo_name: str, bundle_name: str):
+    repo_path = ensure_repo_path_valid(repo_dir, repo_name)
+    commit_hash = bundle_name.removesuffix(BUNDLE_SUFFIX)
+    if commit_hash == bundle_name or not is_commit_hash(commit_hash):
+        abort(404)
+    # named by commit, so the same name always has the same content
+    response = await make_immutable_file_response(
+        get_bundle_directory(repo_path) / bundle_name,
+        commit_hash,
+        "application/x-git-bundle",
+    )
+    # a large bundle takes as long as the client takes to receive it
+    response.timeout = None
+    return response
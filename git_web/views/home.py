@@ -4,6 +4,9 @@ from quart_auth import login_required
 from werkzeug.exceptions import abort
 
 from ..helpers import get_config
+from ..helpers.admission import get_admission_controller
+from ..helpers.code_search import get_code_indexer
+from ..helpers.maintenance import get_maintenance_scheduler
 
 blueprint = Blueprint("home", __name__)
 
@@ -13,6 +16,16 @@ async def index():
     return await render_template("home/index.html")
 
 
+@blueprint.get("/stats")
+@login_required
+async def get_stats():
+    return {
+        "admission": get_admission_controller().get_stats(),
+        "maintenance": get_maintenance_scheduler().get_stats(),
+        "code_search": get_code_indexer().get_stats(),
+    }
+
+
 @blueprint.get("/settings")
 @login_required
 async def get_settings():
@@ -1,37 +1,51 @@
+import re
 import shutil
 from pathlib import Path
+from typing import Optional
 
-from git_interface.archive import get_archive_buffered
 from git_interface.branch import delete_branch, get_branches, new_branch
-from git_interface.cat_file import get_object_size
-from git_interface.datatypes import ArchiveTypes
 from git_interface.exceptions import (AlreadyExistsException, GitException,
                                       NoBranchesException,
                                       PathDoesNotExistInRevException,
-                                      UnknownRefException,
-                                      UnknownRevisionException)
-from git_interface.log import get_logs
-from git_interface.rev_list import get_commit_count
-from git_interface.show import show_file, show_file_buffered
+                                      UnknownRefException)
 from git_interface.symbolic_ref import change_active_branch
-from git_interface.tag import list_tags
 from git_interface.utils import (clone_repo, get_description, init_repo,
-                                 run_maintenance, set_description)
+                                 set_description)
 from quart import (Blueprint, abort, make_response, redirect, render_template,
                    request, url_for)
 from quart.helpers import flash
 from quart_auth import login_required
+from werkzeug.utils import secure_filename
 
-from ..helpers import (MAX_BLOB_SIZE, UnknownBranchName, create_ssh_uri,
-                       find_dirs, get_config, guess_mimetype, highlight_by_ext,
-                       is_commit_hash, is_name_reserved, is_valid_clone_url,
+from ..helpers import (UnknownBranchName, create_ssh_uri, decode_text,
+                       find_dirs, get_config, is_commit_hash,
+                       is_name_reserved, is_valid_clone_url,
                        is_valid_directory_name, is_valid_repo_name,
-                       path_to_tree_components, pathlib_delete_ro_file,
-                       render_markdown, safe_combine_full_dir)
+                       parse_line_range, path_to_tree_components,
+                       pathlib_delete_ro_file, safe_combine_full_dir)
+from ..helpers.admission import (admission_required, admitted,
+                                 admitted_response)
+from ..helpers.archives import (ARCHIVE_LEVELS, get_archive_disk_cache,
+                                get_archive_name, is_archive_format_available,
+                                open_archive)
+from ..helpers.caching import invalidate_repo
 from ..helpers.calculations import (create_git_http_uri,
                                     safe_combine_full_dir_repo)
+from ..helpers.cat_file_pool import get_commit_hash, get_object_info
+from ..helpers.code_search import get_code_indexer, search_code
+from ..helpers.commit_count import get_commit_count
+from ..helpers.commit_log import CommitLogPage, get_commit_log, read_log_page
+from ..helpers.constants import (CODE_SEARCH_RESULTS_LIMIT,
+                                 FILE_FINDER_RESULTS_LIMIT)
+from ..helpers.file_finder import find_paths, get_path_list
+from ..helpers.maintenance import get_maintenance_scheduler
 from ..helpers.requests import ensure_repo_path_valid
-from ..helpers.views import get_repo_view_content, try_get_readme
+from ..helpers.views import (IMMUTABLE_CACHE_CONTROL, cache_page,
+                             gather_or_cancel, get_cached_page,
+                             get_page_cache_key, get_repo_refs,
+                             get_repo_view_content, make_raw_blob_response,
+                             read_blob_preview, render_blob_lines,
+                             render_text_blob, try_get_readme)
 
 blueprint = Blueprint("repository", __name__)
 
@@ -143,7 +157,8 @@ async def post_import_repo():
             await flash("Invalid repo url given", "error")
             return redirect(url_for(".get_import_repo"))
 
-        await clone_repo(full_repo_path, url, True)
+        async with admitted("maintenance"):
+            await clone_repo(full_repo_path, url, True)
     except KeyError:
         abort(400, "missing required values")
     except ValueError:
@@ -157,21 +172,31 @@ async def post_import_repo():
 @blueprint.route("/<repo_dir>/<repo_name>", defaults={"tree_ish": None})
 @blueprint.route("/<repo_dir>/<repo_name>/tree/<tree_ish>")
 @login_required
+@admission_required("interactive")
 async def repo_view(repo_dir: str, repo_name: str, tree_ish: str):
     try:
         repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
+        cache_key = await get_page_cache_key(repo_path, tree_ish, "repo")
+        if (page := get_cached_page(cache_key)) is not None:
+            return page
+
         ssh_url = create_ssh_uri(repo_path)
         http_url = create_git_http_uri(repo_path)
 
-        repo_content = await get_repo_view_content(tree_ish, repo_path)
-        commit_count = await get_commit_count(repo_path, repo_content.tree_ish)
-
-        readme_content = await try_get_readme(repo_path, repo_dir, repo_name, repo_content)
+        repo_content, repo_description = await gather_or_cancel(
+            get_repo_view_content(
+                tree_ish, repo_path,
+                commit_count=lambda tree_ish: get_commit_count(repo_path, tree_ish),
+                readme_content=lambda tree_ish: try_get_readme(
+                    repo_path, repo_dir, repo_name, tree_ish),
+            ),
+            get_description(repo_path),
+        )
     except UnknownBranchName:
         abort(404)
     else:
-        return await render_template(
+        return cache_page(cache_key, await render_template(
             "repository/repository.html",
             repo_dir=repo_dir,
             repo_name=repo_name,
@@ -181,17 +206,19 @@ async def repo_view(repo_dir: str, repo_name: str, tree_ish: str):
             tags=repo_content.tags,
             ssh_url=ssh_url,
             http_url=http_url,
-            repo_description=await get_description(repo_path),
+            repo_description=repo_description,
             root_tree=repo_content.root_tree,
-            readme_content=readme_content,
+            readme_content=repo_content.extra.get("readme_content", ""),
             recent_log=repo_content.recent_log,
             tree_path="",
-            commit_count=commit_count,
-        )
+            commit_count=repo_content.extra.get("commit_count"),
+            code_search_enabled=get_code_indexer().is_enabled,
+        ))
 
 
 @blueprint.get("/<repo_dir>/<repo_name>/tree/<tree_ish>/<path:tree_path>")
 @login_required
+@admission_required("interactive")
 async def get_repo_tree(repo_dir: str, repo_name: str, tree_ish: str, tree_path: str):
     try:
         repo_path = ensure_repo_path_valid(repo_dir, repo_name)
@@ -199,6 +226,10 @@ async def get_repo_tree(repo_dir: str, repo_name: str, tree_ish: str, tree_path:
         if not tree_path.endswith("/"):
             tree_path += "/"
 
+        cache_key = await get_page_cache_key(repo_path, tree_ish, "tree", tree_path)
+        if (page := get_cached_page(cache_key)) is not None:
+            return page
+
         repo_content = await get_repo_view_content(tree_ish, repo_path, tree_path)
 
         split_path = path_to_tree_components(Path(tree_path))
@@ -206,7 +237,7 @@ async def get_repo_tree(repo_dir: str, repo_name: str, tree_ish: str, tree_path:
     except UnknownBranchName:
         abort(404)
     else:
-        return await render_template(
+        return cache_page(cache_key, await render_template(
             "repository/tree.html",
             repo_dir=repo_dir,
             repo_name=repo_name,
@@ -218,24 +249,134 @@ async def get_repo_tree(repo_dir: str, repo_name: str, tree_ish: str, tree_path:
             recent_log=repo_content.recent_log,
             tree_path=tree_path,
             split_path=split_path,
-        )
+        ))
+
+
+@blueprint.get("/<repo_dir>/<repo_name>/search")
+@login_required
+@admission_required("interactive")
+async def repo_code_search(repo_dir: str, repo_name: str):
+    repo_path = ensure_repo_path_valid(repo_dir, repo_name)
+    indexer = get_code_indexer()
+    if not indexer.is_enabled:
+        abort(404)
+
+    search_query = request.args.get("q", "")
+    path_query = request.args.get("path", "")
+    is_regex = request.args.get("regex") == "1"
+
+    results = None
+    is_stale = False
+    if search_query:
+        try:
+            results = await search_code(
+                repo_path, search_query, is_regex, path_query, CODE_SEARCH_RESULTS_LIMIT)
+        except re.error as err:
+            abort(400, f"invalid regular expression: {err}")
+        try:
+            is_stale = results is None or results.commit_hash != await get_commit_hash(
+                repo_path, "HEAD")
+        except PathDoesNotExistInRevException:
+            # no commits yet
+            pass
+        if is_stale:
+            indexer.enqueue(repo_path)
+
+    return await render_template(
+        "repository/code_search.html",
+        repo_dir=repo_dir,
+        repo_name=repo_name,
+        search_query=search_query,
+        path_query=path_query,
+        is_regex=is_regex,
+        results=results,
+        is_stale=is_stale,
+    )
+
+
+async def find_repo_files(repo_path: Path, tree_ish: str, query: str) -> list[str]:
+    try:
+        commit_hash = await get_commit_hash(repo_path, tree_ish)
+    except PathDoesNotExistInRevException:
+        abort(404)
+    if not query.strip():
+        return []
+    path_list = await get_path_list(repo_path, commit_hash)
+    return await find_paths(path_list, query, FILE_FINDER_RESULTS_LIMIT)
+
+
+@blueprint.get("/<repo_dir>/<repo_name>/find/<tree_ish>")
+@login_required
+@admission_required("interactive")
+async def get_repo_file_finder(repo_dir: str, repo_name: str, tree_ish: str):
+    repo_path = ensure_repo_path_valid(repo_dir, repo_name)
+    search_query = request.args.get("q", "")
+    paths = await find_repo_files(repo_path, tree_ish, search_query)
+    return await render_template(
+        "repository/find_file.html",
+        repo_dir=repo_dir,
+        repo_name=repo_name,
+        curr_tree_ish=tree_ish,
+        search_query=search_query,
+        paths=paths,
+    )
+
+
+@blueprint.get("/<repo_dir>/<repo_name>/find/<tree_ish>/suggest")
+@login_required
+@admission_required("interactive")
+async def get_repo_file_suggestions(repo_dir: str, repo_name: str, tree_ish: str):
+    repo_path = ensure_repo_path_valid(repo_dir, repo_name)
+    paths = await find_repo_files(repo_path, tree_ish, request.args.get("q", ""))
+    return [
+        {
+            "path": path,
+            "url": url_for(
+                ".get_repo_blob_file",
+                repo_dir=repo_dir, repo_name=repo_name, tree_ish=tree_ish, file_path=path,
+            ),
+        }
+        for path in paths
+    ]
+
+
+def get_requested_line_range() -> Optional[tuple[int, int]]:
+    if (line_range := request.args.get("lines")) is None:
+        return None
+    try:
+        return parse_line_range(line_range)
+    except ValueError:
+        abort(400, "invalid line range given")
 
 
 @blueprint.get("/<repo_dir>/<repo_name>/blob/<tree_ish>/<path:file_path>")
 @login_required
+@admission_required("interactive")
 async def get_repo_blob_file(repo_dir: str, repo_name: str, tree_ish: str, file_path: str):
     try:
         repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
         file_path = file_path.replace("\\", "/")  # fixes issue when running server on Windows
-        repo_content = await get_repo_view_content(tree_ish, repo_path, file_path)
+
+        line_range = get_requested_line_range()
+
+        cache_key = await get_page_cache_key(repo_path, tree_ish, "blob", file_path, line_range)
+        if (page := get_cached_page(cache_key)) is not None:
+            return page
+
+        repo_content = await get_repo_view_content(
+            tree_ish, repo_path, file_path,
+            # with a line range only the requested lines are read
+            blob=lambda tree_ish: read_blob_preview(
+                repo_path, tree_ish, file_path, line_range is None),
+        )
+        info, mimetype, raw_content = repo_content.extra["blob"]
 
         split_path = path_to_tree_components(Path(file_path))
 
         content_type = None
         content = None
-
-        mimetype = guess_mimetype(file_path)
+        line_window = None
 
         if mimetype == None:
             pass
@@ -247,26 +388,24 @@ async def get_repo_blob_file(repo_dir: str, repo_name: str, tree_ish: str, file_
                 file_path=file_path
             )
         elif mimetype.startswith("text"):
-            if await get_object_size(repo_path, repo_content.tree_ish, file_path) < MAX_BLOB_SIZE:
-                content = (await show_file(repo_path, repo_content.tree_ish, file_path)).decode()
-
-                if mimetype.endswith("markdown"):
-                    content_type = "HTML"
-                    content = render_markdown(
-                        content,
-                        url_relative_to_raw=url_for(
-                            ".get_repo_raw_file",
-                            repo_dir=repo_dir,
-                            repo_name=repo_name,
-                            tree_ish=repo_content.tree_ish,
-                            file_path=""
-                        )
-                    )
-                else:
-                    content_type = "TEXT"
-                    content = highlight_by_ext(content, file_path)
-
-        return await render_template(
+            if raw_content is None:
+                # too large to show whole, show a window of lines instead
+                content_type = "LINES"
+                content, line_window = await render_blob_lines(
+                    repo_path, info, file_path, line_range)
+            else:
+                content_type, content = await render_text_blob(
+                    info, decode_text(raw_content), file_path, mimetype,
+                    url_for(
+                        ".get_repo_raw_file",
+                        repo_dir=repo_dir,
+                        repo_name=repo_name,
+                        tree_ish=repo_content.tree_ish,
+                        file_path=""
+                    ),
+                )
+
+        return cache_page(cache_key, await render_template(
             "repository/blob.html",
                 repo_dir=repo_dir,
                 repo_name=repo_name,
@@ -279,8 +418,9 @@ async def get_repo_blob_file(repo_dir: str, repo_name: str, tree_ish: str, file_
                 tree_path=file_path,
                 content_type=content_type,
                 content=content,
+                line_window=line_window,
                 split_path=split_path
-        )
+        ))
     except PathDoesNotExistInRevException:
         abort(404)
 
@@ -293,18 +433,23 @@ async def get_repo_raw_file(repo_dir: str, repo_name: str, tree_ish: str, file_p
 
         file_path = file_path.replace("\\", "/")  # fixes issue when running server on Windows
 
-        content = show_file_buffered(repo_path, tree_ish, file_path)
-        raw_response = await make_response(content)
-        mimetype = guess_mimetype(file_path)
-        raw_response.mimetype = mimetype if mimetype is not None else "application/octet-stream"
+        info, commit_hash = await gather_or_cancel(
+            get_object_info(repo_path, tree_ish, file_path),
+            get_commit_hash(repo_path, tree_ish),
+        )
+        if info.type_ != "blob":
+            abort(404)
 
-        return raw_response
+        # a url with a full commit hash always gives the same blob
+        return await make_raw_blob_response(
+            repo_path, info, file_path, tree_ish == commit_hash)
     except PathDoesNotExistInRevException:
         abort(404)
 
 
 @blueprint.get("/<repo_dir>/<repo_name>/settings")
 @login_required
+@admission_required("interactive")
 async def repo_settings(repo_dir: str, repo_name: str):
     repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
@@ -345,6 +490,7 @@ async def post_repo_change_head(repo_dir: str, repo_name: str):
             raise UnknownRefException()
         else:
             await change_active_branch(repo_path, new_head)
+            invalidate_repo(repo_path)
     except KeyError:
         await flash("missing required fields 'repo-head'", "error")
     except NoBranchesException:
@@ -368,6 +514,7 @@ async def repo_branch_new(repo_dir: str, repo_name: str):
             await flash("Branch name not valid", "error")
         else:
             await new_branch(repo_path, branch_name)
+            invalidate_repo(repo_path)
             await flash(f"Branch '{branch_name}' created", "ok")
     except AlreadyExistsException:
         await flash(f"Branch '{branch_name}' already exists", "error")
@@ -389,6 +536,7 @@ async def repo_branch_delete(repo_dir: str, repo_name: str):
             await flash("Branch name not valid", "error")
         else:
             await delete_branch(repo_path, branch_name)
+            invalidate_repo(repo_path)
             await flash(f"branch {branch_name} deleted", "ok")
     except (GitException, NoBranchesException):
         await flash("Cannot delete provided branch name", "error")
@@ -407,6 +555,7 @@ async def repo_move(repo_dir: str, repo_name: str):
         await flash("invalid directory given", "error")
         return redirect(url_for(".repo_settings", repo_dir=repo_dir, repo_name=repo_name))
     shutil.move(repo_path, safe_combine_full_dir_repo(new_dir, repo_name))
+    invalidate_repo(repo_path)
     await flash(f"moved repository to: {new_dir}/{repo_name}", "ok")
     return redirect(url_for(".repo_view", repo_dir=new_dir, repo_name=repo_name))
 
@@ -417,6 +566,7 @@ async def repo_delete(repo_dir: str, repo_name: str):
     repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
     shutil.rmtree(repo_path, onerror=pathlib_delete_ro_file)
+    invalidate_repo(repo_path)
     return redirect(url_for("directory.repo_list", directory=repo_dir))
 
 
@@ -429,6 +579,7 @@ async def repo_set_description(repo_dir: str, repo_name: str):
         new_description: str = (await request.form)["repo-description"]
         new_description = new_description.strip()
         await set_description(repo_path, new_description)
+        invalidate_repo(repo_path)
         await flash("new description set", "ok")
     except KeyError:
         await flash("missing repo-description field", "error")
@@ -453,6 +604,7 @@ async def repo_set_name(repo_dir: str, repo_name: str):
             await flash("Repo name is reserved", "error")
         else:
             repo_path.rename(safe_combine_full_dir_repo(repo_dir, new_name))
+            invalidate_repo(repo_path)
     except KeyError:
         await flash("missing 'repo-name' field", "error")
     finally:
@@ -464,77 +616,129 @@ async def repo_set_name(repo_dir: str, repo_name: str):
 async def repo_maintenance_run(repo_dir: str, repo_name: str):
     repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
-    await run_maintenance(repo_path)
-    await flash("maintenance running", "ok")
+    # run in the background, so the request doesn't wait for it
+    get_maintenance_scheduler().enqueue(repo_path, forced=True)
+    await flash("maintenance queued", "ok")
     return redirect(url_for(".repo_settings", repo_dir=repo_dir, repo_name=repo_name))
 
 
+async def read_commit_log_page(
+        repo_path: Path,
+        tree_ish: str,
+        after: Optional[str],
+        before: Optional[str]) -> Optional[CommitLogPage]:
+    try:
+        commit_hash = await get_commit_hash(repo_path, tree_ish)
+        if after or before:
+            # paged from by full hash, even when given abbreviated
+            from_hash = await get_commit_hash(repo_path, after or before)
+    except PathDoesNotExistInRevException:
+        return None
+    commit_log = await get_commit_log(repo_path, tree_ish, commit_hash)
+    return await read_log_page(
+        repo_path,
+        commit_log,
+        get_config().MAX_COMMIT_LOG_COUNT,
+        after=from_hash if after else None,
+        before=from_hash if before and not after else None,
+    )
+
+
 @blueprint.route("/<repo_dir>/<repo_name>/commits/<tree_ish>")
 @login_required
+@admission_required("interactive")
 async def repo_commit_log(repo_dir: str, repo_name: str, tree_ish: str):
-    try:
-        repo_path = ensure_repo_path_valid(repo_dir, repo_name)
+    repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
-        head = None
-        branches = None
-        tags = None
+    after_commit_hash = request.args.get("after")
+    before_commit_hash = request.args.get("before")
+    for commit_hash in (after_commit_hash, before_commit_hash):
+        if commit_hash and not is_commit_hash(commit_hash):
+            abort(400, "Invalid after or before param argument")
 
+    cache_key = await get_page_cache_key(
+        repo_path, tree_ish, "commits", "", after_commit_hash, before_commit_hash)
+    if (page := get_cached_page(cache_key)) is not None:
+        return page
+
+    async def get_refs():
         try:
-            head, branches = await get_branches(repo_path)
-            tags = await list_tags(repo_path)
+            return await get_repo_refs(repo_path)
         except NoBranchesException:
-            pass
-        else:
-            if tree_ish is None:
-                tree_ish = head
+            return None, None, None
 
-            branches = list(branches)
-            branches.append(head)
+    (head, branches, tags), log_page = await gather_or_cancel(
+        get_refs(),
+        read_commit_log_page(repo_path, tree_ish, after_commit_hash, before_commit_hash),
+    )
 
-        rev_range = tree_ish
-        after_commit_hash = request.args.get("after")
-        if after_commit_hash:
-            if is_commit_hash(after_commit_hash):
-                rev_range = f"{after_commit_hash}^"
-            else:
-                abort(400, "Invalid after param argument")
+    return cache_page(cache_key, await render_template(
+        "repository/commit_log.html",
+        log_page=log_page,
+        logs=log_page.logs if log_page else (),
+        curr_tree_ish=tree_ish,
+        branches=branches,
+        tags=tags,
+        head=head,
+        repo_dir=repo_dir,
+        repo_name=repo_name,
+    ))
 
-        try:
-            logs = tuple(await get_logs(repo_path, rev_range,
-                        get_config().MAX_COMMIT_LOG_COUNT))
-        except UnknownRevisionException:
-            logs = tuple()
-
-        last_commit_hash = None
-        if len(logs) > 0:
-            if logs[-1].parent_hash:
-                last_commit_hash = logs[-1].commit_hash
-
-        return await render_template(
-            "repository/commit_log.html",
-            logs=logs,
-            curr_tree_ish=tree_ish,
-            branches=branches,
-            tags=tags,
-            head=head,
-            repo_dir=repo_dir,
-            repo_name=repo_name,
-            last_commit_hash=last_commit_hash,
-        )
-    except UnknownRevisionException:
+
+def get_requested_archive_level(archive_type: str) -> Optional[int]:
+    if (level := request.args.get("level")) is None:
+        return None
+    if not level.isdigit() or int(level) not in ARCHIVE_LEVELS[archive_type]:
+        abort(400, "invalid compression level given")
+    return int(level)
+
+
+async def get_archive_object_hash(repo_path: Path, commit_hash: str, path: str) -> str:
+    if not path:
+        return commit_hash
+    info = await get_object_info(repo_path, commit_hash, path)
+    if info.type_ != "tree":
         abort(404)
+    return info.object_hash
 
 
 @blueprint.route("/<repo_dir>/<repo_name>/archive.<archive_type>")
 @login_required
 async def repo_archive(repo_dir: str, repo_name: str, archive_type: str):
     try:
-        archive_type_type = ArchiveTypes(archive_type)
+        if not is_archive_format_available(archive_type):
+            abort(404)
         repo_path = ensure_repo_path_valid(repo_dir, repo_name)
 
-        content = get_archive_buffered(repo_path, archive_type_type)
-        response = await make_response(content)
-        response.mimetype = "application/" + archive_type
-        return response
-    except ValueError:
+        tree_ish = request.args.get("tree_ish")
+        path = request.args.get("path", "").strip("/")
+        level = get_requested_archive_level(archive_type)
+        commit_hash = await get_commit_hash(repo_path, tree_ish or "HEAD")
+        # only the tree at path is archived, with its content at the top
+        object_hash = await get_archive_object_hash(repo_path, commit_hash, path)
+        etag = get_archive_name(object_hash, archive_type, level)
+        filename = "-".join(filter(None, (repo_name, tree_ish, path)))
+        filename = f"{secure_filename(filename)}.{archive_type}"
+        headers = {
+            "ETag": f'"{etag}"',
+            # a url with a full commit hash always gives the same archive
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if tree_ish == commit_hash else "no-cache",
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        }
+        if request.if_none_match.contains_weak(etag):
+            return await make_response("", 304, headers)
+
+        async def make_archive_response():
+            size, content = await open_archive(repo_path, object_hash, archive_type, level)
+            response = await make_response(content, 200, headers)
+            response.mimetype = "application/" + archive_type
+            if size is not None:
+                response.content_length = size
+            return response
+
+        if etag in get_archive_disk_cache():
+            return await make_archive_response()
+        # held while the build is read, which usually lasts as long as the build
+        return await admitted_response("archive", make_archive_response)
+    except PathDoesNotExistInRevException:
         abort(404)
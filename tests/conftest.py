@@ -1,3 +1,8 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
 import pytest
 from git_web.helpers import Config, get_config
 from git_web.main import create_app
@@ -13,3 +18,54 @@ def app_config() -> Config:
 @pytest.mark.usefixtures("app")
 def app() -> Quart:
     return create_app()
+
+
+@pytest.fixture(scope="session")
+def git_repo(tmp_path_factory) -> Path:
+    """
+    A bare repository with a couple of commits on 'main',
+    'large.txt' is larger than a pipe's stream buffer,
+    'data.txt' is binary, 'NOTES' is text without an extension
+    and 'docs' is a directory
+    """
+    work_path = tmp_path_factory.mktemp("work")
+    repo_path = tmp_path_factory.mktemp("repos") / "test.git"
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+        GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+    )
+
+    def git(*args):
+        subprocess.run(["git", *args], check=True, capture_output=True, env=env)
+
+    git("init", "-b", "main", str(work_path))
+    (work_path / "README.md").write_text("# Test\n")
+    git("-C", str(work_path), "add", "-A")
+    git("-C", str(work_path), "commit", "-m", "first commit")
+    (work_path / "hello.py").write_text("print('hello')\n")
+    (work_path / "large.txt").write_text("".join(f"line {i}\n" for i in range(100000)))
+    (work_path / "data.txt").write_bytes(bytes(range(256)) * 64)
+    (work_path / "NOTES").write_text("some notes\n")
+    (work_path / "docs").mkdir()
+    (work_path / "docs" / "guide.md").write_text("# Guide\n")
+    git("-C", str(work_path), "add", "-A")
+    git("-C", str(work_path), "commit", "-m", "second commit")
+    git("clone", "--bare", str(work_path), str(repo_path))
+    return repo_path
+
+
+@pytest.fixture(scope="session")
+def served_repos(app_config: Config, git_repo: Path) -> Path:
+    """
+    A directory under REPOS_PATH with copies of
+    git_repo named 'test' and 'other', for view tests
+    """
+    dir_path = app_config.REPOS_PATH / "pytest-views"
+    for name in ("test", "other"):
+        subprocess.run(
+            ["git", "clone", "-q", "--bare", str(git_repo), str(dir_path / f"{name}.git")],
+            check=True,
+        )
+    yield dir_path
+    shutil.rmtree(dir_path)
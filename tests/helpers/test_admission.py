@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from git_web.helpers import admission
+from werkzeug.exceptions import ServiceUnavailable
+
+LIMITS = {"interactive": 2, "push": 1, "fetch": 1, "archive": 1, "maintenance": 1}
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_class_limit():
+    controller = admission.AdmissionController(LIMITS, 4)
+    await controller.acquire("fetch", 1)
+    waiting = asyncio.ensure_future(controller.acquire("fetch", 1))
+    # another class still runs
+    await controller.acquire("push", 1)
+    await settle()
+    assert not waiting.done()
+    assert controller.get_stats()["fetch"] == {
+        "limit": 1, "running": 1, "waiting": 1, "rejected": 0,
+    }
+    controller.release("fetch")
+    await waiting
+    assert controller.get_stats()["fetch"]["running"] == 1
+
+
+@pytest.mark.asyncio
+async def test_priority():
+    controller = admission.AdmissionController(LIMITS, 1)
+    await controller.acquire("fetch", 1)
+    admitted = []
+
+    async def acquire(admission_class: str):
+        await controller.acquire(admission_class, 1)
+        admitted.append(admission_class)
+
+    tasks = [
+        asyncio.ensure_future(acquire(admission_class))
+        for admission_class in ("maintenance", "archive", "interactive")
+    ]
+    await settle()
+    for admission_class in ("fetch", "interactive", "archive"):
+        controller.release(admission_class)
+        await settle()
+    await asyncio.gather(*tasks)
+    assert admitted == ["interactive", "archive", "maintenance"]
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout():
+    controller = admission.AdmissionController(LIMITS, 4)
+    await controller.acquire("archive", 1)
+    with pytest.raises(ServiceUnavailable) as exc_info:
+        await controller.acquire("archive", 0.05)
+    assert ("Retry-After", "1") in exc_info.value.get_headers()
+    assert controller.get_stats()["archive"] == {
+        "limit": 1, "running": 1, "waiting": 0, "rejected": 1,
+    }
+    # the timed out request is not admitted later
+    controller.release("archive")
+    assert controller.get_stats()["archive"]["running"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter():
+    controller = admission.AdmissionController(LIMITS, 4)
+    await controller.acquire("push", 1)
+    waiting = asyncio.ensure_future(controller.acquire("push", 1))
+    await settle()
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.get_stats()["push"]["waiting"] == 0
+    controller.release("push")
+    assert controller.get_stats()["push"]["running"] == 0
@@ -0,0 +1,85 @@
+import asyncio
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_interface.exceptions import GitException
+from git_web.helpers import archives
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def archive_cache(app_config, monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path / "cache")
+    archives.get_archive_disk_cache.cache_clear()
+    yield
+    archives.get_archive_disk_cache.cache_clear()
+
+
+@pytest.fixture
+def builds(monkeypatch) -> list:
+    calls = []
+    run_archive = archives._run_archive
+
+    def counted(*args):
+        calls.append(args)
+        return run_archive(*args)
+
+    monkeypatch.setattr(archives, "_run_archive", counted)
+    return calls
+
+
+def git_archive(repo_path: Path, commit_hash: str) -> bytes:
+    return subprocess.run(
+        ["git", "-C", str(repo_path), "archive", "--format=tar", commit_hash],
+        capture_output=True, check=True,
+    ).stdout
+
+
+async def read_all(content) -> bytes:
+    return b"".join([chunk async for chunk in content])
+
+
+@pytest.mark.asyncio
+async def test_open_archive_shares_build(app_config, git_repo: Path, builds: list):
+    commit_hash = subprocess.run(
+        ["git", "-C", str(git_repo), "rev-parse", "main"],
+        capture_output=True, check=True,
+    ).stdout.decode().strip()
+    opened = [
+        await archives.open_archive(git_repo, commit_hash, "tar")
+        for _ in range(3)
+    ]
+    assert [size for size, _ in opened] == [None] * 3
+    contents = await asyncio.gather(*(read_all(content) for _, content in opened))
+    assert len(builds) == 1
+    expected = git_archive(git_repo, commit_hash)
+    assert contents == [expected] * 3
+
+    # served from the disk cache with a known size
+    size, content = await archives.open_archive(git_repo, commit_hash, "tar")
+    assert size == len(expected)
+    assert await read_all(content) == expected
+    assert len(builds) == 1
+    assert (app_config.CACHE_PATH / "archives" / f"{commit_hash}.tar").exists()
+
+
+@pytest.mark.asyncio
+async def test_open_archive_failed(git_repo: Path):
+    _, content = await archives.open_archive(git_repo, "0" * 40, "tar")
+    with pytest.raises(GitException):
+        await read_all(content)
+    assert archives.get_archive_name("0" * 40, "tar", None) not in \
+        archives.get_archive_disk_cache()
+
+
+def test_get_archive_name():
+    assert archives.get_archive_name("abc", "tar.gz", None) == "abc.tar.gz"
+    assert archives.get_archive_name("abc", "tar.gz", 1) == "abc-1.tar.gz"
+
+
+def test_zstd_unavailable(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "ARCHIVE_ZSTD_COMMAND", "not-installed -c")
+    assert not archives.is_archive_format_available("tar.zst")
+    assert archives.is_archive_format_available("tar.gz")
+    assert not archives.is_archive_format_available("rar")
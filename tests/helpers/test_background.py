@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+from git_web.helpers import background
+
+
+@pytest.mark.asyncio
+async def test_periodic_task():
+    runs = []
+
+    async def record():
+        runs.append(len(runs))
+        if len(runs) == 2:
+            raise ValueError("keeps running after a failure")
+
+    background.start_periodic_task(0.01, record)
+    while len(runs) < 4:
+        await asyncio.sleep(0.01)
+    await background.stop_background_tasks()
+    count = len(runs)
+    await asyncio.sleep(0.05)
+    assert len(runs) == count
@@ -0,0 +1,75 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import bundles, cat_file_pool
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def bundle_cache(app_config, monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path / "cache")
+    yield
+    await cat_file_pool.close_cat_file_pool()
+
+
+@pytest.fixture
+def repo_path(git_repo: Path, tmp_path: Path) -> Path:
+    repo_path = tmp_path / "repos" / "bundles" / "test.git"
+    subprocess.run(["git", "clone", "-q", "--bare", str(git_repo), str(repo_path)], check=True)
+    return repo_path
+
+
+@pytest.mark.asyncio
+async def test_create_bundle(repo_path: Path):
+    commit_hash = subprocess.run(
+        ["git", "-C", str(repo_path), "rev-parse", "main"],
+        capture_output=True, check=True,
+    ).stdout.decode().strip()
+    assert await bundles.create_bundle(repo_path)
+    path = bundles.get_bundle_path(repo_path)
+    assert path == bundles.get_bundle_directory(repo_path) / f"{commit_hash}.bundle"
+    heads = subprocess.run(
+        ["git", "-C", str(repo_path), "bundle", "list-heads", str(path)],
+        capture_output=True, check=True,
+    ).stdout.decode()
+    assert heads == f"{commit_hash} refs/heads/main\n"
+    # nothing new to bundle
+    assert not await bundles.create_bundle(repo_path)
+
+
+@pytest.mark.asyncio
+async def test_create_bundle_replaces_old(repo_path: Path):
+    await bundles.create_bundle(repo_path)
+    old_path = bundles.get_bundle_path(repo_path)
+    # the branch moving to another commit
+    subprocess.run(
+        ["git", "-C", str(repo_path), "update-ref", "refs/heads/main",
+         "main^{/^first commit}"],
+        check=True,
+    )
+    assert await bundles.create_bundle(repo_path)
+    assert bundles.get_bundle_path(repo_path) != old_path
+    assert not old_path.exists()
+
+
+@pytest.mark.asyncio
+async def test_create_bundle_empty_repo(tmp_path: Path):
+    repo_path = tmp_path / "empty.git"
+    subprocess.run(["git", "init", "-q", "--bare", str(repo_path)], check=True)
+    assert not await bundles.create_bundle(repo_path)
+    assert bundles.get_bundle_path(repo_path) is None
+    assert bundles.get_bundle_list(repo_path) == []
+
+
+@pytest.mark.asyncio
+async def test_get_bundle_list(app_config, repo_path: Path, monkeypatch):
+    monkeypatch.setattr(app_config, "REPOS_PATH", repo_path.parent.parent)
+    await bundles.create_bundle(repo_path)
+    name = bundles.get_bundle_path(repo_path).name
+    assert bundles.get_bundle_list(repo_path) == [
+        "bundle.version=1",
+        "bundle.mode=all",
+        f"bundle.{name.removesuffix('.bundle')}.uri="
+        f"http://gitweb.lan/bundles/test.git/bundles/{name}",
+    ]
@@ -0,0 +1,153 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from git_interface.exceptions import GitException
+from git_web.helpers import caching
+
+
+class TestLRUCache:
+    def test_get_set(self):
+        cache = caching.LRUCache(2)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evicts_least_recent(self):
+        cache = caching.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+
+    def test_size_budget(self):
+        cache = caching.LRUCache(10, len)
+        cache.set("a", "12345")
+        cache.set("b", "123456")
+        assert "a" not in cache
+        assert cache.size == 6
+        cache.set("c", "12345678901")
+        assert "c" not in cache
+
+    def test_pop_group(self):
+        cache = caching.LRUCache(10, group_by=lambda key: key[0])
+        cache.set(("repo-a", 1), 1)
+        cache.set(("repo-a", 2), 2)
+        cache.set(("repo-b", 1), 3)
+        cache.pop_group("repo-a")
+        assert len(cache) == 1
+        assert ("repo-b", 1) in cache
+
+
+def test_invalidate_repo(git_repo: Path):
+    cache = caching.register_repo_cache(caching.LRUCache(10, group_by=lambda key: key[0]))
+    cache.set((str(git_repo), "page"), "html")
+    before = caching.get_refs_fingerprint(git_repo)
+    caching.invalidate_repo(git_repo)
+    assert len(cache) == 0
+    assert caching.get_refs_fingerprint(git_repo) != before
+
+
+class TestDiskCache:
+    def test_add_get(self, tmp_path: Path):
+        cache = caching.DiskCache(tmp_path, 10)
+        temp_path = cache.temp_path()
+        temp_path.write_bytes(b"12345")
+        path = cache.add("a", temp_path)
+        assert cache.get("a") == path
+        assert path.read_bytes() == b"12345"
+        assert cache.get("b") is None
+
+    def test_evicts_least_recent(self, tmp_path: Path):
+        cache = caching.DiskCache(tmp_path, 10)
+        for name in ("a", "b", "c"):
+            temp_path = cache.temp_path()
+            temp_path.write_bytes(b"1234")
+            cache.add(name, temp_path)
+        assert "a" not in cache
+        assert not (tmp_path / "a").exists()
+        assert cache.size == 8
+
+    def test_reloads_existing(self, tmp_path: Path):
+        (tmp_path / "a").write_bytes(b"1234")
+        cache = caching.DiskCache(tmp_path, 10)
+        assert cache.get("a") == tmp_path / "a"
+        assert cache.size == 4
+
+
+@pytest.mark.asyncio
+async def test_highlight_cache_spills_to_disk(tmp_path: Path):
+    cache = caching.HighlightCache(10**6, caching.DiskCache(tmp_path, 10**6))
+    await cache.set("abc", "TextLexer", "<span>hi</span>")
+    restarted = caching.HighlightCache(10**6, caching.DiskCache(tmp_path, 10**6))
+    assert await restarted.get("abc", "TextLexer") == "<span>hi</span>"
+    assert await restarted.get("abc", "PythonLexer") is None
+    assert (restarted.hits, restarted.disk_hits, restarted.misses) == (0, 1, 1)
+
+
+class TestDiskCacheBuild:
+    @pytest.mark.asyncio
+    async def test_read_while_written(self, tmp_path: Path):
+        disk = caching.DiskCache(tmp_path, 10**6)
+        build = caching.DiskCacheBuild(disk, "a")
+        chunks = asyncio.Queue()
+
+        async def source():
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+
+        writing = asyncio.ensure_future(build.write(source()))
+        early = build.iter_content()
+        await chunks.put(b"123")
+        assert await anext(early) == b"123"
+        await chunks.put(b"456")
+        assert await anext(early) == b"456"
+        await chunks.put(None)
+        await writing
+        assert [chunk async for chunk in early] == []
+        # readers starting after completion read the cached file
+        assert b"".join([chunk async for chunk in build.iter_content()]) == b"123456"
+        assert (await disk.read("a")) == b"123456"
+
+    @pytest.mark.asyncio
+    async def test_failed(self, tmp_path: Path):
+        disk = caching.DiskCache(tmp_path, 10**6)
+        build = caching.DiskCacheBuild(disk, "a")
+
+        async def source():
+            yield b"123"
+            raise ValueError("failed")
+
+        reader = build.iter_content()
+        with pytest.raises(ValueError):
+            await build.write(source())
+        with pytest.raises(GitException):
+            async for _ in reader:
+                pass
+        assert "a" not in disk
+        assert list(tmp_path.iterdir()) == []
+
+
+def test_get_cache_path(app_config, monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path)
+    assert caching.get_cache_path("blobs") == tmp_path / "blobs"
+    monkeypatch.setattr(app_config, "CACHE_PATH", None)
+    temp_path = caching.get_cache_path("blobs").parent
+    assert temp_path.is_dir()
+    caching.remove_temp_cache_path()
+    assert not temp_path.exists()
+
+
+@pytest.mark.asyncio
+async def test_iter_file_range(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(caching, "FILE_READ_SIZE", 4)
+    path = tmp_path / "file"
+    path.write_bytes(bytes(range(20)))
+    chunks = [chunk async for chunk in caching.iter_file(open(path, "rb"), 3, 13)]
+    assert chunks == [bytes(range(3, 7)), bytes(range(7, 11)), bytes(range(11, 13))]
+    assert b"".join([chunk async for chunk in caching.iter_file(open(path, "rb"))]) == \
+        bytes(range(20))
@@ -96,3 +96,13 @@ class TestCalculations:
         actual_output = tuple(calc.path_to_tree_components(path))
 
         assert excepted_output == actual_output
+
+    def test_parse_line_range(self):
+        assert calc.parse_line_range("12000-12200") == (11999, 12200)
+        assert calc.parse_line_range("5") == (4, 4 + calc.BLOB_LINES_WINDOW)
+        assert calc.parse_line_range("1-999999") == (0, calc.MAX_BLOB_LINES_WINDOW)
+
+    def test_parse_line_range_invalid(self):
+        for line_range in ("", "a-b", "0-10", "10-5"):
+            with pytest.raises(ValueError):
+                calc.parse_line_range(line_range)
@@ -0,0 +1,132 @@
+from pathlib import Path
+
+import asyncio
+
+import pytest
+import pytest_asyncio
+from git_interface.exceptions import (GitException,
+                                      PathDoesNotExistInRevException)
+from git_web.helpers import cat_file_pool
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pool():
+    yield
+    await cat_file_pool.close_cat_file_pool()
+
+
+@pytest.mark.asyncio
+async def test_read_object(git_repo: Path):
+    info, content = await cat_file_pool.read_object(git_repo, "main", "README.md")
+    assert info.type_ == "blob"
+    assert info.size == len(content)
+    assert content == b"# Test\n"
+
+
+@pytest.mark.asyncio
+async def test_read_object_max_size(git_repo: Path):
+    info, content = await cat_file_pool.read_object(git_repo, "main", "README.md", 2)
+    assert info.size == 7
+    assert content is None
+
+
+@pytest.mark.asyncio
+async def test_read_object_missing(git_repo: Path):
+    with pytest.raises(PathDoesNotExistInRevException):
+        await cat_file_pool.read_object(git_repo, "main", "missing.txt")
+
+
+@pytest.mark.asyncio
+async def test_read_object_missing_with_space(git_repo: Path):
+    with pytest.raises(PathDoesNotExistInRevException):
+        await cat_file_pool.read_object(git_repo, "main", "missing file.txt")
+
+
+@pytest.mark.asyncio
+async def test_read_object_larger_than_max_size(git_repo: Path):
+    info, content = await cat_file_pool.read_object(git_repo, "main", "large.txt", 1024)
+    assert info.size > 2**20
+    assert content is None
+    info, content = await cat_file_pool.read_object(git_repo, "main", "large.txt")
+    assert len(content) == info.size
+
+
+@pytest.mark.asyncio
+async def test_stream_object_stopped_early(git_repo: Path):
+    info, content = await cat_file_pool.open_object(git_repo, "main", "large.txt")
+    async for _ in content:
+        break
+    await asyncio.wait_for(content.aclose(), 10)
+    assert cat_file_pool.get_cat_file_pool(True).total == 0
+
+
+@pytest.mark.asyncio
+async def test_open_object(git_repo: Path):
+    info, content = await cat_file_pool.open_object(git_repo, "main", "hello.py")
+    assert info.size == 15
+    assert b"".join([chunk async for chunk in content]) == b"print('hello')\n"
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_processes(git_repo: Path):
+    pool = cat_file_pool.CatFilePool(2, 60, 10)
+    async with pool.process(git_repo, True) as process:
+        await process.request("main:README.md")
+    async with pool.process(git_repo, True) as reused:
+        assert reused is process
+    assert pool.total == 1
+    await pool.close()
+    assert pool.total == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_replaces_out_of_sync(git_repo: Path):
+    pool = cat_file_pool.CatFilePool(1, 60, 10)
+    async with pool.process(git_repo) as process:
+        await process.request("main:README.md")
+    async with pool.process(git_repo) as replaced:
+        assert replaced is not process
+        info = await replaced.request("main:hello.py")
+        await replaced.read_content(info.size)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_release_unread_content(git_repo: Path):
+    pool = cat_file_pool.CatFilePool(1, 60, 10)
+
+    async def read_header():
+        async with pool.process(git_repo) as process:
+            await process.request("main:large.txt")
+            # let the unread content fill the pipe and pause the reader
+            await asyncio.sleep(0.2)
+
+    await asyncio.wait_for(read_header(), 10)
+    assert pool.total == 0
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_acquire_timeout(git_repo: Path):
+    pool = cat_file_pool.CatFilePool(1, 60, 0.05)
+    async with pool.process(git_repo, True):
+        with pytest.raises(GitException):
+            async with pool.process(git_repo, True):
+                pass
+    async with pool.process(git_repo, True):
+        pass
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_read_content_head_then_skip(git_repo: Path):
+    pool = cat_file_pool.get_cat_file_pool()
+    async with pool.process(git_repo) as process:
+        info = await process.request("main:large.txt")
+        assert await process.read_content_head(info.size, 12) == b"line 0\nline "
+        await process.skip_content(info.size - 12)
+        assert process.is_healthy
+        info = await process.request("main:README.md")
+        assert await process.read_content_head(info.size, 4096) == b"# Test\n"
+        assert await process.read_content(0) == b""
+        assert process.is_healthy
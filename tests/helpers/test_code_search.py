@@ -0,0 +1,116 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import cat_file_pool, code_search
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def index_cache(app_config, monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path / "cache")
+    yield
+    await cat_file_pool.close_cat_file_pool()
+
+
+@pytest.fixture
+def repo_path(git_repo: Path, tmp_path: Path) -> Path:
+    repo_path = tmp_path / "repos" / "code" / "test.git"
+    subprocess.run(["git", "clone", "-q", "--bare", str(git_repo), str(repo_path)], check=True)
+    return repo_path
+
+
+def commit_files(repo_path: Path, work_path: Path, files: dict[str, str]):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+        GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+    )
+    if not work_path.exists():
+        subprocess.run(["git", "clone", "-q", str(repo_path), str(work_path)], check=True)
+    for name, content in files.items():
+        (work_path / name).write_text(content)
+    subprocess.run(["git", "-C", str(work_path), "add", "-A"], check=True)
+    subprocess.run(
+        ["git", "-C", str(work_path), "commit", "-q", "-m", "change"], check=True, env=env)
+    subprocess.run(["git", "-C", str(work_path), "push", "-q", "origin", "main"], check=True)
+
+
+def get_segment_names(repo_path: Path) -> list[str]:
+    return code_search._read_manifest(code_search.get_code_index_directory(repo_path))["segments"]
+
+
+@pytest.mark.parametrize(("pattern", "expected"), (
+    ("def main", ["def main"]),
+    (r"def \w+\(", ["def ", "("]),
+    ("colou?r", ["colo", "r"]),
+    ("ab+c", ["ab", "c"]),
+    ("a{2,}bc", ["bc"]),
+    ("fn[ae]ture", ["fn", "ture"]),
+    ("(foo|bar)baz", ["baz"]),
+    ("foo|bar", []),
+    (r"1\.0", ["1.0"]),
+    ("(?x) a b", []),
+))
+def test_find_required_literals(pattern: str, expected: list[str]):
+    assert code_search.find_required_literals(pattern) == expected
+
+
+@pytest.mark.asyncio
+async def test_search(repo_path: Path, app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "CODE_SEARCH_MAX_FILE_SIZE", 2*10**6)
+    assert await code_search.search_code(repo_path, "hello") is None
+    assert await code_search.update_code_index(repo_path)
+    assert not await code_search.update_code_index(repo_path)
+    results = await code_search.search_code(repo_path, "PRINT('hello')")
+    assert [match.path for match in results.matches] == ["hello.py"]
+    assert results.matches[0].lines == [(1, "print('hello')")]
+    results = await code_search.search_code(repo_path, r"^line 9999\d$", True)
+    assert [match.path for match in results.matches] == ["large.txt"]
+    assert results.matches[0].lines[0] == (99991, "line 99990")
+    assert len(results.matches[0].lines) == code_search.MAX_FILE_LINES
+    results = await code_search.search_code(repo_path, "#", path_query=r"\.md$")
+    assert [match.path for match in results.matches] == ["README.md", "docs/guide.md"]
+    results = await code_search.search_code(repo_path, "e", limit=1)
+    assert len(results.matches) == 1 and results.truncated
+    # binary files match nothing, even without trigrams to filter by
+    results = await code_search.search_code(repo_path, ".", True, r"data\.txt")
+    assert results.matches == []
+
+
+@pytest.mark.asyncio
+async def test_incremental_update(repo_path: Path, tmp_path: Path, monkeypatch):
+    await code_search.update_code_index(repo_path)
+    commit_files(repo_path, tmp_path / "work", {"hello.py": "print('changed')\n"})
+    assert await code_search.update_code_index(repo_path)
+    _, second = get_segment_names(repo_path)
+    directory = code_search.get_code_index_directory(repo_path)
+    # only the changed blob is read
+    assert len(code_search.TrigramSegment(directory / second)) == 1
+    results = await code_search.search_code(repo_path, "print")
+    assert results.matches[0].lines == [(1, "print('changed')")]
+    assert (await code_search.search_code(repo_path, "hello")).matches == []
+    # too many segments are merged by building the index again
+    monkeypatch.setattr(code_search, "MAX_SEGMENTS", 2)
+    commit_files(repo_path, tmp_path / "work", {"new.txt": "new file\n"})
+    await code_search.update_code_index(repo_path)
+    assert len(get_segment_names(repo_path)) == 1
+    assert sorted(path.suffix for path in directory.iterdir()) == [
+        ".files", ".json", ".trigrams"]
+    results = await code_search.search_code(repo_path, "new file")
+    assert [match.path for match in results.matches] == ["new.txt"]
+
+
+@pytest.mark.asyncio
+async def test_large_files_skipped(repo_path: Path):
+    await code_search.update_code_index(repo_path)
+    assert (await code_search.search_code(repo_path, "line 99990")).matches == []
+
+
+@pytest.mark.asyncio
+async def test_removed_repo(repo_path: Path, tmp_path: Path):
+    await code_search.update_code_index(repo_path)
+    repo_path.rename(tmp_path / "moved.git")
+    assert not await code_search.update_code_index(repo_path)
+    assert not code_search.get_code_index_directory(repo_path).exists()
@@ -0,0 +1,85 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_interface.exceptions import UnknownRevisionException
+from git_web.helpers import commit_count, commit_log
+from git_web.helpers.cat_file_pool import close_cat_file_pool
+
+ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+    GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+)
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pool():
+    yield
+    await close_cat_file_pool()
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ["git", *args], check=True, capture_output=True, env=ENV, text=True).stdout.strip()
+
+
+def commit(work_path: Path, *subjects: str):
+    for subject in subjects:
+        git("-C", str(work_path), "commit", "-q", "--allow-empty", "-m", subject)
+    git("-C", str(work_path), "push", "-q", "--force", "origin", "main")
+
+
+@pytest.fixture
+def work_path(git_repo: Path, tmp_path: Path) -> Path:
+    git("clone", "-q", "--bare", str(git_repo), str(tmp_path / "test.git"))
+    git("clone", "-q", str(tmp_path / "test.git"), str(tmp_path / "work"))
+    return tmp_path / "work"
+
+
+@pytest.fixture
+def rev_list_calls(monkeypatch) -> list[tuple[str, ...]]:
+    calls = []
+    rev_list_count = commit_count._rev_list_count
+
+    async def record(repo_path: Path, *args: str) -> list[int]:
+        calls.append(args)
+        return await rev_list_count(repo_path, *args)
+
+    monkeypatch.setattr(commit_count, "_rev_list_count", record)
+    return calls
+
+
+def count_commits(repo_path: Path, tree_ish: str = "main") -> int:
+    return int(git("-C", str(repo_path), "rev-list", "--count", tree_ish))
+
+
+@pytest.mark.asyncio
+async def test_commit_count(work_path: Path, rev_list_calls: list):
+    repo_path = work_path.parent / "test.git"
+    assert await commit_count.get_commit_count(repo_path, "main") == 2
+    assert await commit_count.get_commit_count(repo_path, "main") == 2
+    assert len(rev_list_calls) == 1
+    # counted from the commit counted before
+    commit(work_path, "newer 1", "newer 2")
+    assert await commit_count.get_commit_count(repo_path, "main") == 4
+    assert rev_list_calls[-1][0] == "--left-right"
+    # including when the branch was rewritten
+    git("-C", str(work_path), "reset", "-q", "--hard", "HEAD~3")
+    commit(work_path, "rewritten")
+    assert await commit_count.get_commit_count(repo_path, "main") == count_commits(repo_path)
+    assert rev_list_calls[-1][0] == "--left-right"
+    with pytest.raises(UnknownRevisionException):
+        await commit_count.get_commit_count(repo_path, "unknown")
+
+
+@pytest.mark.asyncio
+async def test_count_from_commit_log(work_path: Path, rev_list_calls: list):
+    repo_path = work_path.parent / "test.git"
+    commit_hash = git("-C", str(repo_path), "rev-parse", "main")
+    log = await commit_log.get_commit_log(repo_path, "main", commit_hash)
+    await log.get_hashes(0, None)
+    assert await commit_count.get_commit_count(repo_path, "main") == 2
+    assert rev_list_calls == []
@@ -0,0 +1,118 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_interface.log import get_logs
+from git_web.helpers import commit_log
+from git_web.helpers.cat_file_pool import close_cat_file_pool
+
+ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+    GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+)
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pool():
+    yield
+    await close_cat_file_pool()
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ["git", *args], check=True, capture_output=True, env=ENV, text=True).stdout.strip()
+
+
+def commit(work_path: Path, *subjects: str):
+    for subject in subjects:
+        git("-C", str(work_path), "commit", "-q", "--allow-empty", "-m", subject)
+    git("-C", str(work_path), "push", "-q", "--force", "origin", "main")
+
+
+@pytest.fixture
+def work_path(git_repo: Path, tmp_path: Path) -> Path:
+    repo_path = tmp_path / "test.git"
+    git("clone", "-q", "--bare", str(git_repo), str(repo_path))
+    git("clone", "-q", str(repo_path), str(tmp_path / "work"))
+    commit(tmp_path / "work", *(f"commit {number}" for number in range(5)))
+    return tmp_path / "work"
+
+
+def rev_list(repo_path: Path, tree_ish: str = "main") -> list[str]:
+    return git("-C", str(repo_path), "rev-list", tree_ish).split()
+
+
+async def get_log(repo_path: Path) -> commit_log.CommitLog:
+    return await commit_log.get_commit_log(repo_path, "main", rev_list(repo_path)[0])
+
+
+def test_parse_commit():
+    content = (
+        b"tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904\n"
+        b"parent 1111111111111111111111111111111111111111\n"
+        b"parent 2222222222222222222222222222222222222222\n"
+        b"author A U Thor <author@example.com> 1700000000 +0130\n"
+        b"committer C O Mitter <committer@example.com> 1700000060 -0500\n"
+        b"gpgsig -----BEGIN PGP SIGNATURE-----\n"
+        b" \n"
+        b" -----END PGP SIGNATURE-----\n"
+        b"\n"
+        b"Merge the branch\n"
+        b"into main\n"
+        b"\n"
+        b"The body\n"
+    )
+    log = commit_log.parse_commit("3" * 40, content)
+    assert log.parent_hash == "1" * 40 + " " + "2" * 40
+    assert (log.author_name, log.author_email) == ("A U Thor", "author@example.com")
+    assert log.commit_date.isoformat() == "2023-11-14T17:14:20-05:00"
+    assert log.subject == "Merge the branch into main"
+
+
+@pytest.mark.asyncio
+async def test_pages(work_path: Path):
+    repo_path = work_path.parent / "test.git"
+    expected = rev_list(repo_path)
+    log = await get_log(repo_path)
+    page = await commit_log.read_log_page(repo_path, log, 3)
+    assert [entry.commit_hash for entry in page.logs] == expected[:3]
+    assert page.logs == list(await get_logs(repo_path, "main", 3))
+    assert page.previous_hash is None and page.next_hash == expected[2]
+    page = await commit_log.read_log_page(repo_path, log, 3, after=page.next_hash)
+    assert [entry.commit_hash for entry in page.logs] == expected[3:6]
+    assert page.start == 3 and page.previous_hash == expected[3]
+    assert page.total == len(expected)
+    page = await commit_log.read_log_page(repo_path, log, 3, after=page.next_hash)
+    assert [entry.commit_hash for entry in page.logs] == expected[6:]
+    assert page.next_hash is None
+    page = await commit_log.read_log_page(repo_path, log, 2, before=expected[5])
+    assert [entry.commit_hash for entry in page.logs] == expected[3:5]
+    # pages before the first are the first page
+    page = await commit_log.read_log_page(repo_path, log, 3, before=expected[1])
+    assert [entry.commit_hash for entry in page.logs] == expected[:3]
+    page = await commit_log.read_log_page(repo_path, log, None)
+    assert len(page.logs) == len(expected)
+    assert await commit_log.read_log_page(repo_path, log, 3, after="0" * 40) is None
+
+
+@pytest.mark.asyncio
+async def test_extended_after_push(work_path: Path):
+    repo_path = work_path.parent / "test.git"
+    first = await get_log(repo_path)
+    await first.get_hashes(0, None)
+    commit(work_path, "newer 1", "newer 2")
+    second = await get_log(repo_path)
+    # the commits read before are shared
+    assert second.rev_list is first.rev_list
+    assert len(second.newer) == 2 * second.width
+    assert await second.get_hashes(0, None) == rev_list(repo_path)
+    assert await second.find(first.tip) == 2
+    # a rewritten branch is read again
+    git("-C", str(work_path), "reset", "-q", "--hard", "HEAD~3")
+    commit(work_path, "rewritten")
+    third = await get_log(repo_path)
+    assert third.rev_list is not first.rev_list
+    assert await third.get_hashes(0, None) == rev_list(repo_path)
@@ -18,3 +18,72 @@ class TestGuessMimetype:
     @pytest.mark.usefixtures("register_mimetypes")
     def test_no_ext(self):
         assert content_preview.guess_mimetype("license") == "text/plain"
+
+
+def test_get_lexer_for_path():
+    assert content_preview.get_lexer_for_path("src/main.py").name == "Python"
+    assert content_preview.get_lexer_for_path("unknown.file-type").name == "Text only"
+
+
+def test_get_lexer_for_path_by_name():
+    assert content_preview.get_lexer_for_path("CMakeLists.txt").name == "CMake"
+    assert content_preview.get_lexer_for_path("notes.txt").name == "Text only"
+
+
+def test_render_markdown_relative_urls():
+    content = "[a](b.md) ![i](c.png) [d](https://example.com/d)"
+    rendered = content_preview.render_markdown(content, "/blob/", "/raw/")
+    assert 'href="/blob/b.md"' in rendered
+    assert 'src="/raw/c.png"' in rendered
+    assert 'href="https://example.com/d"' in rendered
+    rendered = content_preview.render_markdown(content)
+    assert 'href="b.md"' in rendered
+    assert 'src="c.png"' in rendered
+
+
+class TestSniffContentType:
+    def test_text(self):
+        assert content_preview.sniff_content_type(b"hello\nworld\n", False) == "text/plain"
+
+    def test_nul_byte(self):
+        assert content_preview.sniff_content_type(b"hello\0world") == "application/octet-stream"
+
+    def test_png_magic(self):
+        head = b"\x89PNG\r\n\x1a\n\0\0\0\rIHDR"
+        assert content_preview.sniff_content_type(head) == "image/png"
+
+    def test_utf8_cut_off(self):
+        head = ("é" * content_preview.CONTENT_SNIFF_SIZE).encode()
+        head = head[:content_preview.CONTENT_SNIFF_SIZE - 1]
+        assert head[-1:] == b"\xc3"
+        assert content_preview.sniff_content_type(head) == "text/plain"
+
+    def test_latin1(self):
+        head = "café, crème brûlée\n".encode("latin-1") * 100
+        assert content_preview.sniff_content_type(head, False) == "text/plain"
+
+    def test_binary(self):
+        head = bytes(range(1, 256)) * 16
+        assert content_preview.sniff_content_type(head) == "application/octet-stream"
+
+
+class TestGuessMimetypeWithContent:
+    def test_binary_with_text_name(self):
+        content_type = content_preview.sniff_content_type(bytes(range(256)))
+        assert content_preview.guess_mimetype("data.txt", content_type) == \
+            "application/octet-stream"
+
+    def test_text_without_extension(self):
+        content_type = content_preview.sniff_content_type(b"some notes\n", False)
+        assert content_preview.guess_mimetype("NOTES", content_type) == "text/plain"
+
+    def test_image_without_extension(self):
+        assert content_preview.guess_mimetype("logo", "image/png") == "image/png"
+
+    def test_extension_kept_for_text(self):
+        assert content_preview.guess_mimetype("main.py", "text/plain") == "text/x-python"
+
+
+def test_decode_text():
+    assert content_preview.decode_text("é".encode()) == "é"
+    assert content_preview.decode_text("é".encode("latin-1")) == "é"
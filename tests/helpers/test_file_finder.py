@@ -0,0 +1,86 @@
+import asyncio
+from array import array
+from pathlib import Path
+
+import pytest
+from git_web.helpers import file_finder
+from git_web.helpers.cat_file_pool import close_cat_file_pool, get_commit_hash
+
+PATHS = (
+    "README.md",
+    "docs/index.md",
+    "git_web/views/repository.py",
+    "git_web/helpers/views.py",
+    "git_web/templates/repository/tree.html",
+    "tests/views/test_repository.py",
+    "Views.txt",
+)
+
+
+@pytest.fixture
+def path_list() -> file_finder.PathList:
+    output = b"".join(path.encode() + b"\0" for path in PATHS)
+    return file_finder._make_path_list("0" * 40, output)
+
+
+def test_path_list(path_list: file_finder.PathList):
+    assert len(path_list) == len(PATHS)
+    assert [path_list.get_path(number) for number in range(len(path_list))] == sorted(PATHS)
+    assert path_list.names.split(b"\n")[0] == b"readme.md"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(("query", "expected"), (
+    ("views", ["Views.txt", "git_web/helpers/views.py", "git_web/views/repository.py",
+               "tests/views/test_repository.py"]),
+    ("repo", ["git_web/views/repository.py", "tests/views/test_repository.py",
+              "git_web/templates/repository/tree.html"]),
+    ("gwvrep", ["git_web/views/repository.py"]),
+    ("TREE HTML", ["git_web/templates/repository/tree.html"]),
+    ("zzz", []),
+    (" ", []),
+))
+async def test_find_paths(path_list: file_finder.PathList, query: str, expected: list[str]):
+    assert await file_finder.find_paths(path_list, query, 10) == expected
+
+
+@pytest.mark.asyncio
+async def test_find_paths_limit(path_list: file_finder.PathList):
+    assert await file_finder.find_paths(path_list, "e", 2) == ["README.md", "Views.txt"]
+
+
+@pytest.mark.asyncio
+async def test_find_paths_narrowed(path_list: file_finder.PathList):
+    await file_finder.find_paths(path_list, "test", 10)
+    assert sorted(path_list.matches[b"test"]) == [4, 5, 6]
+    # only the matches of "test" are checked
+    path_list.matches[b"test"] = array("I", [5])
+    assert await file_finder.find_paths(path_list, "testr", 10) == ["git_web/views/repository.py"]
+
+
+@pytest.mark.asyncio
+async def test_find_paths_blocks(monkeypatch):
+    monkeypatch.setattr(file_finder, "BLOCK_LINES", 2)
+    paths = [f"dir/file-{number:03}.txt" for number in range(100)] + ["dir/query.txt"]
+    output = b"".join(path.encode() + b"\0" for path in paths)
+    path_list = file_finder._make_path_list("0" * 40, output)
+    assert file_finder._find_line_ranges(path_list, "qy") == [(100, 101)]
+    assert file_finder._find_line_ranges(path_list, "file") == [(0, 101)]
+    assert file_finder._find_line_ranges(path_list, "#") == []
+    assert await file_finder.find_paths(path_list, "qy", 10) == ["dir/query.txt"]
+
+
+@pytest.mark.asyncio
+async def test_get_path_list(git_repo: Path):
+    commit_hash = await get_commit_hash(git_repo, "main")
+    await close_cat_file_pool()
+    file_finder.get_path_list_cache().clear()
+    first, second = await asyncio.gather(
+        file_finder.get_path_list(git_repo, commit_hash),
+        file_finder.get_path_list(git_repo, commit_hash),
+    )
+    # concurrent requests share one listing
+    assert first is second
+    assert first is await file_finder.get_path_list(git_repo, commit_hash)
+    assert [first.get_path(number) for number in range(len(first))] == [
+        "NOTES", "README.md", "data.txt", "docs/guide.md", "hello.py", "large.txt"]
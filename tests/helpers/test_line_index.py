@@ -0,0 +1,101 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import caching, cat_file_pool, line_index
+
+CONTENT = "".join(f"line {i}\n" for i in range(1000)) + "\n\nno newline at end"
+LINES = CONTENT.split("\n")
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clear_caches(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "CACHE_PATH", None)
+    monkeypatch.setattr(line_index, "LINE_INDEX_STEP", 16)
+    line_index.get_line_index_cache.cache_clear()
+    line_index.get_blob_disk_cache.cache_clear()
+    yield
+    line_index.get_line_index_cache.cache_clear()
+    line_index.get_blob_disk_cache.cache_clear()
+    caching.remove_temp_cache_path()
+    await cat_file_pool.close_cat_file_pool()
+
+
+@pytest.fixture
+def blob(tmp_path: Path) -> tuple[Path, cat_file_pool.ObjectInfo]:
+    repo_path = tmp_path / "blob.git"
+    subprocess.run(["git", "init", "-q", "--bare", str(repo_path)], check=True)
+    object_hash = subprocess.run(
+        ["git", "-C", str(repo_path), "hash-object", "-w", "--stdin"],
+        input=CONTENT.encode(), capture_output=True, check=True,
+    ).stdout.decode().strip()
+    return repo_path, cat_file_pool.ObjectInfo(object_hash, "blob", len(CONTENT))
+
+
+def test_builder_chunking():
+    expected = None
+    for chunk_size in (1, 7, 64, len(CONTENT)):
+        builder = line_index._LineIndexBuilder()
+        data = CONTENT.encode()
+        for i in range(0, len(data), chunk_size):
+            builder.feed(data[i:i + chunk_size])
+        index = builder.finish("hash")
+        assert index.line_count == len(LINES)
+        if expected is None:
+            expected = index.offsets
+        assert index.offsets == expected
+    for i, offset in enumerate(expected):
+        assert CONTENT.encode()[offset:].startswith(LINES[i * 16].encode())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("start, stop", [(0, 5), (15, 17), (990, 1003), (1002, 2000)])
+async def test_read_lines(blob, start, stop):
+    repo_path, info = blob
+    index = await line_index.get_line_index(repo_path, info)
+    assert index.line_count == 1003
+    assert await line_index.read_lines(repo_path, index, start, stop) == LINES[start:stop]
+
+
+@pytest.mark.asyncio
+async def test_read_lines_disk(blob, app_config, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path / "cache")
+    repo_path, info = blob
+    index = await line_index.get_line_index(repo_path, info)
+    assert (tmp_path / "cache" / "blobs" / info.object_hash).read_text() == CONTENT
+    # served from the disk copy and the cached index, so the repo is not read
+    assert await line_index.read_lines(tmp_path, index, 500, 502) == LINES[500:502]
+    assert await line_index.get_line_index(tmp_path, info) is index
+
+
+@pytest.mark.asyncio
+async def test_read_lines_temp_dir(blob):
+    repo_path, info = blob
+    await line_index.get_line_index(repo_path, info)
+    directory = line_index.get_blob_disk_cache().directory
+    assert (directory / info.object_hash).read_text() == CONTENT
+    caching.remove_temp_cache_path()
+    assert not directory.exists()
+
+
+@pytest.mark.asyncio
+async def test_read_lines_copy_evicted(blob):
+    repo_path, info = blob
+    index = await line_index.get_line_index(repo_path, info)
+    # as if evicted by another process
+    (line_index.get_blob_disk_cache().directory / info.object_hash).unlink()
+    assert await line_index.read_lines(repo_path, index, 500, 502) == LINES[500:502]
+    assert info.object_hash in line_index.get_blob_disk_cache()
+
+
+@pytest.mark.asyncio
+async def test_read_lines_large_blob(git_repo: Path):
+    # larger than a pipe's stream buffer
+    info = await cat_file_pool.get_object_info(git_repo, "main", "large.txt")
+    index = await line_index.get_line_index(git_repo, info)
+    assert index.line_count == 100000
+    assert await line_index.read_lines(git_repo, index, 99998, 100005) == [
+        "line 99998", "line 99999",
+    ]
+    assert await line_index.read_lines(git_repo, index, 0, 1) == ["line 0"]
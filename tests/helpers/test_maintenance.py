@@ -0,0 +1,82 @@
+import asyncio
+import subprocess
+from pathlib import Path
+
+import pytest
+from git_web.helpers import maintenance
+from git_web.helpers.background import stop_background_tasks
+
+
+@pytest.fixture
+def repo_path(git_repo: Path, tmp_path: Path) -> Path:
+    """
+    A copy of git_repo with its objects in one pack
+    and its refs packed, without any index of them
+    """
+    repo_path = tmp_path / "repo.git"
+    subprocess.run(
+        ["git", "clone", "-q", "--bare", "--no-local", str(git_repo), str(repo_path)],
+        check=True,
+    )
+    return repo_path
+
+
+def git(repo_path: Path, *args):
+    subprocess.run(["git", "-C", str(repo_path), *args], check=True, capture_output=True)
+
+
+@pytest.mark.asyncio
+async def test_maintain_repo(repo_path: Path):
+    assert await maintenance.maintain_repo(repo_path) == ["repack", "commit-graph"]
+    pack_path = repo_path / "objects" / "pack"
+    assert (pack_path / "multi-pack-index").exists()
+    assert list(pack_path.glob("multi-pack-index-*.bitmap"))
+    assert (repo_path / "objects/info/commit-graphs/commit-graph-chain").exists()
+    # nothing is due until the repository changes
+    assert await maintenance.maintain_repo(repo_path) == []
+    await asyncio.sleep(0.01)
+    git(repo_path, "branch", "new-branch", "main")
+    assert await maintenance.maintain_repo(repo_path) == ["commit-graph"]
+    assert await maintenance.maintain_repo(repo_path, forced=True) == list(
+        maintenance.MAINTENANCE_TASKS)
+
+
+@pytest.mark.asyncio
+async def test_pack_refs(repo_path: Path, app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "MAINTENANCE_LOOSE_REF_LIMIT", 2)
+    git(repo_path, "branch", "first", "main")
+    assert not maintenance.is_task_needed(repo_path, "pack-refs")
+    git(repo_path, "tag", "v1.0", "main")
+    assert maintenance.count_loose_refs(repo_path) == 2
+    assert maintenance.is_task_needed(repo_path, "pack-refs")
+    await maintenance.run_maintenance_task(repo_path, "pack-refs")
+    assert maintenance.count_loose_refs(repo_path) == 0
+
+
+def test_count_loose_objects(repo_path: Path):
+    assert maintenance.count_loose_objects(repo_path) == 0
+    sample_path = repo_path / "objects" / maintenance.LOOSE_OBJECT_SAMPLE
+    sample_path.mkdir()
+    (sample_path / ("0" * 38)).touch()
+    assert maintenance.count_loose_objects(repo_path) == 256
+
+
+@pytest.mark.asyncio
+async def test_scheduler(repo_path: Path):
+    scheduler = maintenance.MaintenanceScheduler(2, 1)
+    scheduler.record_push(repo_path)
+    assert scheduler.get_stats()["queued"] == 0
+    scheduler.record_push(repo_path)
+    scheduler.record_push(repo_path)
+    # queued once
+    assert scheduler.get_stats()["queued"] == 1
+    scheduler.start()
+    try:
+        for _ in range(500):
+            if scheduler.get_stats()["completed"] == 1:
+                break
+            await asyncio.sleep(0.01)
+        assert scheduler.get_stats() == {"queued": 0, "running": 0, "completed": 1, "failed": 0}
+        assert (repo_path / "objects" / "pack" / "multi-pack-index").exists()
+    finally:
+        await stop_background_tasks()
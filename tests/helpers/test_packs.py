@@ -0,0 +1,24 @@
+import pytest
+from git_web.helpers import packs
+
+
+@pytest.mark.parametrize("protocol, valid", [
+    ("version=2", True),
+    ("version=2:object-format=sha1", True),
+    ("version=2\n", False),
+    ("version=2 --upload-pack=sh", False),
+    ("", False),
+])
+def test_is_valid_git_protocol(protocol: str, valid: bool):
+    assert packs.is_valid_git_protocol(protocol) is valid
+
+
+def test_is_protocol_v2():
+    assert packs.is_protocol_v2("version=2")
+    assert packs.is_protocol_v2("object-format=sha1:version=2")
+    assert not packs.is_protocol_v2("version=1")
+    assert not packs.is_protocol_v2(None)
+
+
+def test_pkt_line():
+    assert packs.pkt_line(b"# service=git-upload-pack\n") == b"001e# service=git-upload-pack\n"
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import rendering
+
+
+def slow_upper(text: str) -> str:
+    time.sleep(0.5)
+    return text.upper()
+
+
+def failing(text: str) -> str:
+    raise ValueError(text)
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def render_pool(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "RENDER_WORKERS", 1)
+    monkeypatch.setattr(app_config, "RENDER_TIMEOUT", 10)
+    rendering.get_slow_render_cache().clear()
+    yield
+    rendering.close_render_pool()
+
+
+@pytest.mark.asyncio
+async def test_render():
+    assert await rendering.render(str.upper, "text") == "TEXT"
+
+
+@pytest.mark.asyncio
+async def test_render_inline(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "RENDER_WORKERS", 0)
+    assert rendering.get_render_pool() is None
+    assert await rendering.render(str.upper, "text") == "TEXT"
+
+
+@pytest.mark.asyncio
+async def test_render_error():
+    with pytest.raises(ValueError, match="text"):
+        await rendering.render(failing, "text")
+    # the worker is still usable
+    assert await rendering.render(str.upper, "text") == "TEXT"
+
+
+@pytest.mark.asyncio
+async def test_render_timeout_kills_worker(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "RENDER_TIMEOUT", 0.1)
+    with pytest.raises(rendering.RenderTimeout):
+        await rendering.render(slow_upper, "text")
+    # a new worker replaces the killed one
+    monkeypatch.setattr(app_config, "RENDER_TIMEOUT", 10)
+    assert await rendering.render(str.upper, "text") == "TEXT"
+
+
+@pytest.mark.asyncio
+async def test_render_timeout_excludes_queueing(app_config, monkeypatch):
+    # start the worker first so the timeout only covers the render
+    await rendering.render(str.upper, "")
+    monkeypatch.setattr(app_config, "RENDER_TIMEOUT", 0.8)
+    # with one worker the second render waits for the first
+    results = await asyncio.gather(
+        rendering.render(slow_upper, "a"),
+        rendering.render(slow_upper, "b"),
+    )
+    assert results == ["A", "B"]
+
+
+@pytest.mark.asyncio
+async def test_render_coalesced():
+    await rendering.render(str.upper, "")
+    start = time.monotonic()
+    results = await asyncio.gather(*(
+        rendering.render(slow_upper, "text", key="same")
+        for _ in range(3)
+    ))
+    assert results == ["TEXT"] * 3
+    # one worker, so separate renders would take 1.5 seconds
+    assert time.monotonic() - start < 1.4
+
+
+@pytest.mark.asyncio
+async def test_render_timed_out_key_remembered(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "RENDER_TIMEOUT", 0.1)
+    with pytest.raises(rendering.RenderTimeout):
+        await rendering.render(slow_upper, "text", key="slow")
+    assert "slow" in rendering.get_slow_render_cache()
+    start = time.monotonic()
+    with pytest.raises(rendering.RenderTimeout):
+        await rendering.render(slow_upper, "text", key="slow")
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_render_cancelled_kills_worker():
+    await rendering.render(str.upper, "")
+    worker = rendering.get_render_pool()._workers[0]
+    pid = worker._process.pid
+    task = asyncio.ensure_future(rendering.render(slow_upper, "text"))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert not worker.is_alive
+    assert await rendering.render(str.upper, "text") == "TEXT"
+    assert worker._process.pid != pid
@@ -0,0 +1,153 @@
+import asyncio
+import shutil
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from git_web.helpers import repo_index
+from git_web.helpers.caching import invalidate_repo
+
+
+@pytest.fixture
+def index_dir(app_config, git_repo: Path) -> Path:
+    """
+    A directory under REPOS_PATH with copies of git_repo named 'alpha' and 'beta'
+    """
+    dir_path = app_config.REPOS_PATH / "pytest-index"
+    for name in ("alpha", "beta"):
+        subprocess.run(
+            ["git", "clone", "-q", "--bare", str(git_repo), str(dir_path / f"{name}.git")],
+            check=True,
+        )
+    yield dir_path
+    shutil.rmtree(dir_path)
+
+
+@pytest.mark.asyncio
+async def test_read_repo_info(git_repo: Path):
+    _, info = await repo_index.read_repo_info(git_repo)
+    assert info.name == "test"
+    assert info.default_branch == "main"
+    assert info.last_commit is not None
+    assert info.ref_count == 1
+    assert info.size > 0
+
+
+@pytest.mark.asyncio
+async def test_read_empty_repo(tmp_path: Path):
+    subprocess.run(["git", "init", "-q", "--bare", "-b", "dev", str(tmp_path / "empty.git")])
+    (tmp_path / "empty.git" / "description").write_text("Empty\n")
+    _, info = await repo_index.read_repo_info(tmp_path / "empty.git")
+    assert info.last_commit is None
+    assert info.default_branch == "dev"
+    assert info.description == "Empty"
+    assert info.ref_count == 0
+
+
+@pytest.mark.asyncio
+async def test_index_directory_changes(index_dir: Path):
+    index = repo_index.RepoIndex()
+    assert "pytest-index" in await index.get_dirs()
+    repos = await index.get_repos("pytest-index")
+    assert sorted(repo.name for repo in repos) == ["alpha", "beta"]
+    subprocess.run(["git", "init", "-q", "--bare", str(index_dir / "gamma.git")], check=True)
+    shutil.rmtree(index_dir / "alpha.git")
+    repos = await index.get_repos("pytest-index")
+    assert sorted(repo.name for repo in repos) == ["beta", "gamma"]
+
+
+@pytest.mark.asyncio
+async def test_index_repo_changes(index_dir: Path, monkeypatch):
+    index = repo_index.RepoIndex()
+    # a directory unchanged since scanned is not read again
+    monkeypatch.setattr(repo_index, "RACY_MODIFIED_NS", 0)
+    await index.rescan()
+    (index_dir / "alpha.git" / "description").write_text("changed by this app\n")
+    index.mark_changed(index_dir / "alpha.git")
+    (index_dir / "beta.git" / "description").write_text("changed outside\n")
+    repos = {repo.name: repo for repo in await index.get_repos("pytest-index")}
+    assert repos["alpha"].description == "changed by this app"
+    assert repos["beta"].description != "changed outside"
+    await index.rescan()
+    repos = {repo.name: repo for repo in await index.get_repos("pytest-index")}
+    assert repos["beta"].description == "changed outside"
+
+
+@pytest.mark.asyncio
+async def test_index_invalidated(index_dir: Path):
+    index = repo_index.get_repo_index()
+    await index.get_repos("pytest-index")
+    subprocess.run(
+        ["git", "-C", str(index_dir / "beta.git"), "branch", "other", "main"], check=True)
+    invalidate_repo(index_dir / "beta.git")
+    repos = {repo.name: repo for repo in await index.get_repos("pytest-index")}
+    assert repos["beta"].ref_count == 2
+
+
+def test_sort_by_activity():
+    older = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    newer = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    repos = [
+        repo_index.RepoInfo(Path("empty.git"), None, None, "", 0, 0),
+        repo_index.RepoInfo(Path("older.git"), older, None, "", 0, 0),
+        repo_index.RepoInfo(Path("newer.git"), newer, None, "", 0, 0),
+    ]
+    repos.sort(key=repo_index.REPO_SORT_KEYS["activity"])
+    assert [repo.name for repo in repos] == ["newer", "older", "empty"]
+
+
+@pytest.mark.asyncio
+async def test_search(index_dir: Path):
+    (index_dir / "beta.git" / "description").write_text("Second alpha version\n")
+    index = repo_index.RepoIndex()
+    repos = await index.search("alpha")
+    # a name match ranks above a description match
+    assert [repo.name for repo in repos] == ["alpha", "beta"]
+    assert [repo.name for repo in await index.search("second ALPHA")] == ["beta"]
+    assert [repo.name for repo in await index.search("pytest-index/al")] == ["alpha"]
+    assert await index.search("  ") == []
+    (index_dir / "alpha.git").rename(index_dir / "gamma.git")
+    repos = await index.search("alpha")
+    assert [repo.name for repo in repos] == ["beta"]
+
+
+@pytest.mark.asyncio
+async def test_search_ranks():
+    index = repo_index.RepoIndex()
+    index.get_dirs = lambda: asyncio.sleep(0, [])
+    for path, description in (
+        ("web-apps/site.git", ""), ("tools/my-web.git", ""), ("tools/web-tools.git", ""),
+        ("tools/web.git", ""), ("tools/docs.git", "Web docs"), ("tools/gone.git", ""),
+    ):
+        index._set_repo(repo_index.RepoInfo(Path(path), None, None, description, 0, 0), ())
+    index._remove_repo(Path("tools/gone.git"))
+    repos = await index.search("web")
+    assert [repo.name for repo in repos] == ["web", "web-tools", "my-web", "site", "docs"]
+    assert [repo.name for repo in await index.search("web", 2)] == ["web", "web-tools"]
+    assert [repo.name for repo in await index.search("apps/s")] == ["site"]
+    # ranked by the sum of each term's rank, 'tools' being in every directory
+    repos = await index.search("web tools")
+    assert [repo.name for repo in repos] == ["web", "web-tools", "my-web", "docs"]
+    assert await index.search("gone") == []
+
+
+@pytest.mark.asyncio
+async def test_search_latency():
+    index = repo_index.RepoIndex()
+    # as if 10,000 repositories had been read
+    index.get_dirs = lambda: asyncio.sleep(0, [])
+    for number in range(10000):
+        info = repo_index.RepoInfo(
+            Path(f"directory-{number % 50}/repo-{number}.git"), None, "main",
+            f"description of project {number} with some words", 0, 1,
+        )
+        index._set_repo(info, ())
+    for query in ("repo-12", "project 9999", "words", "re", "e", "directory-7/repo"):
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            await index.search(query, 10)
+            timings.append(time.perf_counter() - start)
+        assert min(timings) < 0.01
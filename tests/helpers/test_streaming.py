@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+from git_web.helpers import streaming
+from werkzeug.exceptions import (BadRequest, RequestEntityTooLarge,
+                                 UnsupportedMediaType)
+
+
+async def iter_chunks(content: bytes, size: int = 1000):
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+async def read_all(stream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+
+@pytest.mark.asyncio
+async def test_decode_body_gzip():
+    content = os.urandom(50000) + bytes(200000)
+    decoded = streaming.decode_body(iter_chunks(gzip.compress(content)), "gzip", len(content))
+    chunks = [chunk async for chunk in decoded]
+    assert b"".join(chunks) == content
+    # a highly compressed chunk is not expanded at once
+    assert max(map(len, chunks)) <= streaming.DECODE_SIZE
+
+
+@pytest.mark.asyncio
+async def test_decode_body_too_large():
+    content = bytes(200000)
+    with pytest.raises(RequestEntityTooLarge):
+        await read_all(streaming.decode_body(iter_chunks(gzip.compress(content)), "gzip", 100000))
+    with pytest.raises(RequestEntityTooLarge):
+        await read_all(streaming.decode_body(iter_chunks(content), None, 100000))
+
+
+@pytest.mark.asyncio
+async def test_decode_body_invalid():
+    with pytest.raises(UnsupportedMediaType):
+        await read_all(streaming.decode_body(iter_chunks(b"data"), "br", 100))
+    with pytest.raises(BadRequest):
+        await read_all(streaming.decode_body(iter_chunks(b"not gzip"), "gzip", 100))
+    truncated = gzip.compress(bytes(1000))[:-10]
+    with pytest.raises(BadRequest):
+        await read_all(streaming.decode_body(iter_chunks(truncated, 10), "gzip", 1000))
+
+
+@pytest.mark.asyncio
+async def test_buffer_body():
+    content = os.urandom(5000)
+    assert await streaming.buffer_body(iter_chunks(content), 5000) == content
+    stream = await streaming.buffer_body(iter_chunks(content), 2500)
+    assert await read_all(stream) == content
+
+
+@pytest.mark.asyncio
+async def test_start_stream():
+    async def failing():
+        raise RequestEntityTooLarge()
+        yield b""
+
+    with pytest.raises(RequestEntityTooLarge):
+        await streaming.start_stream(failing())
+    assert await read_all(await streaming.start_stream(iter_chunks(b"content", 2))) == b"content"
+
+
+@pytest.mark.asyncio
+async def test_body_wait_for_space():
+    body = streaming.StreamingBody(None, None)
+    body.append(bytes(streaming.STREAM_BUFFER_SIZE))
+    waiting = asyncio.ensure_future(body.wait_for_space())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    await body.__anext__()
+    await asyncio.wait_for(waiting, 1)
+
+
+@pytest.mark.asyncio
+async def test_body_read_whole():
+    body = streaming.StreamingBody(None, None)
+    body.append(bytes(streaming.STREAM_BUFFER_SIZE))
+    waiting = asyncio.ensure_future(body.wait_for_space())
+    read = asyncio.ensure_future(body)
+    await asyncio.wait_for(waiting, 1)
+    body.append(b"end")
+    body.set_complete()
+    assert len(await read) == streaming.STREAM_BUFFER_SIZE + 3
+
+
+@pytest.mark.asyncio
+async def test_body_max_content_length():
+    # only refused by its length when read whole
+    body = streaming.StreamingBody(2000, 1000)
+    body.append(bytes(500))
+    assert len(await body.__anext__()) == 500
+    with pytest.raises(RequestEntityTooLarge):
+        await streaming.StreamingBody(2000, 1000)
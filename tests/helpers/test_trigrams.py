@@ -0,0 +1,54 @@
+from git_web.helpers import trigrams
+
+
+def test_iter_trigrams():
+    assert list(trigrams.iter_trigrams("abcd")) == ["abc", "bcd"]
+    assert list(trigrams.iter_trigrams("ab")) == []
+
+
+def test_find():
+    index = trigrams.TrigramIndex()
+    index.add("web", "Git-Web interface")
+    index.add("cli", "command line interface")
+    assert index.find("interface") == {"web", "cli"}
+    assert index.find("git-web") == {"web"}
+    assert index.find("li") == {"cli"}
+    # trigrams present, but not next to each other
+    assert index.find("webface") == set()
+    assert index.find("missing") == set()
+
+
+def test_replace_and_remove():
+    index = trigrams.TrigramIndex()
+    index.add("repo", "old name")
+    index.add("repo", "new name")
+    assert index.find("old") == set()
+    assert index.find("new") == {"repo"}
+    index.remove("repo")
+    index.remove("repo")
+    assert index.find("name") == set()
+    assert len(index) == 0
+    assert not index._postings
+
+
+def test_segment(tmp_path):
+    builder = trigrams.TrigramSegmentBuilder()
+    builder.add(b"a" * 20, trigrams.find_content_trigrams(b"Hello World"))
+    builder.add(b"b" * 20, trigrams.find_content_trigrams(b"hello there"))
+    builder.add(b"c" * 20, ())
+    builder.write(tmp_path / "segment")
+    segment = trigrams.TrigramSegment(tmp_path / "segment")
+    assert len(segment) == 3
+    assert list(segment.iter_keys()) == [b"a" * 20, b"b" * 20, b"c" * 20]
+    assert segment.find([b"hel", b"llo"]) == {0, 1}
+    assert segment.find([b"hel", b"wor"]) == {0}
+    assert segment.find([b"xyz"]) == set()
+    # every document, as nothing is required
+    assert segment.find([]) == {0, 1, 2}
+
+
+def test_empty_segment(tmp_path):
+    trigrams.TrigramSegmentBuilder().write(tmp_path / "segment")
+    segment = trigrams.TrigramSegment(tmp_path / "segment")
+    assert len(segment) == 0
+    assert segment.find([b"abc"]) == set()
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import cat_file_pool, views
+from git_web.helpers.rendering import RenderTimeout
+from quart import Quart
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pool():
+    yield
+    await cat_file_pool.close_cat_file_pool()
+
+
+@pytest.mark.asyncio
+async def test_gather_or_cancel():
+    async def value(n):
+        await asyncio.sleep(0)
+        return n
+
+    assert await views.gather_or_cancel(value(1), value(2)) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_gather_or_cancel_cancels_on_error():
+    cancelled = asyncio.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(views.gather_or_cancel(slow(), fail()), 5)
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_get_repo_view_content(git_repo: Path):
+    async def get_tree_ish(tree_ish):
+        return tree_ish
+
+    content = await views.get_repo_view_content(None, git_repo, resolved=get_tree_ish)
+    assert content.tree_ish == "main"
+    assert content.head == "main"
+    assert "main" in content.branches
+    assert {str(item.file) for item in content.root_tree} >= {"README.md", "hello.py"}
+    assert content.recent_log.subject == "second commit"
+    assert content.extra == {"resolved": "main"}
+
+
+@pytest.mark.asyncio
+async def test_get_repo_view_content_empty_repo(tmp_path: Path):
+    repo_path = tmp_path / "empty.git"
+    subprocess.run(["git", "init", "-q", "--bare", str(repo_path)], check=True)
+    content = await views.get_repo_view_content(None, repo_path)
+    assert content.head is None
+    assert content.root_tree is None
+    assert content.extra == {}
+
+
+@pytest.fixture
+def inline_render(app_config, monkeypatch):
+    monkeypatch.setattr(app_config, "RENDER_WORKERS", 0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("inline_render")
+async def test_try_get_readme_cached(app: Quart, git_repo: Path):
+    cache = views.get_readme_cache()
+    cache.clear()
+    async with app.test_request_context("/pytest-views/test"):
+        html = await views.try_get_readme(git_repo, "pytest-views", "test", "main")
+        hits = cache.hits
+        assert await views.try_get_readme(git_repo, "pytest-views", "test", "main") == html
+    assert "<h1>Test</h1>" in html
+    assert cache.hits == hits + 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("inline_render")
+async def test_try_get_readme_missing_cached(app: Quart, tmp_path: Path, monkeypatch):
+    work_path = tmp_path / "work"
+    repo_path = tmp_path / "no-readme.git"
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+        GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+    )
+    subprocess.run(["git", "init", "-q", "-b", "main", str(work_path)], check=True)
+    subprocess.run(
+        ["git", "-C", str(work_path), "commit", "-q", "--allow-empty", "-m", "empty"],
+        check=True, env=env,
+    )
+    subprocess.run(["git", "clone", "-q", "--bare", str(work_path), str(repo_path)], check=True)
+    commit_hash = await cat_file_pool.get_commit_hash(repo_path, "main")
+
+    async with app.test_request_context("/pytest-views/test"):
+        assert await views.try_get_readme(repo_path, "pytest-views", "test", "main") == ""
+        assert (str(repo_path), commit_hash) in views.get_no_readme_cache()
+
+        async def no_lookup(*_):
+            raise AssertionError("README looked up again")
+
+        monkeypatch.setattr(views, "get_object_info", no_lookup)
+        assert await views.try_get_readme(repo_path, "pytest-views", "test", "main") == ""
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("inline_render")
+async def test_render_markdown_or_text_store():
+    stored = []
+
+    async def store(html: str):
+        stored.append(html)
+
+    html = await views.render_markdown_or_text("# Title", store=store)
+    assert stored == [html]
+    assert "<h1>Title</h1>" in html
+
+
+@pytest.mark.asyncio
+async def test_render_markdown_or_text_timeout_not_stored(monkeypatch):
+    stored = []
+
+    async def store(html: str):
+        stored.append(html)
+
+    async def timed_out(*_, **__):
+        raise RenderTimeout("render timed out")
+
+    monkeypatch.setattr(views, "render", timed_out)
+    html = await views.render_markdown_or_text("# <Title>", store=store)
+    assert html == "<pre># &lt;Title&gt;</pre>"
+    assert stored == []
+
+
+@pytest.mark.asyncio
+async def test_read_blob_preview_text(git_repo: Path):
+    info, mimetype, content = await views.read_blob_preview(git_repo, "main", "NOTES")
+    assert mimetype == "text/plain"
+    assert content == b"some notes\n"
+    assert views.get_content_type_cache().get(info.object_hash) == "text/plain"
+    # the cached type is used, the content is still read in the same request
+    assert await views.read_blob_preview(git_repo, "main", "NOTES") == (info, mimetype, content)
+
+
+@pytest.mark.asyncio
+async def test_read_blob_preview_binary(git_repo: Path):
+    info, mimetype, content = await views.read_blob_preview(git_repo, "main", "data.txt")
+    assert mimetype == "application/octet-stream"
+    assert content is None
+    # the rest of the blob was skipped, so the process is kept
+    pool = cat_file_pool.get_cat_file_pool()
+    assert len(pool._idle[(str(git_repo), False)]) == 1
+
+
+@pytest.mark.asyncio
+async def test_read_blob_preview_without_content(git_repo: Path):
+    info, mimetype, content = await views.read_blob_preview(
+        git_repo, "main", "large.txt", False)
+    assert mimetype == "text/plain"
+    assert content is None
+
+
+@pytest.mark.asyncio
+async def test_sniff_blob_stream(git_repo: Path):
+    views.get_content_type_cache().clear()
+    info, content = await cat_file_pool.open_object(git_repo, "main", "data.txt")
+    mimetype, content = await views.sniff_blob_stream("data.txt", info, content)
+    assert mimetype == "application/octet-stream"
+    assert b"".join([chunk async for chunk in content]) == bytes(range(256)) * 64
@@ -0,0 +1,65 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+from git_web.helpers.caching import invalidate_repo
+from quart import Quart
+
+
+@pytest.fixture
+def listed_dir(app_config, git_repo: Path) -> Path:
+    """
+    A directory under REPOS_PATH with git_repo as 'active'
+    and an empty repository named 'abandoned'
+    """
+    dir_path = app_config.REPOS_PATH / "pytest-listing"
+    subprocess.run(
+        ["git", "clone", "-q", "--bare", str(git_repo), str(dir_path / "active.git")],
+        check=True,
+    )
+    subprocess.run(["git", "init", "-q", "--bare", str(dir_path / "abandoned.git")], check=True)
+    yield dir_path
+    shutil.rmtree(dir_path)
+
+
+@pytest.mark.asyncio
+async def test_repo_list(app: Quart, listed_dir: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        explore = await client.get("/explore")
+        by_name = await client.get("/pytest-listing")
+        by_activity = await client.get("/pytest-listing?sort=activity")
+        invalid = await client.get("/pytest-listing?sort=size")
+        searched = await client.get("/pytest-listing?q=act")
+    assert "pytest-listing" in await explore.get_data(as_text=True)
+    content = await by_name.get_data(as_text=True)
+    assert content.index(">abandoned<") < content.index(">active<")
+    assert "no commits" in content
+    assert "main" in content
+    content = await by_activity.get_data(as_text=True)
+    assert content.index(">active<") < content.index(">abandoned<")
+    assert invalid.status_code == 400
+    assert searched.status_code == 302
+
+
+@pytest.mark.asyncio
+async def test_search(app: Quart, listed_dir: Path):
+    (listed_dir / "abandoned.git" / "description").write_text("Left behind\n")
+    # as when changed through this app
+    invalidate_repo(listed_dir / "abandoned.git")
+    client = app.test_client()
+    async with client.authenticated("1"):
+        searched = await client.get("/search?q=behind")
+        empty = await client.get("/search")
+        suggested = await client.get("/search/suggest?q=act")
+    content = await searched.get_data(as_text=True)
+    assert "pytest-listing/abandoned" in content
+    assert "pytest-listing/active" not in content
+    assert empty.status_code == 200
+    assert await suggested.get_json() == [{
+        "directory": "pytest-listing",
+        "name": "active",
+        "description": (listed_dir / "active.git" / "description").read_text().strip(),
+        "url": "/pytest-listing/active",
+    }]
@@ -17,3 +17,15 @@ async def test_index_authenticated(app: Quart):
         response = await test_client.get("/")
         assert response.status_code == 200
         assert "Log Out" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_stats(app: Quart):
+    test_client = app.test_client()
+    async with test_client.authenticated("1"):
+        response = await test_client.get("/stats")
+    stats = await response.get_json()
+    assert set(stats["admission"]) == {"interactive", "push", "fetch", "archive", "maintenance"}
+    assert stats["admission"]["push"]["limit"] == 4
+    assert set(stats["maintenance"]) == {"queued", "running", "completed", "failed"}
+    assert set(stats["code_search"]) == {"queued", "running", "completed", "failed"}
@@ -0,0 +1,387 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from git_web.helpers import cat_file_pool, code_search, maintenance, views
+from git_web.views.git_http import invalidate_after_push
+from quart import Quart
+from quart.wrappers.response import IterableBody
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_pool():
+    yield
+    await cat_file_pool.close_cat_file_pool()
+
+
+def push_commit(repo_path: Path, work_path: Path, subject: str):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="pytest", GIT_AUTHOR_EMAIL="pytest@example.com",
+        GIT_COMMITTER_NAME="pytest", GIT_COMMITTER_EMAIL="pytest@example.com",
+    )
+    subprocess.run(["git", "clone", "-q", str(repo_path), str(work_path)], check=True)
+    subprocess.run(
+        ["git", "-C", str(work_path), "commit", "-q", "--allow-empty", "-m", subject],
+        check=True, env=env,
+    )
+    subprocess.run(["git", "-C", str(work_path), "push", "-q", "origin", "main"], check=True)
+
+
+@pytest.mark.asyncio
+async def test_page_served_from_cache(app: Quart, served_repos: Path):
+    cache = views.get_page_cache()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        first = await client.get("/pytest-views/test")
+        hits = cache.hits
+        second = await client.get("/pytest-views/test")
+    assert second.status_code == 200
+    assert cache.hits == hits + 1
+    assert await first.get_data() == await second.get_data()
+
+
+@pytest.mark.asyncio
+async def test_page_with_flashes_not_cached(app: Quart, served_repos: Path):
+    cache = views.get_page_cache()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        await client.get("/pytest-views/test/tree/main")
+        async with client.session_transaction() as session:
+            session["_flashes"] = [("ok", "pending message")]
+        hits = cache.hits
+        response = await client.get("/pytest-views/test/tree/main")
+    assert "pending message" in await response.get_data(as_text=True)
+    assert cache.hits == hits
+
+
+@pytest.mark.asyncio
+async def test_branch_change_invalidates_only_that_repo(app: Quart, served_repos: Path):
+    cache = views.get_page_cache()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        await client.get("/pytest-views/test")
+        await client.get("/pytest-views/other")
+        await client.post(
+            "/pytest-views/test/new-branch",
+            form={"branch-name-new": "cache-test"},
+        )
+    # a new client has no pending flashes from the post
+    client = app.test_client()
+    async with client.authenticated("1"):
+        hits = cache.hits
+        await client.get("/pytest-views/other")
+        assert cache.hits == hits + 1
+        response = await client.get("/pytest-views/test")
+        assert cache.hits == hits + 1
+    assert "cache-test" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_push_invalidates_page(app: Quart, served_repos: Path, tmp_path: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        await client.get("/pytest-views/test/commits/main")
+        push_commit(served_repos / "test.git", tmp_path / "work", "pushed commit")
+        response = await client.get("/pytest-views/test/commits/main")
+    assert "pushed commit" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_commit_log_pages(app: Quart, app_config, served_repos: Path, monkeypatch):
+    monkeypatch.setattr(app_config, "MAX_COMMIT_LOG_COUNT", 1)
+    # pages cached with the configured count
+    views.get_page_cache().clear()
+    first, second = subprocess.run(
+        ["git", "-C", str(served_repos / "test.git"), "rev-list", "-2", "main"],
+        check=True, capture_output=True, text=True,
+    ).stdout.split()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/commits/main")
+        assert f"after={first}" in await response.get_data(as_text=True)
+        response = await client.get(f"/pytest-views/test/commits/main?after={first[:10]}")
+        body = await response.get_data(as_text=True)
+        assert second in body and f"before={second}" in body
+        response = await client.get(f"/pytest-views/test/commits/main?before={second}")
+        assert first in await response.get_data(as_text=True)
+        response = await client.get("/pytest-views/test/commits/main?after=unknown")
+        assert "No Commits Found" in await response.get_data(as_text=True)
+        response = await client.get("/pytest-views/test/commits/main?before=not-a-hash")
+        assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_invalidate_after_push(served_repos: Path):
+    cache = views.get_page_cache()
+    test_key = (str(served_repos / "test.git"), "page")
+    other_key = (str(served_repos / "other.git"), "page")
+    cache.set(test_key, "html")
+    cache.set(other_key, "html")
+    body = IterableBody([b"result"])
+    chunks = [chunk async for chunk in invalidate_after_push(served_repos / "test.git", body)]
+    assert chunks == [b"result"]
+    assert test_key not in cache
+    assert other_key in cache
+
+
+@pytest.mark.asyncio
+async def test_pinned_commit_page_kept_after_push(
+        app: Quart, served_repos: Path, tmp_path: Path):
+    cache = views.get_page_cache()
+    repo_path = served_repos / "other.git"
+    commit_hash = subprocess.run(
+        ["git", "-C", str(repo_path), "rev-parse", "main"],
+        capture_output=True, check=True,
+    ).stdout.decode().strip()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        await client.get(f"/pytest-views/other/tree/{commit_hash}")
+        push_commit(repo_path, tmp_path / "work", "another pushed commit")
+        hits = cache.hits
+        response = await client.get(f"/pytest-views/other/tree/{commit_hash}")
+    assert response.status_code == 200
+    assert cache.hits == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_blob_line_window(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/blob/main/large.txt?lines=1000-1001")
+        html = await response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'id="L1000"' in html and 'id="L1001"' in html
+    assert 'id="L1002"' not in html
+
+
+@pytest.mark.asyncio
+async def test_blob_line_window_past_end(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/blob/main/README.md?lines=50")
+        html = await response.get_data(as_text=True)
+    assert response.status_code == 200
+    # the window past the end shows the last line
+    assert 'id="L1"' in html
+    assert "Test" in html
+
+
+@pytest.mark.asyncio
+async def test_blob_line_window_invalid(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/blob/main/README.md?lines=5-2")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_blob_binary_with_text_name(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/blob/main/data.txt")
+        raw_response = await client.get("/pytest-views/test/raw/main/data.txt")
+    assert response.status_code == 200
+    assert raw_response.mimetype == "application/octet-stream"
+    assert await raw_response.get_data() == bytes(range(256)) * 64
+
+
+@pytest.mark.asyncio
+async def test_blob_text_without_extension(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/blob/main/NOTES")
+    assert "some notes" in await response.get_data(as_text=True)
+
+
+def rev_parse(repo_path: Path, rev: str) -> str:
+    return subprocess.run(
+        ["git", "-C", str(repo_path), "rev-parse", rev],
+        capture_output=True, check=True,
+    ).stdout.decode().strip()
+
+
+@pytest.mark.asyncio
+async def test_raw_file_validators(app: Quart, served_repos: Path):
+    repo_path = served_repos / "test.git"
+    blob_hash = rev_parse(repo_path, "main:README.md")
+    commit_hash = rev_parse(repo_path, "main")
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/raw/main/README.md")
+        pinned = await client.get(f"/pytest-views/test/raw/{commit_hash}/README.md")
+        not_modified = await client.get(
+            "/pytest-views/test/raw/main/README.md",
+            headers={"If-None-Match": f'"{blob_hash}"'},
+        )
+    assert response.headers["ETag"] == f'"{blob_hash}"'
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert "immutable" in pinned.headers["Cache-Control"]
+    assert not_modified.status_code == 304
+    assert await not_modified.get_data() == b""
+
+
+@pytest.mark.asyncio
+async def test_raw_file_head(app: Quart, served_repos: Path):
+    repo_path = served_repos / "test.git"
+    info = await cat_file_pool.get_object_info(repo_path, "main", "large.txt")
+    # the test client sets Content-Length from the (empty) body it receives
+    async with app.test_request_context("/pytest-views/test/raw/main/large.txt", method="HEAD"):
+        response = await views.make_raw_blob_response(repo_path, info, "large.txt", False)
+    assert response.status_code == 200
+    assert response.content_length == info.size == 1088890
+    assert response.mimetype == "text/plain"
+    assert await response.get_data() == b""
+
+
+@pytest.mark.asyncio
+async def test_raw_file_range(app: Quart, served_repos: Path):
+    content = "".join(f"line {i}\n" for i in range(100000)).encode()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get(
+            "/pytest-views/test/raw/main/large.txt",
+            headers={"Range": "bytes=500000-500099"},
+        )
+        suffix = await client.get(
+            "/pytest-views/test/raw/main/large.txt",
+            headers={"Range": "bytes=-10"},
+        )
+        multiple = await client.get(
+            "/pytest-views/test/raw/main/README.md",
+            headers={"Range": "bytes=0-1,3-4"},
+        )
+        outside = await client.get(
+            "/pytest-views/test/raw/main/README.md",
+            headers={"Range": "bytes=100-200"},
+        )
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 500000-500099/{len(content)}"
+    assert await response.get_data() == content[500000:500100]
+    assert await suffix.get_data() == content[-10:]
+    assert multiple.status_code == 200
+    assert await multiple.get_data() == b"# Test\n"
+    assert outside.status_code == 416
+    assert outside.headers["Content-Range"] == "bytes */7"
+
+
+@pytest.mark.asyncio
+async def test_raw_file_not_a_blob(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/raw/main/")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_archive(app: Quart, served_repos: Path):
+    repo_path = served_repos / "test.git"
+    commit_hash = rev_parse(repo_path, "main^{/^first commit}")
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get(f"/pytest-views/test/archive.tar?tree_ish={commit_hash}")
+        content = await response.get_data()
+        not_modified = await client.get(
+            f"/pytest-views/test/archive.tar?tree_ish={commit_hash}",
+            headers={"If-None-Match": f'"{commit_hash}.tar"'},
+        )
+        unknown = await client.get("/pytest-views/test/archive.tar?tree_ish=unknown")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{commit_hash}.tar"'
+    assert "immutable" in response.headers["Cache-Control"]
+    assert f'filename="test-{commit_hash}.tar"' in response.headers["Content-Disposition"]
+    # the first commit only has the README
+    names = subprocess.run(
+        ["tar", "-t"], input=content, capture_output=True, check=True,
+    ).stdout.decode().split()
+    assert names == ["README.md"]
+    assert not_modified.status_code == 304
+    assert unknown.status_code == 404
+
+
+async def get_archive_names(response, *decompress: str) -> list[str]:
+    content = await response.get_data()
+    if decompress:
+        content = subprocess.run(
+            decompress, input=content, capture_output=True, check=True,
+        ).stdout
+    return subprocess.run(
+        ["tar", "-t"], input=content, capture_output=True, check=True,
+    ).stdout.decode().split()
+
+
+@pytest.mark.asyncio
+async def test_archive_path_and_level(app: Quart, served_repos: Path):
+    repo_path = served_repos / "test.git"
+    tree_hash = rev_parse(repo_path, "main:docs")
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/archive.tar.gz?path=docs&level=1")
+        not_a_tree = await client.get("/pytest-views/test/archive.tar?path=README.md")
+        invalid_level = await client.get("/pytest-views/test/archive.tar.gz?level=10")
+        no_level = await client.get("/pytest-views/test/archive.tar?level=1")
+        unknown_format = await client.get("/pytest-views/test/archive.rar")
+    assert response.headers["ETag"] == f'"{tree_hash}-1.tar.gz"'
+    assert 'filename="test-docs.tar.gz"' in response.headers["Content-Disposition"]
+    assert await get_archive_names(response, "gzip", "-d") == ["guide.md"]
+    assert not_a_tree.status_code == 404
+    assert invalid_level.status_code == 400
+    assert no_level.status_code == 400
+    assert unknown_format.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd not installed")
+async def test_archive_zstd(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/archive.tar.zst?path=docs&level=19")
+    assert response.status_code == 200
+    assert await get_archive_names(response, "zstd", "-d") == ["guide.md"]
+
+
+@pytest.mark.asyncio
+async def test_maintenance_queued(app: Quart, served_repos: Path):
+    maintenance.get_maintenance_scheduler.cache_clear()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/maintenance")
+    assert response.status_code == 302
+    # run by the scheduler's workers, not in the request
+    assert maintenance.get_maintenance_scheduler().get_stats()["queued"] == 1
+    maintenance.get_maintenance_scheduler.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_code_search(app: Quart, served_repos: Path, app_config, monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(app_config, "CACHE_PATH", tmp_path / "cache")
+    code_search.get_code_indexer.cache_clear()
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/search?q=hello")
+        assert "being indexed" in await response.get_data(as_text=True)
+        # queued for the workers by the search
+        assert code_search.get_code_indexer().get_stats()["queued"] == 1
+        await code_search.update_code_index(served_repos / "test.git")
+        response = await client.get("/pytest-views/test/search?q=hello")
+        content = await response.get_data(as_text=True)
+        assert "hello.py" in content and "being indexed" not in content
+        response = await client.get("/pytest-views/test/search?q=(&regex=1")
+        assert response.status_code == 400
+    code_search.get_code_indexer.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_file_finder(app: Quart, served_repos: Path):
+    client = app.test_client()
+    async with client.authenticated("1"):
+        response = await client.get("/pytest-views/test/find/main?q=guide")
+        assert "docs/guide.md" in await response.get_data(as_text=True)
+        response = await client.get("/pytest-views/test/find/main/suggest?q=hlo")
+        assert await response.get_json() == [
+            {"path": "hello.py", "url": "/pytest-views/test/blob/main/hello.py"}]
+        response = await client.get("/pytest-views/test/find/unknown/suggest?q=hlo")
+        assert response.status_code == 404